@@ -1,18 +1,218 @@
 import numpy as np
-import pandas as pd
 from sklearn.ensemble import IsolationForest
-from sklearn.svm import OneClassSVM
-from sklearn.neighbors import LocalOutlierFactor
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import precision_recall_fscore_support
+from sklearn.cluster import KMeans, MiniBatchKMeans
+import time
 import logging
-from models import Anomaly, DataPoint, ModelEvaluation, Recommendation
+from models import Anomaly, ModelEvaluation, Recommendation
+from feature_cache import get_features
+from timeseries_store import count_points
+from model_registry import find_model, load_model, save_model
+from recommendation_rules import readings_for, evaluate_rules, MIN_ANOMALIES_FOR_PATTERNS
+from autoencoder import fit_autoencoder, reconstruction_errors
+from metrics import stage
+
+
+# K-means: inputs this large are fitted with MiniBatchKMeans
+KMEANS_MINIBATCH_MIN_ROWS = 100000
+# Largest k tried, and the subsample the elbow is found on
+KMEANS_MAX_CLUSTERS = 10
+KMEANS_SELECTION_SAMPLE_ROWS = 5000
+# Points per block when computing centre distances
+DISTANCE_CHUNK_ROWS = 100000
+
+
+def _normalize(values, low, high):
+    """Scale values to the 0-1 range given the training minimum and maximum."""
+    if high > low:
+        return np.clip((values - low) / (high - low), 0.0, 1.0)
+    return np.zeros(len(values))
+
+
+def _fit_isolation_forest(X_scaled, contamination):
+    model = IsolationForest(contamination=contamination, random_state=42)
+    model.fit(X_scaled)
+    return {'kind': 'isolation_forest', 'model': model}
+
+
+def _select_n_clusters(X_sample):
+    """
+    Pick the number of clusters at the elbow of the inertia curve: the k
+    whose (k, inertia) point lies furthest below the line joining the
+    curve's ends.
+    """
+    max_clusters = min(KMEANS_MAX_CLUSTERS, len(X_sample) - 1)
+    if max_clusters < 2:
+        return max(1, min(2, len(X_sample)))
+    ks = np.arange(1, max_clusters + 1)
+    inertias = np.array([MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3).fit(X_sample).inertia_
+                         for k in ks])
+    if inertias[0] <= 0:
+        return 2
+    # Distance below the chord, with both axes scaled to 0-1
+    x = (ks - 1) / (max_clusters - 1)
+    y = inertias / inertias[0]
+    chord = y[0] + (y[-1] - y[0]) * x
+    return int(max(2, ks[np.argmax(chord - y)]))
+
+
+def _fit_kmeans(X_scaled, contamination):
+    """
+    Fit k-means with k chosen from a subsample, using MiniBatchKMeans for
+    large inputs. Only the centres are kept, which is all scoring needs.
+    """
+    rng = np.random.default_rng(42)
+    if len(X_scaled) > KMEANS_SELECTION_SAMPLE_ROWS:
+        X_sample = X_scaled[rng.choice(len(X_scaled), size=KMEANS_SELECTION_SAMPLE_ROWS, replace=False)]
+    else:
+        X_sample = X_scaled
+    n_clusters = _select_n_clusters(X_sample)
+    
+    if len(X_scaled) >= KMEANS_MINIBATCH_MIN_ROWS:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, batch_size=4096, n_init=3)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    kmeans.fit(X_scaled)
+    detector = {'kind': 'kmeans', 'centers': kmeans.cluster_centers_}
+    
+    # Distances to the cluster centres set the threshold and score range
+    distances = _kmeans_distances(detector, X_scaled)
+    detector['threshold'] = float(np.percentile(distances, 100 * (1 - contamination)))
+    detector['score_min'] = float(distances.min())
+    detector['score_max'] = float(distances.max())
+    return detector
+
+
+def fit_detector(algorithm, X_scaled, contamination=0.1):
+    """
+    Fit an anomaly detector on a scaled feature matrix.
+    
+    Args:
+        algorithm: String indicating which algorithm to use
+        X_scaled: 2-D array of scaled features
+        contamination: Float between 0 and 0.5 representing expected percentage of anomalies
+        
+    Returns:
+        Detector dict holding the fitted model and the training statistics
+        needed by score_detector
+    """
+    if algorithm == 'isolation_forest':
+        return _fit_isolation_forest(X_scaled, contamination)
+    
+    elif algorithm == 'kmeans_clustering':
+        return _fit_kmeans(X_scaled, contamination)
+    
+    elif algorithm == 'auto_encoder':
+        detector = {'kind': 'autoencoder', 'weights': fit_autoencoder(X_scaled)}
+        
+        # Reconstruction errors set the score range and threshold
+        errors = reconstruction_errors(detector['weights'], X_scaled)
+        detector['score_min'] = float(errors.min())
+        detector['score_max'] = float(errors.max())
+        scores = _normalize(errors, detector['score_min'], detector['score_max'])
+        detector['threshold'] = float(np.percentile(scores, 100 * (1 - contamination)))
+        return detector
+    
+    raise ValueError(f"Unknown algorithm: {algorithm}")
+
+
+def _kmeans_distances(detector, X_scaled):
+    """Distance from each point to its nearest cluster centre."""
+    centers = detector['centers']
+    center_norms = np.einsum('ij,ij->i', centers, centers)
+    distances = np.empty(len(X_scaled))
+    # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, one chunk of points at a time
+    for low in range(0, len(X_scaled), DISTANCE_CHUNK_ROWS):
+        chunk = X_scaled[low:low + DISTANCE_CHUNK_ROWS]
+        squared = (np.einsum('ij,ij->i', chunk, chunk)[:, None] - 2 * chunk @ centers.T + center_norms).min(axis=1)
+        distances[low:low + DISTANCE_CHUNK_ROWS] = np.sqrt(np.maximum(squared, 0.0))
+    return distances
+
+
+def score_detector(detector, X_scaled):
+    """
+    Score points with a fitted detector.
+    
+    Args:
+        detector: Detector dict as returned by fit_detector
+        X_scaled: 2-D array of features scaled like the training data
+        
+    Returns:
+        Tuple of (anomaly scores, higher is more anomalous; boolean array
+        marking the points classed as anomalies)
+    """
+    if len(X_scaled) == 0:
+        return np.zeros(0), np.zeros(0, dtype=bool)
+    
+    if detector['kind'] == 'isolation_forest':
+        model = detector['model']
+        # -1 for anomalies, 1 for normal data points
+        labels = model.predict(X_scaled) == -1
+        # Invert decision scores so that higher = more anomalous
+        scores = 1 - (model.decision_function(X_scaled) + 0.5)
+        return scores, labels
+    
+    if detector['kind'] == 'kmeans':
+        # Identify anomalies based on distance to cluster center
+        distances = _kmeans_distances(detector, X_scaled)
+        labels = distances > detector['threshold']
+        return _normalize(distances, detector['score_min'], detector['score_max']), labels
+    
+    if detector['kind'] == 'autoencoder':
+        # Determine anomalies based on reconstruction error threshold
+        errors = reconstruction_errors(detector['weights'], X_scaled)
+        scores = _normalize(errors, detector['score_min'], detector['score_max'])
+        return scores, scores > detector['threshold']
+    
+    raise ValueError(f"Unknown detector kind: {detector['kind']}")
+
+
+def get_detector(dataset_id, algorithm, contamination, features, component_of=None):
+    """
+    Load the detector fitted earlier on the same version of a dataset with
+    the same parameters from the model registry, or fit and register one.
+    
+    Args:
+        dataset_id: ID of the dataset
+        algorithm: String indicating which algorithm to use
+        contamination: Float between 0 and 0.5 representing expected percentage of anomalies
+        features: Dict with the scaled feature matrix ('X_scaled'), its
+            'feature_names', 'scaler' and data 'version'
+        component_of: Ensemble algorithm the detector is part of, if any;
+            ensemble components are registered apart from the detectors of
+            single-algorithm runs
+        
+    Returns:
+        Detector dict as returned by fit_detector
+    """
+    params = {'contamination': contamination}
+    if component_of is not None:
+        params['component_of'] = component_of
+    record = find_model(dataset_id, algorithm, params, data_version=features['version'])
+    if record is not None and record.feature_names == features['feature_names']:
+        with stage('detection', 'load_model'):
+            detector, _ = load_model(record)
+        if detector is not None:
+            return detector
+    
+    X_scaled = features['X_scaled']
+    started = time.perf_counter()
+    with stage('detection', 'fit'):
+        detector = fit_detector(algorithm, X_scaled, contamination)
+    save_model(dataset_id, algorithm, params, detector, features['scaler'],
+               data_version=features['version'],
+               training_size=len(X_scaled),
+               fit_seconds=time.perf_counter() - started,
+               feature_names=features['feature_names'])
+    return detector
 
 
 def detect_anomalies(dataset, algorithm, contamination=0.1):
     """
     Detect anomalies in the given dataset using the specified algorithm.
     
+    A model fitted earlier on the same version of the dataset with the same
+    parameters is reused from the model registry instead of being refitted.
+    
     Args:
         dataset: The Dataset model instance
         algorithm: String indicating which algorithm to use
@@ -22,127 +222,33 @@ def detect_anomalies(dataset, algorithm, contamination=0.1):
         List of Anomaly model instances
     """
     try:
-        # Get data points for the dataset
-        data_points = DataPoint.query.filter_by(dataset_id=dataset.id).all()
+        # Get the scaled feature matrix for the dataset (cached per data version)
+        features = get_features(dataset.id)
+        series = features['series']
         
-        if not data_points:
+        if len(series['id']) == 0:
             logging.warning(f"No data points found for dataset {dataset.id}")
             return []
         
-        # Prepare features for anomaly detection
-        features = []
-        for dp in data_points:
-            # Use energy consumption as main feature
-            feature_row = [dp.energy_consumption]
-            
-            # Add additional features if available
-            if dp.temperature is not None:
-                feature_row.append(dp.temperature)
-            if dp.humidity is not None:
-                feature_row.append(dp.humidity)
-            if dp.occupancy is not None:
-                feature_row.append(dp.occupancy)
-                
-            features.append(feature_row)
-        
-        # Convert to numpy array and scale
-        X = np.array(features)
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
+        X_scaled = features['X_scaled']
         
-        # Run the selected anomaly detection algorithm
-        anomaly_scores = []
+        # Reuse a stored model for this exact data, or fit and register one
+        detector = get_detector(dataset.id, algorithm, contamination, features)
         
-        if algorithm == 'isolation_forest':
-            model = IsolationForest(contamination=contamination, random_state=42)
-            # -1 for anomalies, 1 for normal data points
-            predictions = model.fit_predict(X_scaled)
-            # Convert to anomaly score (0 for normal, 1 for anomaly)
-            anomaly_labels = [1 if p == -1 else 0 for p in predictions]
-            # Calculate anomaly scores (higher is more anomalous)
-            anomaly_scores = model.decision_function(X_scaled)
-            # Invert scores so that higher = more anomalous
-            anomaly_scores = [1 - (score + 0.5) for score in anomaly_scores]
-            
-        elif algorithm == 'kmeans_clustering':
-            from sklearn.cluster import KMeans
+        with stage('detection', 'score'):
+            anomaly_scores, anomaly_labels = score_detector(detector, X_scaled)
             
-            # Determine optimal number of clusters (simplified approach)
-            n_clusters = max(2, min(10, int(len(X_scaled) / 20)))
-            
-            # Apply K-means clustering
-            kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-            cluster_labels = kmeans.fit_predict(X_scaled)
-            
-            # Calculate distance to cluster center for each point
-            distances = np.zeros(len(X_scaled))
-            for i, point in enumerate(X_scaled):
-                cluster_center = kmeans.cluster_centers_[cluster_labels[i]]
-                distances[i] = np.linalg.norm(point - cluster_center)
-            
-            # Identify anomalies based on distance to cluster center
-            threshold = np.percentile(distances, 100 * (1 - contamination))
-            anomaly_labels = [1 if dist > threshold else 0 for dist in distances]
-            
-            # Normalize distances to get anomaly scores (0-1 range)
-            if max(distances) > min(distances):
-                anomaly_scores = (distances - min(distances)) / (max(distances) - min(distances))
-            else:
-                anomaly_scores = np.zeros(len(distances))
-            
-        elif algorithm == 'auto_encoder':
-            # Import tensorflow only if needed to avoid dependency issues
-            try:
-                import tensorflow as tf
-                from tensorflow.keras.models import Sequential
-                from tensorflow.keras.layers import Dense
-                
-                # Create a simple autoencoder model
-                input_dim = X_scaled.shape[1]
-                model = Sequential([
-                    Dense(input_dim, activation='relu', input_shape=(input_dim,)),
-                    Dense(max(int(input_dim/2), 1), activation='relu'),
-                    Dense(max(int(input_dim/4), 1), activation='relu'),
-                    Dense(max(int(input_dim/2), 1), activation='relu'),
-                    Dense(input_dim, activation='sigmoid')
-                ])
-                
-                model.compile(optimizer='adam', loss='mse')
-                model.fit(X_scaled, X_scaled, epochs=50, batch_size=32, verbose=0)
-                
-                # Calculate reconstruction error
-                reconstructions = model.predict(X_scaled)
-                reconstruction_errors = np.mean(np.power(X_scaled - reconstructions, 2), axis=1)
-                
-                # Normalize to 0-1 range
-                if max(reconstruction_errors) > min(reconstruction_errors):
-                    anomaly_scores = (reconstruction_errors - min(reconstruction_errors)) / (max(reconstruction_errors) - min(reconstruction_errors))
-                else:
-                    anomaly_scores = np.zeros(len(reconstruction_errors))
-                
-                # Determine anomalies based on reconstruction error threshold
-                threshold = np.percentile(anomaly_scores, 100 * (1 - contamination))
-                anomaly_labels = [1 if score > threshold else 0 for score in anomaly_scores]
-                
-            except ImportError:
-                logging.error("TensorFlow not available, using Isolation Forest instead")
-                model = IsolationForest(contamination=contamination, random_state=42)
-                predictions = model.fit_predict(X_scaled)
-                anomaly_labels = [1 if p == -1 else 0 for p in predictions]
-                anomaly_scores = model.decision_function(X_scaled)
-                anomaly_scores = [1 - (score + 0.5) for score in anomaly_scores]
-        
-        # Create Anomaly objects for detected anomalies
-        anomalies = []
-        for i, (data_point, score, is_anomaly) in enumerate(zip(data_points, anomaly_scores, anomaly_labels)):
-            if is_anomaly:
-                anomaly = Anomaly(
-                    data_point_id=data_point.id,
-                    dataset_id=dataset.id,
-                    anomaly_score=float(score),
-                    algorithm=algorithm
-                )
-                anomalies.append(anomaly)
+            # Create Anomaly objects for detected anomalies
+            anomalies = []
+            for data_point_id, score, is_anomaly in zip(series['id'].tolist(), anomaly_scores.tolist(), anomaly_labels.tolist()):
+                if is_anomaly:
+                    anomaly = Anomaly(
+                        data_point_id=data_point_id,
+                        dataset_id=dataset.id,
+                        anomaly_score=float(score),
+                        algorithm=algorithm
+                    )
+                    anomalies.append(anomaly)
         
         return anomalies
     
@@ -151,7 +257,7 @@ def detect_anomalies(dataset, algorithm, contamination=0.1):
         raise
 
 
-def evaluate_model(dataset, algorithm, detected_anomalies=None):
+def evaluate_model(dataset, algorithm, detected_anomalies=None, num_anomalies=None):
     """
     Evaluate the performance of an anomaly detection model.
     This is a simplified version that assumes any detected anomalies are correct.
@@ -160,21 +266,23 @@ def evaluate_model(dataset, algorithm, detected_anomalies=None):
         dataset: Dataset model instance
         algorithm: String indicating which algorithm was used
         detected_anomalies: List of Anomaly objects
+        num_anomalies: Number of anomalies, when they are not passed as objects
         
     Returns:
         ModelEvaluation object
     """
     try:
-        # Get data points and create y_true and y_pred
-        data_points = DataPoint.query.filter_by(dataset_id=dataset.id).all()
+        # Count the data points in the dataset
+        with stage('evaluation', 'load'):
+            total_points = count_points(dataset.id)
         
         # For simplified evaluation without ground truth, we assume:
         # - Precision: All detected anomalies are considered correct (1.0)
         # - Recall: We don't know the true number of anomalies, so N/A
         # - Accuracy: Percentage of data points that are normal (1 - anomaly_rate)
         
-        total_points = len(data_points)
-        num_anomalies = len(detected_anomalies) if detected_anomalies else 0
+        if num_anomalies is None:
+            num_anomalies = len(detected_anomalies) if detected_anomalies else 0
         
         if total_points == 0:
             return ModelEvaluation(
@@ -228,12 +336,41 @@ def generate_recommendations(dataset, anomalies):
         dataset: Dataset model instance
         anomalies: List of Anomaly objects
         
+    Returns:
+        List of Recommendation objects
+    """
+    if not anomalies:
+        return recommendations_for_readings(dataset, None, None)
+    
+    try:
+        # Readings of the anomalous points, as column arrays from the feature cache
+        with stage('recommendations', 'load'):
+            readings = readings_for(get_features(dataset.id)['series'],
+                                    [anomaly.data_point_id for anomaly in anomalies])
+    except Exception as e:
+        logging.error(f"Error reading anomalous points for recommendations: {str(e)}")
+        readings = None
+    return recommendations_for_readings(dataset, readings, anomalies[0].id)
+
+
+def recommendations_for_readings(dataset, readings, anomaly_id):
+    """
+    Generate energy efficiency recommendations from the readings of the
+    anomalous points.
+    
+    Args:
+        dataset: Dataset model instance
+        readings: Dict of column arrays as returned by readings_for, or None
+            if they could not be read
+        anomaly_id: ID of the anomaly the recommendations link to, or None
+            if there are no anomalies
+        
     Returns:
         List of Recommendation objects
     """
     recommendations = []
     
-    if not anomalies:
+    if anomaly_id is None:
         # General recommendation if no anomalies found
         recommendations.append(Recommendation(
             dataset_id=dataset.id,
@@ -243,13 +380,6 @@ def generate_recommendations(dataset, anomalies):
         return recommendations
     
     try:
-        # Get data points for the anomalies to analyze patterns
-        anomaly_data_points = []
-        for anomaly in anomalies:
-            data_point = DataPoint.query.filter_by(id=anomaly.data_point_id).first()
-            if data_point:
-                anomaly_data_points.append((data_point, anomaly))
-        
         # Common recommendations patterns
         recommendation_templates = [
             ("High energy consumption during off-hours detected. Consider adjusting operational schedules or implementing automatic power-down systems.", 0.10),
@@ -260,77 +390,45 @@ def generate_recommendations(dataset, anomalies):
             ("Standby power consumption detected outside of business hours. Consider smart power strips or complete shutdowns.", 0.05)
         ]
         
+        if readings is None:
+            raise ValueError("No readings for the anomalous points")
+        
         # Group anomalies by patterns for more meaningful recommendations
-        if len(anomaly_data_points) >= 3:
-            # Check for time-based patterns (night/weekend usage)
-            night_anomalies = [dp for dp, _ in anomaly_data_points if dp.timestamp.hour >= 20 or dp.timestamp.hour <= 5]
-            weekend_anomalies = [dp for dp, _ in anomaly_data_points if dp.timestamp.weekday() >= 5]  # 5,6 = Sat,Sun
-            
-            # Check for temperature correlation if available
-            temp_related = []
-            if any(dp.temperature is not None for dp, _ in anomaly_data_points):
-                temp_related = [dp for dp, _ in anomaly_data_points if dp.temperature is not None and 
-                               (dp.temperature > 30 or dp.temperature < 10)]
-            
-            # Check for occupancy correlation if available
-            occupancy_related = []
-            if any(dp.occupancy is not None for dp, _ in anomaly_data_points):
-                occupancy_related = [dp for dp, _ in anomaly_data_points if dp.occupancy is not None and 
-                                    dp.occupancy == 0 and dp.energy_consumption > 5]  # Threshold depends on data
-            
-            # Generate specific recommendations based on patterns
-            if night_anomalies:
-                recommendations.append(Recommendation(
-                    dataset_id=dataset.id,
-                    anomaly_id=anomalies[0].id,  # Link to first anomaly
-                    recommendation_text=f"Detected {len(night_anomalies)} instances of high energy usage during night hours. "
-                                       f"Implement timer controls to automatically shut down non-essential systems after hours.",
-                    potential_savings=0.08 * len(night_anomalies) / len(anomaly_data_points)
-                ))
-            
-            if weekend_anomalies:
-                recommendations.append(Recommendation(
-                    dataset_id=dataset.id,
-                    anomaly_id=anomalies[0].id,
-                    recommendation_text=f"Observed {len(weekend_anomalies)} anomalies during weekends. "
-                                       f"Review weekend operations and create specific power-down protocols for non-working days.",
-                    potential_savings=0.10 * len(weekend_anomalies) / len(anomaly_data_points)
-                ))
-            
-            if temp_related:
-                recommendations.append(Recommendation(
-                    dataset_id=dataset.id,
-                    anomaly_id=anomalies[0].id,
-                    recommendation_text=f"Energy consumption anomalies correlate with extreme temperatures in {len(temp_related)} instances. "
-                                       f"Optimize HVAC settings and consider building envelope improvements for better insulation.",
-                    potential_savings=0.12 * len(temp_related) / len(anomaly_data_points)
-                ))
-            
-            if occupancy_related:
+        if len(readings['id']) >= MIN_ANOMALIES_FOR_PATTERNS:
+            with stage('recommendations', 'score'):
+                matches = evaluate_rules(readings)
+            for match in matches:
+                logging.info(f"Recommendation rule {match['name']} matched {match['count']} anomalies "
+                             f"in {match['seconds'] * 1000:.2f} ms")
                 recommendations.append(Recommendation(
                     dataset_id=dataset.id,
-                    anomaly_id=anomalies[0].id,
-                    recommendation_text=f"Detected {len(occupancy_related)} instances of high energy usage during zero occupancy. "
-                                       f"Install occupancy sensors and integrate with building systems to reduce energy waste.",
-                    potential_savings=0.15 * len(occupancy_related) / len(anomaly_data_points)
+                    anomaly_id=anomaly_id,  # Link to first anomaly
+                    recommendation_text=match['text'],
+                    potential_savings=match['potential_savings'],
+                    rule=match['name'],
+                    support_count=match['count'],
+                    rule_seconds=match['seconds']
                 ))
         
         # Add general recommendations if specific patterns don't cover all anomalies
         if not recommendations or len(recommendations) < 3:
             # Select random templates without replacement
-            selected_templates = np.random.choice(recommendation_templates, 
+            selected_templates = np.random.choice(len(recommendation_templates),
                                                  size=min(3 - len(recommendations), len(recommendation_templates)),
                                                  replace=False)
             
-            for template_text, savings_factor in selected_templates:
+            for index in selected_templates:
+                template_text, savings_factor = recommendation_templates[index]
                 # Calculate potential savings based on anomaly count and randomization
                 potential_savings = savings_factor * (0.8 + np.random.random() * 0.4)
                 
                 recommendations.append(Recommendation(
                     dataset_id=dataset.id,
-                    anomaly_id=anomalies[0].id if anomalies else None,
+                    anomaly_id=anomaly_id,
                     recommendation_text=template_text,
-                    potential_savings=potential_savings
+                    potential_savings=potential_savings,
+                    rule='general',
+                    support_count=len(readings['id'])
                 ))
         
         return recommendations
@@ -0,0 +1,91 @@
+"""
+Query helpers for listing anomalies in the web UI.
+
+Counts come from one aggregate query per user rather than one query per
+dataset, and anomaly rows are fetched a page at a time with their data
+points eager-loaded in the same query. Pages are addressed by opaque keyset
+cursors, so later pages cost the same as the first.
+"""
+import json
+import base64
+import binascii
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.orm import joinedload
+from app import db
+from models import Dataset, Anomaly, DetectionRun
+from detection_runs import current_run_ids
+
+
+def encode_cursor(*values):
+    """Encode JSON-serializable keyset values as an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+
+def anomaly_counts(user_id):
+    """
+    Count anomalies per dataset for a user in a single aggregate query.
+
+    Returns:
+        List of (Dataset, anomaly count) tuples for the datasets that have
+        anomalies, ordered by dataset id
+    """
+    counts = (select(Anomaly.dataset_id, func.count(Anomaly.id).label('count'))
+              .join(Dataset, Anomaly.dataset_id == Dataset.id)
+              .join(DetectionRun, Anomaly.run_id == DetectionRun.id)
+              .where(Dataset.user_id == user_id, DetectionRun.status == 'current')
+              .group_by(Anomaly.dataset_id)
+              .subquery())
+    statement = (select(Dataset, counts.c.count)
+                 .join(counts, counts.c.dataset_id == Dataset.id)
+                 .order_by(Dataset.id))
+    return [(dataset, count) for dataset, count in db.session.execute(statement)]
+
+
+def anomaly_page(dataset_id, per_page, cursor=None):
+    """
+    Fetch one page of a dataset's anomalies, highest score first, with each
+    anomaly's data point loaded in the same query.
+
+    Args:
+        dataset_id: ID of the dataset
+        per_page: Maximum number of anomalies to return
+        cursor: Cursor returned with the previous page, or None for the first
+
+    Returns:
+        Tuple of (list of Anomaly objects, cursor for the next page or None)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    query = (Anomaly.query
+             .options(joinedload(Anomaly.data_point))
+             .filter(Anomaly.dataset_id == dataset_id,
+                     Anomaly.run_id.in_(current_run_ids(dataset_id)))
+             .order_by(Anomaly.anomaly_score.desc(), Anomaly.id))
+    if cursor:
+        try:
+            score, anomaly_id = decode_cursor(cursor)
+            score, anomaly_id = float(score), int(anomaly_id)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid cursor: {str(e)}")
+        query = query.filter(or_(Anomaly.anomaly_score < score,
+                                 and_(Anomaly.anomaly_score == score, Anomaly.id > anomaly_id)))
+
+    anomalies = query.limit(per_page + 1).all()
+    if len(anomalies) <= per_page:
+        return anomalies, None
+    last = anomalies[per_page - 1]
+    return anomalies[:per_page], encode_cursor(last.anomaly_score, last.id)
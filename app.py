@@ -5,16 +5,17 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager
+from database import engine_options, configure_engines, RoutingSession, READ_BIND
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG").upper())
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 # create the app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
@@ -22,14 +23,82 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # needed for url_for
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///energy_anomaly.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Database profile (see database.py); auto picks sqlite or postgresql tuning from the URL, basic keeps driver defaults
+app.config["DATABASE_PROFILE"] = os.environ.get("DATABASE_PROFILE", "auto")
+app.config["SQLITE_BUSY_TIMEOUT_MS"] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "15000"))
+app.config["SQLITE_MMAP_SIZE"] = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+app.config["SQLITE_CACHE_SIZE_KB"] = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "65536"))
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", "10"))
+app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+app.config["DB_STATEMENT_TIMEOUT_MS"] = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "60000"))
+app.config["DB_IDLE_TRANSACTION_TIMEOUT_MS"] = int(os.environ.get("DB_IDLE_TRANSACTION_TIMEOUT_MS", "300000"))
+# Optional read replica for the reads of GET requests
+app.config["DATABASE_READ_URL"] = os.environ.get("DATABASE_READ_URL")
+
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+if app.config["DATABASE_READ_URL"]:
+    app.config["SQLALCHEMY_BINDS"] = {
+        READ_BIND: dict(engine_options(app.config), url=app.config["DATABASE_READ_URL"]),
+    }
+
+# Optional columnar store for dataset readings (see timeseries_store.py)
+app.config["SERIES_STORE_ENABLED"] = os.environ.get("SERIES_STORE_ENABLED", "0") == "1"
+app.config["SERIES_STORE_DIR"] = os.environ.get("SERIES_STORE_DIR", os.path.join(app.instance_path, "series"))
+
+# Background detection jobs (see jobs.py); 0 workers runs jobs inline
+app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", "2"))
+app.config["JOB_STALE_SECONDS"] = int(os.environ.get("JOB_STALE_SECONDS", "120"))
+
+# Worker processes for ensemble detection run inline (see ensemble.py); 0 runs detectors in turn
+app.config["ENSEMBLE_WORKERS"] = int(os.environ.get("ENSEMBLE_WORKERS", "3"))
+
+# Windowed detection of very large datasets (see windowed_detection.py)
+app.config["WINDOWED_DETECTION_MIN_ROWS"] = int(os.environ.get("WINDOWED_DETECTION_MIN_ROWS", "1000000"))
+app.config["DETECTION_WINDOW_DAYS"] = int(os.environ.get("DETECTION_WINDOW_DAYS", "30"))
+app.config["DETECTION_WINDOW_OVERLAP_DAYS"] = int(os.environ.get("DETECTION_WINDOW_OVERLAP_DAYS", "7"))
+app.config["DETECTION_FIT_SAMPLE_ROWS"] = int(os.environ.get("DETECTION_FIT_SAMPLE_ROWS", "50000"))
+app.config["DETECTION_SCORE_CHUNK_ROWS"] = int(os.environ.get("DETECTION_SCORE_CHUNK_ROWS", "100000"))
+
+# Cache of preprocessed detection features (see feature_cache.py)
+app.config["FEATURE_CACHE_MAX_BYTES"] = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+app.config["FEATURE_CACHE_DIR"] = os.environ.get("FEATURE_CACHE_DIR")
+
+# Registry of fitted detectors (see model_registry.py)
+app.config["MODEL_REGISTRY_DIR"] = os.environ.get("MODEL_REGISTRY_DIR", os.path.join(app.instance_path, "models"))
+app.config["MODEL_REGISTRY_MAX_BYTES"] = int(os.environ.get("MODEL_REGISTRY_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Incremental scoring of appended readings (see incremental.py)
+app.config["INCREMENTAL_SCORING"] = os.environ.get("INCREMENTAL_SCORING", "1") == "1"
+app.config["INCREMENTAL_REFIT_ROWS"] = int(os.environ.get("INCREMENTAL_REFIT_ROWS", "10000"))
+app.config["INCREMENTAL_DRIFT_THRESHOLD"] = float(os.environ.get("INCREMENTAL_DRIFT_THRESHOLD", "1.0"))
+
+# Chart data downsampling (see downsampling.py)
+app.config["CHART_MAX_POINTS"] = int(os.environ.get("CHART_MAX_POINTS", "2000"))
+app.config["CHART_MAX_POINTS_LIMIT"] = int(os.environ.get("CHART_MAX_POINTS_LIMIT", "20000"))
+
+# Cache of serialized dataset API responses (see response_cache.py)
+app.config["RESPONSE_CACHE_MAX_BYTES"] = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+app.config["RESPONSE_CACHE_DIR"] = os.environ.get("RESPONSE_CACHE_DIR")
+
+# Anomaly listing API pagination and streaming
+app.config["ANOMALY_PAGE_SIZE"] = int(os.environ.get("ANOMALY_PAGE_SIZE", "500"))
+app.config["ANOMALY_PAGE_SIZE_LIMIT"] = int(os.environ.get("ANOMALY_PAGE_SIZE_LIMIT", "5000"))
+app.config["ANOMALY_STREAM_BATCH_SIZE"] = int(os.environ.get("ANOMALY_STREAM_BATCH_SIZE", "1000"))
+app.config["ANOMALY_PANEL_PAGE_SIZE"] = int(os.environ.get("ANOMALY_PANEL_PAGE_SIZE", "50"))
+
+# Streaming dataset exports (see exports.py); rows fetched, serialized and, for Parquet, written per row group at a time
+app.config["EXPORT_BATCH_SIZE"] = int(os.environ.get("EXPORT_BATCH_SIZE", "50000"))
+
+# Metrics endpoint and slow-request log (see metrics.py); 0 disables the log
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") == "1"
+app.config["SLOW_REQUEST_SECONDS"] = float(os.environ.get("SLOW_REQUEST_SECONDS", "0"))
+
 # Initialize the database
 db.init_app(app)
+configure_engines(app, db)
 
 # Setup Flask-Login
 login_manager = LoginManager()
@@ -38,9 +107,24 @@ login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
 with app.app_context():
-    # Import models to ensure tables are created
+    # Import models to register them with the metadata
     import models  # noqa: F401
-    db.create_all()
+
+    # Create the schema and bring existing databases up to date before the
+    # first request rather than at import (see migrations.py)
+    from migrations import init_db
+    app.before_request(init_db)
 
     # Import routes to register them with the app
     import routes  # noqa: F401
+
+    # Collect request, SQL and pipeline metrics
+    import metrics  # noqa: F401
+
+    # Register maintenance commands
+    import query_audit  # noqa: F401
+    import startup  # noqa: F401
+
+    # Commands skip before_request, so they bring the schema up to date themselves
+    from migrations import init_db_before_commands
+    init_db_before_commands()
@@ -0,0 +1,134 @@
+"""
+Compact NumPy autoencoder for reconstruction-error anomaly detection.
+
+A small fully connected network (input -> hidden -> bottleneck -> hidden
+-> input, tanh activations, linear output) is trained to reconstruct the
+scaled features with mini-batch Adam in float32. Training uses a random
+subsample of at most ``TRAIN_ROWS`` rows, holds out part of it for early
+stopping, and keeps the weights with the lowest validation loss, so a fit
+takes well under a second even on large datasets. Points the network
+reconstructs badly are anomalous.
+"""
+import numpy as np
+
+
+# Rows sampled for training, and the share of them held out for early stopping
+TRAIN_ROWS = 20000
+VALIDATION_FRACTION = 0.1
+
+BATCH_SIZE = 256
+MAX_EPOCHS = 50
+LEARNING_RATE = 0.005
+# Epochs without a relative validation improvement of TOLERANCE before stopping
+PATIENCE = 4
+TOLERANCE = 1e-3
+
+# Rows per forward pass when computing reconstruction errors
+ERROR_CHUNK_ROWS = 100000
+
+
+def layer_sizes(input_dim):
+    """Widths of the network's layers, from input to output."""
+    hidden = max(8, 2 * input_dim)
+    bottleneck = max(1, input_dim // 2)
+    return [input_dim, hidden, bottleneck, hidden, input_dim]
+
+
+def _init_weights(sizes, rng):
+    weights = []
+    for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+        limit = np.sqrt(6.0 / (fan_in + fan_out))
+        weights.append([rng.uniform(-limit, limit, size=(fan_in, fan_out)).astype(np.float32),
+                        np.zeros(fan_out, dtype=np.float32)])
+    return weights
+
+
+def _forward(weights, X):
+    """Return the activations of every layer, the input first."""
+    activations = [X]
+    for i, (W, b) in enumerate(weights):
+        z = activations[-1] @ W + b
+        activations.append(z if i == len(weights) - 1 else np.tanh(z))
+    return activations
+
+
+def reconstruction_errors(weights, X):
+    """
+    Mean squared reconstruction error of each row.
+
+    Args:
+        weights: List of [W, b] pairs from fit_autoencoder
+        X: 2-D array of scaled features
+
+    Returns:
+        1-D float64 array of errors
+    """
+    errors = np.empty(len(X))
+    for low in range(0, len(X), ERROR_CHUNK_ROWS):
+        chunk = np.asarray(X[low:low + ERROR_CHUNK_ROWS], dtype=np.float32)
+        errors[low:low + ERROR_CHUNK_ROWS] = np.mean((_forward(weights, chunk)[-1] - chunk) ** 2, axis=1)
+    return errors
+
+
+def fit_autoencoder(X, random_state=42):
+    """
+    Train an autoencoder on scaled features.
+
+    Args:
+        X: 2-D array of scaled features
+        random_state: Seed for sampling, initialization and shuffling
+
+    Returns:
+        List of [W, b] float32 weight pairs, one per layer
+    """
+    rng = np.random.default_rng(random_state)
+    if len(X) > TRAIN_ROWS:
+        X = X[np.sort(rng.choice(len(X), size=TRAIN_ROWS, replace=False))]
+    X = np.asarray(X, dtype=np.float32)
+    order = rng.permutation(len(X))
+    n_validation = int(len(X) * VALIDATION_FRACTION) if len(X) >= 20 else 0
+    X_validation = X[order[:n_validation]] if n_validation else X
+    X_train = X[order[n_validation:]]
+
+    weights = _init_weights(layer_sizes(X.shape[1]), rng)
+    moments = [[np.zeros_like(p) for p in layer] for layer in weights]
+    velocities = [[np.zeros_like(p) for p in layer] for layer in weights]
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-7
+    step = 0
+
+    best_loss, best_weights, stale_epochs = np.inf, None, 0
+    for _ in range(MAX_EPOCHS):
+        shuffled = X_train[rng.permutation(len(X_train))]
+        for low in range(0, len(shuffled), BATCH_SIZE):
+            batch = shuffled[low:low + BATCH_SIZE]
+            activations = _forward(weights, batch)
+
+            # Backpropagate the mean squared error
+            delta = 2.0 * (activations[-1] - batch) / batch.size
+            gradients = []
+            for i in range(len(weights) - 1, -1, -1):
+                gradients.append((activations[i].T @ delta, delta.sum(axis=0)))
+                if i:
+                    delta = (delta @ weights[i][0].T) * (1.0 - activations[i] ** 2)
+            gradients.reverse()
+
+            # Adam update
+            step += 1
+            correction = np.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+            for layer, layer_moments, layer_velocities, layer_gradients in zip(weights, moments, velocities,
+                                                                               gradients):
+                for j, gradient in enumerate(layer_gradients):
+                    layer_moments[j] = beta1 * layer_moments[j] + (1 - beta1) * gradient
+                    layer_velocities[j] = beta2 * layer_velocities[j] + (1 - beta2) * gradient * gradient
+                    layer[j] -= (LEARNING_RATE * correction * layer_moments[j]
+                                 / (np.sqrt(layer_velocities[j]) + epsilon)).astype(np.float32)
+
+        loss = float(np.mean(reconstruction_errors(weights, X_validation)))
+        if loss < best_loss * (1 - TOLERANCE):
+            best_loss, stale_epochs = loss, 0
+            best_weights = [[p.copy() for p in layer] for layer in weights]
+        else:
+            stale_epochs += 1
+            if stale_epochs >= PATIENCE:
+                break
+    return best_weights if best_weights is not None else weights
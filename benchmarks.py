@@ -0,0 +1,378 @@
+"""
+Micro-benchmarks for the hot paths.
+
+    python benchmarks.py
+    python benchmarks.py --sizes 1000,100000 --baseline benchmark_baseline.json
+    python benchmarks.py --save-baseline benchmark_baseline.json
+
+Every run uses a temporary SQLite database and temporary model registry,
+series store and feature cache directories, created before the app is
+imported and deleted afterwards, and seeds the same generated readings
+(fixed seeds) at each of ``--sizes``. For every size it measures:
+
+- ``generate_sample_data``
+- ``ingest_csv`` of the seeded readings as a CSV upload, into a new dataset
+- ``detect_anomalies`` for each single-detector algorithm, from a cold
+  feature cache and model registry, so features are built and the
+  detector is fitted
+- ``generate_recommendations`` for the isolation forest anomalies
+- ``GET /api/dataset/<id>/data`` and ``GET /api/dataset/<id>/anomalies``,
+  built from an empty response cache and served from it
+- a detection job of each ensemble algorithm, from submission to
+  completion, run in ``BENCHMARK_JOB_WORKERS`` real job worker processes
+  from a cold feature cache and model registry; the benchmarks fail if a
+  job fails, or if the workers don't exit within ``WORKER_EXIT_SECONDS``
+  of the last one
+- ``GET /api/dataset/<id>/data`` from an empty response cache while
+  another connection holds an open transaction that has inserted
+  ``CONCURRENT_WRITE_ROWS`` readings, which shows whether reads wait for
+  writers under the database profile (see database.py)
+
+Each benchmark reports the best wall-clock time of ``--repeat`` runs and
+the peak memory allocated (as traced by ``tracemalloc``, which covers
+Python objects and NumPy arrays) during one more run. Results are written
+as JSON. Compared with a baseline from an earlier run, a benchmark
+regresses when its time or peak memory exceeds the baseline's by more than
+``--threshold``, and the command exits with status 1.
+"""
+import io
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import threading
+import tracemalloc
+from functools import partial
+from datetime import date, datetime, timedelta
+import click
+
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# Algorithms benchmarked with detect_anomalies; the ensembles combine these
+DETECTION_ALGORITHMS = ('isolation_forest', 'kmeans_clustering', 'auto_encoder')
+
+# Differences below these are noise, never regressions
+MIN_SECONDS_DELTA = 0.005
+MIN_PEAK_BYTES_DELTA = 1024 * 1024
+
+BENCHMARK_USERNAME = 'benchmark'
+
+# Readings inserted by the open write transaction of the concurrent read benchmark
+CONCURRENT_WRITE_ROWS = 100000
+
+# Job worker processes of the detection job benchmarks, and how long they
+# may take to exit afterwards
+BENCHMARK_JOB_WORKERS = 2
+WORKER_EXIT_SECONDS = 60
+JOB_TIMEOUT_SECONDS = 3600
+
+
+def _measure(run, setup=None, teardown=None, repeat=3):
+    """
+    Time a benchmark and trace its peak memory.
+
+    Args:
+        run: Callable measured, taking the value returned by setup
+        setup: Optional callable run untimed before each run
+        teardown: Optional callable run untimed after each run, taking the
+            value returned by setup
+        repeat: Number of timed runs
+
+    Returns:
+        Dict with the best time in seconds and the peak traced bytes
+    """
+    def once(traced):
+        state = setup() if setup is not None else None
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            run(state)
+            return time.perf_counter() - started, tracemalloc.get_traced_memory()[1] if traced else None
+        finally:
+            if traced:
+                tracemalloc.stop()
+            if teardown is not None:
+                teardown(state)
+
+    seconds = min(once(False)[0] for _ in range(repeat))
+    _, peak_bytes = once(True)
+    return {'seconds': round(seconds, 6), 'peak_bytes': peak_bytes}
+
+
+def _csv_bytes(columns):
+    """Render generated readings as an upload in the ingestion format."""
+    import pandas as pd
+    from ingestion import TIMESTAMP_FORMAT
+
+    frame = pd.DataFrame({name: values for name, values in columns.items()})
+    return frame.to_csv(index=False, date_format=TIMESTAMP_FORMAT).encode()
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=3, progress=print):
+    """
+    Seed a dataset of each size and run every benchmark on it. Expects the
+    app to be configured with a scratch database.
+
+    Args:
+        sizes: Numbers of readings to benchmark
+        repeat: Number of timed runs per benchmark
+        progress: Callable receiving a line per finished benchmark
+
+    Returns:
+        Dict of results keyed by "<benchmark>/<size>", each with the
+        benchmark name, size, seconds and peak_bytes
+    """
+    from sqlalchemy import select, delete, insert
+    from app import app, db
+    from models import User, Dataset, DataPoint, DetectionJob
+    from migrations import init_db
+    from data_generator import generate_sample_arrays, generate_sample_data
+    from ingestion import ingest_csv
+    from timeseries_store import write_series, delete_store
+    from anomaly_detection import detect_anomalies, evaluate_model, generate_recommendations
+    from ensemble import ENSEMBLE_ALGORITHMS
+    from jobs import submit_detection_job, shutdown_workers
+    from detection_runs import create_run, insert_anomalies, store_run_results
+    from model_registry import delete_dataset_models
+    import feature_cache
+    import response_cache
+
+    results = {}
+
+    def record(name, size, measurement):
+        results[f"{name}/{size}"] = dict(benchmark=name, size=size, **measurement)
+        progress(f"{name:40s} {size:>9,d}  {measurement['seconds']:9.4f}s  "
+                 f"{measurement['peak_bytes'] / 1024 / 1024:9.1f} MB")
+
+    with app.app_context():
+        init_db()
+        user = User(username=BENCHMARK_USERNAME, email='benchmark@example.invalid')
+        user.set_password(BENCHMARK_USERNAME)
+        db.session.add(user)
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+        def new_dataset(name):
+            dataset = Dataset(name=name, user_id=user.id, is_sample=True)
+            db.session.add(dataset)
+            db.session.commit()
+            return dataset
+
+        def drop_dataset(dataset):
+            db.session.execute(delete(DataPoint).where(DataPoint.dataset_id == dataset.id))
+            db.session.delete(dataset)
+            db.session.commit()
+            delete_store(dataset.id)
+
+        for size in sizes:
+            # Half-hourly readings, spanning enough days for all of them
+            start = date(2014, 1, 1)
+            end = start + timedelta(days=size // 48 + 1)
+            columns = generate_sample_arrays(size, start, end, seed=0)
+            dataset = new_dataset(f"Benchmark {size}")
+            write_series(dataset.id, columns)
+            db.session.commit()
+
+            record('generate_sample_data', size, _measure(
+                lambda _: generate_sample_data(size, start, end, dataset_id=dataset.id, seed=0), repeat=repeat))
+
+            upload = _csv_bytes(columns)
+
+            def ingest(target):
+                ingest_csv(io.BytesIO(upload), target.id)
+                db.session.commit()
+
+            record('ingest_csv', size, _measure(ingest, setup=lambda: new_dataset(f"Upload {size}"),
+                                                teardown=drop_dataset, repeat=repeat))
+
+            def cold_start():
+                feature_cache.clear()
+                delete_dataset_models(dataset.id)
+
+            for algorithm in DETECTION_ALGORITHMS:
+                record(f"detect_anomalies[{algorithm}]", size, _measure(
+                    lambda _: detect_anomalies(dataset, algorithm, contamination=0.05),
+                    setup=cold_start, repeat=repeat))
+
+            # Store a current run, which the anomalies API reads
+            anomalies = detect_anomalies(dataset, 'isolation_forest', contamination=0.05)
+            run = create_run(dataset.id, 'isolation_forest', contamination=0.05, status='pending')
+            insert_anomalies(run, anomalies)
+            store_run_results(run, evaluate_model(dataset, 'isolation_forest', anomalies),
+                              generate_recommendations(dataset, anomalies))
+            db.session.commit()
+
+            record('generate_recommendations', size, _measure(
+                lambda _: generate_recommendations(dataset, anomalies), repeat=repeat))
+
+            for name, url in (('GET /api/dataset/data', f"/api/dataset/{dataset.id}/data"),
+                              ('GET /api/dataset/anomalies', f"/api/dataset/{dataset.id}/anomalies")):
+                def request(_, url=url):
+                    response = client.get(url)
+                    response.get_data()
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{url}: HTTP {response.status_code}")
+
+                record(name, size, _measure(request, setup=response_cache.clear, repeat=repeat))
+                record(f"{name} (cached)", size, _measure(request, repeat=repeat))
+
+            def hold_write():
+                # Another connection inserts readings and keeps its transaction
+                # open until the read is done, then rolls it back
+                started, release = threading.Event(), threading.Event()
+                first = start + timedelta(days=size // 48 + 2)
+                rows = [{'dataset_id': dataset.id, 'timestamp': first + timedelta(minutes=i), 'energy_consumption': 0.0}
+                        for i in range(CONCURRENT_WRITE_ROWS)]
+
+                def write():
+                    with app.app_context(), db.engine.connect() as conn:
+                        transaction = conn.begin()
+                        conn.execute(insert(DataPoint), rows)
+                        started.set()
+                        release.wait()
+                        transaction.rollback()
+
+                writer = threading.Thread(target=write)
+                writer.start()
+                started.wait()
+                response_cache.clear()
+                return writer, release
+
+            def release_write(state):
+                writer, release = state
+                release.set()
+                writer.join()
+
+            def read_during_write(_, url=f"/api/dataset/{dataset.id}/data"):
+                response = client.get(url)
+                response.get_data()
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} during a write: HTTP {response.status_code}")
+
+            record('GET /api/dataset/data (during write)', size, _measure(
+                read_during_write, setup=hold_write, teardown=release_write, repeat=repeat))
+
+            def run_job(_, algorithm):
+                job_id = submit_detection_job(user.id, dataset.id, algorithm, 0.05).id
+                deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+                while time.monotonic() < deadline:
+                    # A fresh connection each time, so the poll sees the worker's commits
+                    with db.engine.connect() as conn:
+                        status, message = conn.execute(select(DetectionJob.status, DetectionJob.message)
+                                                       .where(DetectionJob.id == job_id)).one()
+                    if status == 'completed':
+                        return
+                    if status == 'failed':
+                        raise RuntimeError(f"Detection job {job_id} ({algorithm}) failed: {message}")
+                    time.sleep(0.05)
+                raise RuntimeError(f"Detection job {job_id} ({algorithm}) took over {JOB_TIMEOUT_SECONDS}s")
+
+            # Jobs run in worker processes, as they do when served
+            app.config['JOB_WORKERS'] = BENCHMARK_JOB_WORKERS
+            try:
+                for algorithm in ENSEMBLE_ALGORITHMS:
+                    record(f"detection job[{algorithm}]", size, _measure(
+                        partial(run_job, algorithm=algorithm), setup=cold_start, repeat=repeat))
+            finally:
+                app.config['JOB_WORKERS'] = 0
+            feature_cache.clear()
+
+        if not shutdown_workers(timeout=WORKER_EXIT_SECONDS):
+            raise RuntimeError(f"Job workers didn't exit within {WORKER_EXIT_SECONDS}s")
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline.
+
+    Args:
+        results: Results as returned by run_benchmarks
+        baseline: Results of an earlier run
+        threshold: Allowed relative increase, e.g. 0.25 for 25%
+
+    Returns:
+        List of (key, metric, baseline value, current value) for each
+        regression
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric, min_delta in (('seconds', MIN_SECONDS_DELTA), ('peak_bytes', MIN_PEAK_BYTES_DELTA)):
+            before, after = previous.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + threshold) and after - before > min_delta:
+                regressions.append((key, metric, before, after))
+    return regressions
+
+
+@click.command()
+@click.option('--sizes', default=','.join(map(str, DEFAULT_SIZES)), show_default=True,
+              help='Comma-separated dataset sizes, in readings.')
+@click.option('--repeat', default=3, show_default=True, help='Timed runs per benchmark; the best is reported.')
+@click.option('--output', default='benchmark_results.json', show_default=True, help='File the results are written to.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Results to compare against.')
+@click.option('--threshold', default=0.25, show_default=True,
+              help='Relative increase in time or peak memory over the baseline counted as a regression.')
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help='Also write the results here as the new baseline.')
+def main(sizes, repeat, output, baseline, threshold, save_baseline):
+    """Benchmark the hot paths on a temporary database."""
+    scratch = tempfile.mkdtemp(prefix='energy-benchmark-')
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(scratch, 'benchmark.db')}",
+        'SERIES_STORE_DIR': os.path.join(scratch, 'series'),
+        'MODEL_REGISTRY_DIR': os.path.join(scratch, 'models'),
+        'FEATURE_CACHE_DIR': os.path.join(scratch, 'features'),
+        'JOB_WORKERS': '0',
+    })
+    try:
+        from app import app
+        logging.getLogger().setLevel(logging.WARNING)
+        results = run_benchmarks([int(size) for size in sizes.split(',')], repeat=repeat)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'series_store_enabled': app.config['SERIES_STORE_ENABLED'],
+        'database_profile': app.config['DATABASE_PROFILE'],
+        'repeat': repeat,
+        'results': results,
+    }
+    for path in filter(None, (output, save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)['results'], threshold)
+        for key, metric, before, after in regressions:
+            print(f"REGRESSION {key} {metric}: {before:,.4f} -> {after:,.4f} (+{(after / before - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {threshold:.0%} against {baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,122 @@
 import numpy as np
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 from models import DataPoint
 import logging
 
 
-def generate_sample_data(num_points, start_date, end_date, include_anomalies=True, anomaly_percentage=0.1, dataset_id=None):
+# Anomaly types injected into the generated series
+ANOMALY_TYPES = ('spike', 'drop', 'shift')
+
+# Shortest interval between generated points
+MIN_INTERVAL_MINUTES = 1
+
+
+def generate_sample_arrays(num_points, start_date, end_date, include_anomalies=True, anomaly_percentage=0.1, seed=None):
+    """
+    Generate synthetic energy consumption data as column arrays.
+
+    All columns are produced at once with vectorized NumPy operations, so
+    the cost is dominated by memory bandwidth rather than per-row Python work.
+
+    Points are spread evenly over the range, e.g. a year of 15-minute
+    readings for 35,040 points, but never less than
+    ``MIN_INTERVAL_MINUTES`` apart; points that would then fall after the
+    end date are dropped, so a range too short for ``num_points`` yields
+    fewer points than requested.
+
+    Args:
+        num_points: Number of data points to generate, at most
+        start_date: Starting date for the data
+        end_date: Ending date for the data
+        include_anomalies: Whether to include anomalies in the data
+        anomaly_percentage: Percentage of data points that should be anomalies (0.0-1.0)
+        seed: Optional seed for the random generator, for reproducible datasets
+
+    Returns:
+        Dict of NumPy arrays keyed by column name (timestamp, energy_consumption,
+        temperature, humidity, occupancy), of equal length up to num_points
+    """
+    # Calculate date range and time intervals
+    date_range = (end_date - start_date).days
+    if date_range <= 0:
+        raise ValueError("End date must be after start date")
+
+    if num_points <= 0:
+        raise ValueError("Number of points must be positive")
+
+    rng = np.random.default_rng(seed)
+
+    # Interval between data points in hours
+    interval_hours = max((date_range * 24) / num_points, MIN_INTERVAL_MINUTES / 60)
+
+    # Generate timestamps, dropping any that run past the end date
+    start = np.datetime64(datetime.combine(start_date, datetime.min.time()), 'us')
+    end = np.datetime64(datetime.combine(end_date, datetime.max.time()), 'us')
+    step = np.timedelta64(int(round(interval_hours * 3600 * 1e6)), 'us')
+    timestamps = start + np.arange(num_points) * step
+    timestamps = timestamps[timestamps <= end]
+    n = len(timestamps)
+
+    # Calendar fields used by the daily, weekly and seasonal patterns
+    days = timestamps.astype('datetime64[D]')
+    hours = ((timestamps - days) // np.timedelta64(1, 'h')).astype(np.int64)
+    weekdays = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday; Monday == 0
+    months = timestamps.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    is_weekend = weekdays >= 5
+
+    # Base consumption with daily cycle, weekend dip and annual cycle
+    base = 10 + 2 * np.sin(hours / 12 * np.pi)
+    weekly_factor = np.where(is_weekend, 0.7, 1.0)
+    month_factor = 1.0 + 0.2 * np.sin((months - 1) / 12 * 2 * np.pi)
+    energy = base * weekly_factor * month_factor + rng.normal(0, 0.5, n)
+
+    # Generate related features
+    temperature = 20 + 10 * np.sin((hours - 12) / 24 * 2 * np.pi) + rng.normal(0, 2, n)
+    humidity = 50 + 10 * np.sin((hours - 6) / 24 * 2 * np.pi) + rng.normal(0, 5, n)
+
+    # Occupancy (business hours on weekdays)
+    business_hours = (hours >= 8) & (hours <= 18) & ~is_weekend
+    occupancy = np.where(business_hours, 15 + rng.normal(0, 5, n), rng.normal(0, 1, n))
+    occupancy = np.maximum(np.trunc(occupancy), 0).astype(np.int64)
+
+    # Add anomalies if requested
+    if include_anomalies and anomaly_percentage and anomaly_percentage > 0:
+        num_anomalies = min(int(n * anomaly_percentage), n)
+        anomaly_indices = rng.choice(n, size=num_anomalies, replace=False)
+        anomaly_types = rng.integers(0, len(ANOMALY_TYPES), size=num_anomalies)
+
+        # Sudden spike in energy consumption (e.g., equipment malfunction)
+        spikes = anomaly_indices[anomaly_types == 0]
+        energy[spikes] *= 2 + rng.random(len(spikes))
+
+        # Sudden drop in energy consumption (e.g., power outage, sensor error)
+        drops = anomaly_indices[anomaly_types == 1]
+        energy[drops] *= 0.1 + rng.random(len(drops)) * 0.3
+
+        # Sustained shift in consumption (e.g., new equipment, operational change).
+        # Overlapping shifts compound, so accumulate them in log space.
+        shifts = anomaly_indices[anomaly_types == 2]
+        shift_lengths = rng.exponential(3, len(shifts)).astype(np.int64)
+        shift_ends = np.minimum(shifts + shift_lengths, n)
+        log_factors = np.log(1.5 + rng.random(len(shifts)) * 0.5)
+        log_delta = np.zeros(n + 1)
+        np.add.at(log_delta, shifts, log_factors)
+        np.add.at(log_delta, shift_ends, -log_factors)
+        energy *= np.exp(np.cumsum(log_delta[:-1]))
+
+    return {
+        'timestamp': timestamps,
+        'energy_consumption': np.maximum(energy, 0),  # Ensure non-negative
+        'temperature': temperature,
+        'humidity': humidity,
+        'occupancy': occupancy,
+    }
+
+
+def generate_sample_data(num_points, start_date, end_date, include_anomalies=True, anomaly_percentage=0.1, dataset_id=None, seed=None):
     """
     Generate synthetic energy consumption data for testing.
-    
+
     Args:
         num_points: Number of data points to generate
         start_date: Starting date for the data
@@ -16,110 +124,32 @@ def generate_sample_data(num_points, start_date, end_date, include_anomalies=Tru
         include_anomalies: Whether to include anomalies in the data
         anomaly_percentage: Percentage of data points that should be anomalies (0.0-1.0)
         dataset_id: ID of the dataset these points belong to
-        
+        seed: Optional seed for the random generator
+
     Returns:
         List of DataPoint objects
     """
     try:
-        # Calculate date range and time intervals
-        date_range = (end_date - start_date).days
-        if date_range <= 0:
-            raise ValueError("End date must be after start date")
-        
-        if num_points <= 0:
-            raise ValueError("Number of points must be positive")
-        
-        # Interval between data points in hours
-        interval_hours = max((date_range * 24) / num_points, 0.5)  # At least 30 minutes between points
-        
-        # Generate timestamps
-        timestamps = []
-        current_time = datetime.combine(start_date, datetime.min.time())
-        
-        for _ in range(num_points):
-            timestamps.append(current_time)
-            current_time += timedelta(hours=interval_hours)
-            if current_time > datetime.combine(end_date, datetime.max.time()):
-                break
-        
-        # Generate base energy consumption with daily and weekly patterns
-        energy_data = []
-        temperatures = []
-        humidity_values = []
-        occupancy_values = []
-        
-        for ts in timestamps:
-            # Base consumption
-            base = 10 + 2 * np.sin(ts.hour / 12 * np.pi)  # Daily cycle
-            
-            # Add weekly pattern (weekends have lower consumption)
-            weekly_factor = 0.7 if ts.weekday() >= 5 else 1.0  # 5,6 = Sat,Sun
-            
-            # Add seasonality (if data spans multiple months)
-            month_factor = 1.0 + 0.2 * np.sin((ts.month - 1) / 12 * 2 * np.pi)  # Annual cycle
-            
-            # Calculate consumption with patterns
-            consumption = base * weekly_factor * month_factor
-            
-            # Add random noise
-            noise = np.random.normal(0, 0.5)
-            consumption += noise
-            
-            # Generate related features
-            temperature = 20 + 10 * np.sin((ts.hour - 12) / 24 * 2 * np.pi) + np.random.normal(0, 2)  # Daily temperature cycle
-            humidity = 50 + 10 * np.sin((ts.hour - 6) / 24 * 2 * np.pi) + np.random.normal(0, 5)  # Daily humidity cycle
-            
-            # Occupancy (business hours on weekdays)
-            if 8 <= ts.hour <= 18 and ts.weekday() < 5:  # Weekday business hours
-                occupancy = max(0, int(15 + np.random.normal(0, 5)))  # Random occupancy around 15
-            else:
-                occupancy = max(0, int(np.random.normal(0, 1)))  # Mostly 0 with occasional 1
-            
-            energy_data.append(consumption)
-            temperatures.append(temperature)
-            humidity_values.append(humidity)
-            occupancy_values.append(occupancy)
-        
-        # Add anomalies if requested
-        if include_anomalies and anomaly_percentage > 0:
-            num_anomalies = int(num_points * anomaly_percentage)
-            anomaly_indices = np.random.choice(range(num_points), size=num_anomalies, replace=False)
-            
-            for idx in anomaly_indices:
-                # Create different types of anomalies
-                anomaly_type = np.random.choice(['spike', 'drop', 'shift'])
-                
-                if anomaly_type == 'spike':
-                    # Sudden spike in energy consumption (e.g., equipment malfunction)
-                    energy_data[idx] *= (2 + np.random.random())
-                
-                elif anomaly_type == 'drop':
-                    # Sudden drop in energy consumption (e.g., power outage, sensor error)
-                    energy_data[idx] *= (0.1 + np.random.random() * 0.3)
-                
-                elif anomaly_type == 'shift':
-                    # Sustained shift in consumption (e.g., new equipment, operational change)
-                    shift_length = min(int(np.random.exponential(3)), num_points - idx)
-                    shift_factor = 1.5 + np.random.random() * 0.5
-                    
-                    for i in range(idx, min(idx + shift_length, num_points)):
-                        energy_data[i] *= shift_factor
-        
-        # Create DataPoint objects
-        data_points = []
-        for i in range(len(timestamps)):
-            data_point = DataPoint(
-                timestamp=timestamps[i],
-                energy_consumption=max(0, energy_data[i]),  # Ensure non-negative
-                temperature=temperatures[i],
-                humidity=humidity_values[i],
-                occupancy=occupancy_values[i],
-                dataset_id=dataset_id
-            )
-            data_points.append(data_point)
-        
-        return data_points
-    
+        columns = generate_sample_arrays(num_points, start_date, end_date,
+                                         include_anomalies=include_anomalies,
+                                         anomaly_percentage=anomaly_percentage,
+                                         seed=seed)
+
+        return [DataPoint(
+            timestamp=ts,
+            energy_consumption=energy,
+            temperature=temperature,
+            humidity=humidity,
+            occupancy=occupancy,
+            dataset_id=dataset_id
+        ) for ts, energy, temperature, humidity, occupancy in zip(
+            columns['timestamp'].astype('datetime64[us]').tolist(),
+            columns['energy_consumption'].tolist(),
+            columns['temperature'].tolist(),
+            columns['humidity'].tolist(),
+            columns['occupancy'].tolist()
+        )]
+
     except Exception as e:
         logging.error(f"Error generating sample data: {str(e)}")
         raise
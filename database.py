@@ -0,0 +1,146 @@
+"""
+Database profiles: engine tuning for SQLite and PostgreSQL, and routing of
+reads to a replica.
+
+``DATABASE_PROFILE`` selects the profile, by default from the database URL:
+
+- ``sqlite``: every connection is switched to WAL journaling, so readers
+  never wait for a writer and a writer waits only for another writer,
+  for up to ``SQLITE_BUSY_TIMEOUT_MS`` rather than failing with "database
+  is locked". ``synchronous=NORMAL`` syncs the WAL at checkpoints instead
+  of at every commit. Reads are served from a memory map of up to
+  ``SQLITE_MMAP_SIZE`` bytes and a page cache of ``SQLITE_CACHE_SIZE_KB``
+  per connection.
+- ``postgresql``: a ``QueuePool`` of ``DB_POOL_SIZE`` connections plus
+  ``DB_MAX_OVERFLOW`` per process, waiting up to ``DB_POOL_TIMEOUT`` for a
+  free one. Statements running longer than ``DB_STATEMENT_TIMEOUT_MS``, and
+  sessions idle in a transaction for longer than
+  ``DB_IDLE_TRANSACTION_TIMEOUT_MS``, are cancelled by the server.
+- ``basic``: driver defaults, with only ``pool_recycle`` and
+  ``pool_pre_ping``.
+
+With ``DATABASE_READ_URL`` set, the ORM reads of GET and HEAD requests go
+to that database, typically a streaming replica of the primary, until the
+request writes. Then it uses the primary for the rest of the request. Core
+statements on ``db.engine`` always use the primary. A replica that lags
+can serve a page loaded right after a write a little stale data.
+"""
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, Select
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+PROFILES = ('auto', 'basic', 'sqlite', 'postgresql')
+
+# Bind key of the read replica in SQLALCHEMY_BINDS
+READ_BIND = 'read'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def profile_for(config):
+    """
+    Profile used for the configured database.
+
+    Raises:
+        ValueError: If DATABASE_PROFILE is unknown or doesn't match the
+            database URL's backend
+    """
+    profile = config['DATABASE_PROFILE']
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DATABASE_PROFILE {profile!r}, expected one of {', '.join(PROFILES)}")
+    backend = make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    if profile == 'auto':
+        return backend if backend in ('sqlite', 'postgresql') else 'basic'
+    if profile != 'basic' and profile != backend:
+        raise ValueError(f"DATABASE_PROFILE {profile!r} doesn't apply to a {backend} database")
+    return profile
+
+
+def engine_options(config):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS of the configured profile.
+
+    Args:
+        config: App config with the database settings
+
+    Returns:
+        Dict of engine options
+    """
+    profile = profile_for(config)
+    if profile == 'sqlite':
+        # Local file connections don't go stale; waiting on locks is left to busy_timeout
+        return {'pool_pre_ping': False}
+    options = {
+        'pool_recycle': 300,
+        'pool_pre_ping': True,
+    }
+    if profile == 'postgresql':
+        server_options = ' '.join(f"-c {name}={value}" for name, value in (
+            ('statement_timeout', config['DB_STATEMENT_TIMEOUT_MS']),
+            ('idle_in_transaction_session_timeout', config['DB_IDLE_TRANSACTION_TIMEOUT_MS'])))
+        options.update({
+            'poolclass': QueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            # Reuse the most recently returned connection, so idle ones can be recycled
+            'pool_use_lifo': True,
+            'connect_args': {'options': server_options, 'application_name': 'energy-anomaly'},
+        })
+    return options
+
+
+def _sqlite_pragmas(config):
+    return (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT_MS']),
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+        # Negative sizes are in KiB rather than pages
+        ('cache_size', -config['SQLITE_CACHE_SIZE_KB']),
+        ('temp_store', 'MEMORY'),
+    )
+
+
+def configure_engines(app, db):
+    """
+    Install the per-connection settings of the profile on the app's engines.
+    Called once, after ``db.init_app``.
+    """
+    if profile_for(app.config) != 'sqlite':
+        return
+    pragmas = _sqlite_pragmas(app.config)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_pragmas)
+
+
+class RoutingSession(Session):
+    """
+    Session sending the ORM reads of GET and HEAD requests to the read
+    replica bind, when one is configured, until the session writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and READ_BIND in self._db.engines:
+            if (isinstance(clause, Select) and clause._for_update_arg is None
+                    and not self.info.get('wrote') and has_request_context()
+                    and request.method in READ_METHODS):
+                return self._db.engines[READ_BIND]
+            if clause is None or not isinstance(clause, Select):
+                # Flushes and DML: this session's later reads must see them
+                self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,261 @@
+"""
+Materialized per-user and per-dataset statistics.
+
+``UserStats``, ``DatasetStats`` and ``AlgorithmStats`` rows hold running
+counters (datasets, readings, anomalies by algorithm, recommendations,
+potential savings and the last detection time), so summary views read one
+row instead of counting the underlying tables. The counters are updated in
+the same transaction as the writes they describe: ``record_points`` from
+``write_series``, ``record_detection`` when anomalies and recommendations
+are stored, ``record_superseded`` when a newer detection run replaces
+them, and mapper events when a dataset is created or deleted.
+
+``repair_stats`` recomputes the counters from the underlying tables; run it
+with ``flask repair-stats`` after bulk changes made outside the app.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import event, select, insert, update, delete, func
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import (User, Dataset, DataPoint, Anomaly, Recommendation, DetectionRun, UserStats, DatasetStats,
+                    AlgorithmStats)
+
+
+STAT_COUNTERS = ('point_count', 'anomaly_count', 'recommendation_count', 'potential_savings')
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+_UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _add(executor, model, key, increments, values=None):
+    """
+    Add to a stats row's counters, creating the row if it doesn't exist.
+    Concurrent first writes of the same row must both count: SQLite and
+    PostgreSQL upsert in one statement, and elsewhere an insert that loses
+    the race falls back to the update.
+    """
+    table = model.__table__
+    values = values or {}
+    changes = {**{name: table.c[name] + delta for name, delta in increments.items()}, **values}
+    dialect = executor.dialect if isinstance(executor, Connection) else executor.get_bind().dialect
+    if dialect.name in _UPSERTS:
+        statement = _UPSERTS[dialect.name](table).values(**key, **increments, **values)
+        executor.execute(statement.on_conflict_do_update(index_elements=list(key), set_=changes))
+        return
+
+    statement = update(table).where(*[table.c[name] == value for name, value in key.items()]).values(**changes)
+    if executor.execute(statement).rowcount:
+        return
+    try:
+        with executor.begin_nested():
+            executor.execute(insert(table).values(**key, **increments, **values))
+    except IntegrityError:
+        # Another transaction created the row since the update
+        executor.execute(statement)
+
+
+def _dataset_owner(dataset_id):
+    return db.session.execute(select(Dataset.user_id).where(Dataset.id == dataset_id)).scalar()
+
+
+def record_points(dataset_id, count):
+    """Count readings added to a dataset. The caller commits."""
+    if not count:
+        return
+    now = datetime.utcnow()
+    user_id = _dataset_owner(dataset_id)
+    _add(db.session, DatasetStats, {'dataset_id': dataset_id},
+         {'point_count': count}, {'user_id': user_id, 'updated_at': now})
+    _add(db.session, UserStats, {'user_id': user_id}, {'point_count': count}, {'updated_at': now})
+
+
+def record_detection(dataset_id, algorithm, anomaly_count, recommendations=()):
+    """
+    Count anomalies and recommendations stored for a dataset. The caller
+    commits.
+
+    Args:
+        dataset_id: ID of the dataset
+        algorithm: Algorithm that found the anomalies
+        anomaly_count: Number of anomalies stored
+        recommendations: Recommendation objects stored with them
+    """
+    now = datetime.utcnow()
+    user_id = _dataset_owner(dataset_id)
+    increments = {
+        'anomaly_count': anomaly_count,
+        'recommendation_count': len(recommendations),
+        'potential_savings': sum(r.potential_savings or 0.0 for r in recommendations)
+    }
+    _add(db.session, DatasetStats, {'dataset_id': dataset_id}, increments,
+         {'user_id': user_id, 'last_detection_at': now, 'updated_at': now})
+    _add(db.session, AlgorithmStats, {'dataset_id': dataset_id, 'algorithm': algorithm},
+         {'anomaly_count': anomaly_count}, {'last_detection_at': now})
+    _add(db.session, UserStats, {'user_id': user_id}, increments,
+         {'last_detection_at': now, 'updated_at': now})
+
+
+def record_superseded(dataset_id, runs):
+    """
+    Remove superseded runs' results from the counters. The caller commits.
+
+    Args:
+        dataset_id: ID of the dataset
+        runs: Rows with algorithm, anomaly_count, recommendation_count and
+            potential_savings of each superseded run
+    """
+    now = datetime.utcnow()
+    user_id = _dataset_owner(dataset_id)
+    decrements = {
+        'anomaly_count': -sum(run.anomaly_count for run in runs),
+        'recommendation_count': -sum(run.recommendation_count for run in runs),
+        'potential_savings': -sum(run.potential_savings or 0.0 for run in runs)
+    }
+    _add(db.session, DatasetStats, {'dataset_id': dataset_id}, decrements, {'user_id': user_id, 'updated_at': now})
+    _add(db.session, UserStats, {'user_id': user_id}, decrements, {'updated_at': now})
+    for run in runs:
+        _add(db.session, AlgorithmStats, {'dataset_id': dataset_id, 'algorithm': run.algorithm},
+             {'anomaly_count': -run.anomaly_count})
+
+
+@event.listens_for(Dataset, 'after_insert')
+def _dataset_created(mapper, connection, target):
+    now = datetime.utcnow()
+    _add(connection, DatasetStats, {'dataset_id': target.id}, {}, {'user_id': target.user_id, 'updated_at': now})
+    _add(connection, UserStats, {'user_id': target.user_id}, {'dataset_count': 1}, {'updated_at': now})
+
+
+@event.listens_for(Dataset, 'before_delete')
+def _dataset_deleted(mapper, connection, target):
+    row = connection.execute(
+        select(*[DatasetStats.__table__.c[name] for name in STAT_COUNTERS])
+        .where(DatasetStats.dataset_id == target.id)
+    ).first()
+    decrements = {name: -(getattr(row, name) or 0) for name in STAT_COUNTERS} if row else {}
+    _add(connection, UserStats, {'user_id': target.user_id},
+         dict(decrements, dataset_count=-1), {'updated_at': datetime.utcnow()})
+    connection.execute(delete(AlgorithmStats).where(AlgorithmStats.dataset_id == target.id))
+    connection.execute(delete(DatasetStats).where(DatasetStats.dataset_id == target.id))
+
+
+def repair_stats(user_id=None):
+    """
+    Recompute statistics from the underlying tables, in a transaction of
+    its own.
+
+    Args:
+        user_id: Only repair this user's statistics; all users if None
+
+    Returns:
+        Number of datasets whose stored counters were wrong or missing
+    """
+    def scoped(statement, dataset_column):
+        if user_id is None:
+            return statement
+        return statement.join(Dataset, Dataset.id == dataset_column).where(Dataset.user_id == user_id)
+
+    with db.engine.begin() as conn:
+        datasets = select(Dataset.id, Dataset.user_id)
+        users = select(User.id)
+        if user_id is not None:
+            datasets = datasets.where(Dataset.user_id == user_id)
+            users = users.where(User.id == user_id)
+        owners = dict(conn.execute(datasets).all())
+
+        points = dict(conn.execute(scoped(
+            select(DataPoint.dataset_id, func.count(DataPoint.id)).group_by(DataPoint.dataset_id),
+            DataPoint.dataset_id)).all())
+        # Only results of current detection runs count
+        current = select(DetectionRun.id).where(DetectionRun.status == 'current')
+        by_algorithm = conn.execute(scoped(
+            select(Anomaly.dataset_id, Anomaly.algorithm, func.count(Anomaly.id), func.max(Anomaly.detected_at))
+            .where(Anomaly.run_id.in_(current))
+            .group_by(Anomaly.dataset_id, Anomaly.algorithm), Anomaly.dataset_id)).all()
+        recommendations = {row[0]: row[1:] for row in conn.execute(scoped(
+            select(Recommendation.dataset_id, func.count(Recommendation.id),
+                   func.coalesce(func.sum(Recommendation.potential_savings), 0.0))
+            .where(Recommendation.run_id.in_(current))
+            .group_by(Recommendation.dataset_id), Recommendation.dataset_id)).all()}
+
+        now = datetime.utcnow()
+        dataset_rows = {dataset_id: {'dataset_id': dataset_id, 'user_id': owner,
+                                     'point_count': points.get(dataset_id, 0), 'anomaly_count': 0,
+                                     'recommendation_count': recommendations.get(dataset_id, (0, 0.0))[0],
+                                     'potential_savings': float(recommendations.get(dataset_id, (0, 0.0))[1]),
+                                     'last_detection_at': None, 'updated_at': now}
+                        for dataset_id, owner in owners.items()}
+        algorithm_rows = []
+        for dataset_id, algorithm, count, detected_at in by_algorithm:
+            if dataset_id not in dataset_rows:
+                continue
+            row = dataset_rows[dataset_id]
+            row['anomaly_count'] += count
+            if detected_at is not None and (row['last_detection_at'] is None or detected_at > row['last_detection_at']):
+                row['last_detection_at'] = detected_at
+            algorithm_rows.append({'dataset_id': dataset_id, 'algorithm': algorithm,
+                                   'anomaly_count': count, 'last_detection_at': detected_at})
+
+        user_rows = {uid: {'user_id': uid, 'dataset_count': 0, 'point_count': 0, 'anomaly_count': 0,
+                           'recommendation_count': 0, 'potential_savings': 0.0,
+                           'last_detection_at': None, 'updated_at': now}
+                     for uid in conn.execute(users).scalars()}
+        for row in dataset_rows.values():
+            totals = user_rows[row['user_id']]
+            totals['dataset_count'] += 1
+            for name in STAT_COUNTERS:
+                totals[name] += row[name]
+            if row['last_detection_at'] is not None and (totals['last_detection_at'] is None
+                                                         or row['last_detection_at'] > totals['last_detection_at']):
+                totals['last_detection_at'] = row['last_detection_at']
+
+        # Count datasets whose stored counters disagree with the recomputed ones
+        stored = {row[0]: tuple(row[1:]) for row in conn.execute(scoped(
+            select(DatasetStats.dataset_id, *[DatasetStats.__table__.c[name] for name in STAT_COUNTERS]),
+            DatasetStats.dataset_id)).all()}
+        repaired = sum(1 for dataset_id, row in dataset_rows.items()
+                       if dataset_id not in stored
+                       or any(abs((value or 0) - row[name]) > 1e-9
+                              for name, value in zip(STAT_COUNTERS, stored[dataset_id])))
+
+        deletes = [delete(AlgorithmStats), delete(DatasetStats), delete(UserStats)]
+        if user_id is not None:
+            deletes = [deletes[0].where(AlgorithmStats.dataset_id.in_(list(dataset_rows))),
+                       deletes[1].where(DatasetStats.user_id == user_id),
+                       deletes[2].where(UserStats.user_id == user_id)]
+        for statement in deletes:
+            conn.execute(statement)
+        for model, rows in ((UserStats, list(user_rows.values())),
+                            (DatasetStats, list(dataset_rows.values())),
+                            (AlgorithmStats, algorithm_rows)):
+            if rows:
+                conn.execute(insert(model), rows)
+
+    if repaired:
+        logging.warning(f"Repaired statistics for {repaired} datasets")
+    return repaired
+
+
+def get_user_stats(user_id):
+    """
+    Get a user's statistics, rebuilding them if the user has none yet.
+
+    Returns:
+        UserStats row
+    """
+    stats = db.session.get(UserStats, user_id)
+    if stats is None:
+        repair_stats(user_id)
+        # The repair wrote to the primary, which a lagging replica may not show yet
+        db.session.info['wrote'] = True
+        stats = db.session.get(UserStats, user_id)
+    return stats
+
+
+@app.cli.command('repair-stats')
+def repair_stats_command():
+    """Recompute the materialized statistics from the underlying tables."""
+    repaired = repair_stats()
+    print(f"Repaired statistics for {repaired} datasets")
@@ -0,0 +1,203 @@
+"""
+Detection runs: each detection's anomalies, evaluation and recommendations
+belong to a ``DetectionRun``.
+
+A dataset has at most one ``current`` run per algorithm. Storing a new run
+marks the previous one ``superseded`` in the same transaction, so reads
+that filter on current runs (``current_run_ids``) switch atomically from
+the old results to the new ones. Superseded runs are then deleted with
+batched bulk deletes by ``prune_runs``, after the job's transaction; ``flask
+prune-runs`` deletes any left behind.
+
+Results are written with bulk INSERTs rather than ORM ``add_all``.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import select, insert, update, delete
+from app import app, db
+from models import DetectionRun, Anomaly, ModelEvaluation, Recommendation
+from dataset_stats import record_detection, record_superseded
+from timeseries_store import bump_anomaly_version
+
+
+# Rows removed per DELETE statement (and transaction) when pruning
+PRUNE_BATCH_SIZE = 10000
+
+_RECOMMENDATION_COLUMNS = ('dataset_id', 'anomaly_id', 'recommendation_text', 'potential_savings',
+                           'rule', 'support_count', 'rule_seconds')
+
+
+def current_run_ids(dataset_id=None):
+    """
+    SELECT of the ids of current runs, for filtering results with
+    ``Model.run_id.in_(...)``.
+    """
+    statement = select(DetectionRun.id).where(DetectionRun.status == 'current')
+    if dataset_id is not None:
+        statement = statement.where(DetectionRun.dataset_id == dataset_id)
+    return statement
+
+
+def create_run(dataset_id, algorithm, contamination=None, job_id=None, status='current'):
+    """
+    Add a new, still empty run. The caller stores its results and commits.
+
+    A run whose results are committed in several transactions is created
+    ``pending``, so its partial results stay hidden until
+    ``store_run_results`` makes it current.
+    """
+    run = DetectionRun(dataset_id=dataset_id, algorithm=algorithm, contamination=contamination,
+                       job_id=job_id, status=status, created_at=datetime.utcnow())
+    db.session.add(run)
+    db.session.flush()
+    return run
+
+
+def insert_anomalies(run, anomalies):
+    """
+    Bulk insert transient Anomaly objects into a run, setting their ids so
+    recommendations can link to them.
+    """
+    if not anomalies:
+        return
+    now = datetime.utcnow()
+    ids = db.session.execute(
+        insert(Anomaly).returning(Anomaly.id, sort_by_parameter_order=True),
+        [{'data_point_id': anomaly.data_point_id, 'dataset_id': anomaly.dataset_id,
+          'anomaly_score': anomaly.anomaly_score, 'algorithm': anomaly.algorithm,
+          'detector_scores': anomaly.detector_scores, 'detected_at': now, 'run_id': run.id}
+         for anomaly in anomalies]
+    ).scalars().all()
+    for anomaly, anomaly_id in zip(anomalies, ids):
+        anomaly.id = anomaly_id
+    run.anomaly_count += len(anomalies)
+
+
+def add_anomaly_rows(run, rows):
+    """Bulk insert anomaly row dicts into a run and count them."""
+    if not rows:
+        return
+    db.session.execute(insert(Anomaly), [dict(row, run_id=run.id) for row in rows])
+    run.anomaly_count += len(rows)
+    record_detection(run.dataset_id, run.algorithm, len(rows))
+    bump_anomaly_version(run.dataset_id)
+
+
+def store_run_results(run, evaluation, recommendations):
+    """
+    Store a run's results and make it the current run for its dataset and
+    algorithm, superseding the previous one. The caller commits.
+
+    Args:
+        run: DetectionRun from create_run, with its anomalies already
+            stored with insert_anomalies
+        evaluation: ModelEvaluation object
+        recommendations: Recommendation objects
+
+    Returns:
+        List of the ids of the runs superseded
+    """
+    evaluation.run_id = run.id
+    db.session.add(evaluation)
+    if recommendations:
+        db.session.execute(insert(Recommendation), [
+            dict({name: getattr(recommendation, name) for name in _RECOMMENDATION_COLUMNS},
+                 run_id=run.id, created_at=datetime.utcnow())
+            for recommendation in recommendations])
+    run.recommendation_count = len(recommendations)
+    run.potential_savings = sum(r.potential_savings or 0.0 for r in recommendations)
+
+    previous = db.session.execute(
+        select(DetectionRun.id, DetectionRun.algorithm, DetectionRun.anomaly_count,
+               DetectionRun.recommendation_count, DetectionRun.potential_savings)
+        .where(DetectionRun.dataset_id == run.dataset_id, DetectionRun.algorithm == run.algorithm,
+               DetectionRun.status == 'current', DetectionRun.id != run.id)
+    ).all()
+    if previous:
+        db.session.execute(update(DetectionRun)
+                           .where(DetectionRun.id.in_([row.id for row in previous]))
+                           .values(status='superseded'))
+        record_superseded(run.dataset_id, previous)
+    run.status = 'current'
+    record_detection(run.dataset_id, run.algorithm, run.anomaly_count, recommendations)
+    bump_anomaly_version(run.dataset_id)
+    return [row.id for row in previous]
+
+
+def discard_run(run_id):
+    """
+    Mark a pending run whose job failed as superseded, in a transaction of
+    its own, so prune_runs deletes the results it committed.
+    """
+    with db.engine.begin() as conn:
+        conn.execute(update(DetectionRun)
+                     .where(DetectionRun.id == run_id, DetectionRun.status == 'pending')
+                     .values(status='superseded'))
+
+
+def discard_job_runs(job_id):
+    """
+    Mark the pending runs of a job whose worker died as superseded, like
+    discard_run.
+
+    Returns:
+        IDs of the discarded runs, for prune_runs
+    """
+    with db.engine.begin() as conn:
+        run_ids = conn.execute(select(DetectionRun.id).where(DetectionRun.job_id == job_id,
+                                                             DetectionRun.status == 'pending')).scalars().all()
+        if run_ids:
+            conn.execute(update(DetectionRun).where(DetectionRun.id.in_(run_ids)).values(status='superseded'))
+    return run_ids
+
+
+def _delete_batches(model, run_ids, batch_size):
+    """Delete a model's rows for the given runs, one batch per transaction."""
+    table = model.__table__
+    deleted = 0
+    while True:
+        batch = select(table.c.id).where(table.c.run_id.in_(run_ids)).limit(batch_size)
+        with db.engine.begin() as conn:
+            count = conn.execute(delete(table).where(table.c.id.in_(batch.scalar_subquery()))).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def prune_runs(run_ids=None, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Delete superseded runs and their results in batches, so no single
+    transaction holds locks on the result tables for long.
+
+    Args:
+        run_ids: Superseded runs to delete; every superseded run if None
+
+    Returns:
+        Number of anomalies deleted
+    """
+    if run_ids is None:
+        with db.engine.connect() as conn:
+            run_ids = conn.execute(select(DetectionRun.id).where(DetectionRun.status == 'superseded')).scalars().all()
+    else:
+        # Never delete a run that is still current
+        with db.engine.connect() as conn:
+            run_ids = conn.execute(select(DetectionRun.id).where(DetectionRun.id.in_(list(run_ids)),
+                                                                 DetectionRun.status == 'superseded')).scalars().all()
+    if not run_ids:
+        return 0
+
+    # Recommendations reference anomalies, so they go first
+    _delete_batches(Recommendation, run_ids, batch_size)
+    deleted = _delete_batches(Anomaly, run_ids, batch_size)
+    _delete_batches(ModelEvaluation, run_ids, batch_size)
+    with db.engine.begin() as conn:
+        conn.execute(delete(DetectionRun).where(DetectionRun.id.in_(run_ids)))
+    logging.info(f"Pruned {len(run_ids)} superseded detection runs ({deleted} anomalies)")
+    return deleted
+
+
+@app.cli.command('prune-runs')
+def prune_runs_command():
+    """Delete superseded detection runs and their results."""
+    deleted = prune_runs()
+    print(f"Deleted {deleted} superseded anomalies")
@@ -0,0 +1,127 @@
+"""
+Downsampling of time series for charting.
+
+Both methods return sorted indices into the input arrays, so every column of
+a series can be sliced with the same selection. The first and last readings
+are always kept.
+
+- ``lttb``: Largest-Triangle-Three-Buckets. Picks one reading per bucket,
+  the one forming the largest triangle with the reading picked from the
+  previous bucket and the mean of the next bucket, which preserves the
+  visual shape of the line.
+- ``minmax``: Keeps the lowest and highest reading of each bucket, so no
+  peak or trough is lost.
+"""
+import numpy as np
+
+
+DOWNSAMPLING_METHODS = ('lttb', 'minmax')
+
+
+def _bucket_edges(n, buckets):
+    """Edges splitting the readings between the first and last into buckets."""
+    return np.linspace(1, n - 1, buckets + 1).astype(np.int64)
+
+
+def lttb(x, y, max_points):
+    """
+    Select readings with Largest-Triangle-Three-Buckets.
+
+    Args:
+        x: 1-D numeric array of positions, ascending
+        y: 1-D numeric array of values
+        max_points: Number of readings to keep (at least 3)
+
+    Returns:
+        Sorted int64 array of selected indices
+    """
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n, dtype=np.int64)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = _bucket_edges(n, max_points - 2)
+    starts, stops = edges[:-1], edges[1:]
+
+    # Mean of every bucket, with the last reading standing in for the bucket
+    # after the final one
+    counts = stops - starts
+    mean_x = np.append(np.add.reduceat(x[:-1], starts) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], starts) / counts, y[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        ax, ay = x[a], y[a]
+        cx, cy = mean_x[i + 1], mean_y[i + 1]
+        areas = np.abs((ax - cx) * (y[start:stop] - ay) - (ax - x[start:stop]) * (cy - ay))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(y, max_points):
+    """
+    Select the minimum and maximum reading of each bucket.
+
+    Args:
+        y: 1-D numeric array of values
+        max_points: Upper bound on the number of readings to keep (at least 4)
+
+    Returns:
+        Sorted int64 array of selected indices
+    """
+    n = len(y)
+    if max_points >= n or max_points < 4:
+        return np.arange(n, dtype=np.int64)
+
+    y = np.asarray(y, dtype=np.float64)
+    starts = _bucket_edges(n, (max_points - 2) // 2)[:-1]
+    inner = y[1:n - 1]
+    offsets = starts - 1
+    counts = np.diff(np.append(offsets, n - 2))
+
+    selected = [np.array([0, n - 1])]
+    for reduce in (np.minimum, np.maximum):
+        # Position of the first reading in each bucket equal to its extreme
+        extremes = np.repeat(reduce.reduceat(inner, offsets), counts)
+        hits = np.flatnonzero(inner == extremes)
+        buckets = np.searchsorted(offsets, hits, side='right') - 1
+        _, first = np.unique(buckets, return_index=True)
+        selected.append(hits[first] + 1)
+    return np.unique(np.concatenate(selected))
+
+
+def downsample(timestamps, values, max_points, keep=None, method='lttb'):
+    """
+    Choose which readings of a series to chart.
+
+    Readings flagged in ``keep`` are always returned, in addition to the
+    readings the method selects from the remaining budget.
+
+    Args:
+        timestamps: 1-D datetime64 array, ascending
+        values: 1-D numeric array of the charted values
+        max_points: Target number of readings
+        keep: Optional boolean array of readings that must be kept
+        method: One of DOWNSAMPLING_METHODS
+
+    Returns:
+        Sorted int64 array of selected indices
+    """
+    if method not in DOWNSAMPLING_METHODS:
+        raise ValueError(f"Unknown downsampling method: {method}")
+
+    n = len(values)
+    kept = np.flatnonzero(keep) if keep is not None else np.empty(0, dtype=np.int64)
+    if n <= max_points:
+        return np.arange(n, dtype=np.int64)
+
+    budget = max(max_points - len(kept), 4)
+    if method == 'lttb':
+        selected = lttb(timestamps.astype('datetime64[us]').astype(np.int64), values, budget)
+    else:
+        selected = minmax(values, budget)
+    return np.union1d(selected, kept)
@@ -0,0 +1,178 @@
+"""
+Ensemble anomaly detection.
+
+An ensemble run fits and scores every detector in ``ENSEMBLE_DETECTORS``
+and combines their scores. Run inline (``JOB_WORKERS`` set to 0), the
+detectors run at once, one per process of a pool of ``ENSEMBLE_WORKERS``.
+The scaled feature matrix is copied once into a shared memory block that
+the workers map read-only, instead of being pickled to each of them, so a
+full comparison takes about as long as the slowest detector. In a job
+worker the detectors run one after another: jobs already run in parallel
+across the job pool, and a pool nested in each job worker would start cold
+and keep the worker from exiting. With ``ENSEMBLE_WORKERS`` set to 0 the
+detectors always run one after another.
+
+Detectors are loaded from or saved to the model registry as in
+single-algorithm detection, but under entries marked as components of the
+ensemble, so incremental scoring never mistakes them for the model of a
+single-algorithm run. Each anomaly keeps the scores of the individual
+detectors.
+"""
+import json
+import time
+import atexit
+import logging
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.stats import rankdata
+from app import app, db
+from models import Anomaly
+from feature_cache import get_features
+from anomaly_detection import get_detector, score_detector
+
+
+# Detectors combined by an ensemble run
+ENSEMBLE_DETECTORS = ('isolation_forest', 'kmeans_clustering', 'auto_encoder')
+
+# Ensemble algorithm names and how each combines the detectors' scores:
+# 'rank' averages each detector's score ranks and flags the top
+# contamination share; 'vote' flags points most detectors flag
+ENSEMBLE_ALGORITHMS = {
+    'ensemble_rank': 'rank',
+    'ensemble_vote': 'vote',
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned like the job workers, so they import the app fresh
+            _executor = ProcessPoolExecutor(max_workers=app.config['ENSEMBLE_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=importlib.import_module,
+                                            initargs=('app',))
+            atexit.register(_executor.shutdown, wait=True, cancel_futures=True)
+        return _executor
+
+
+def _run_detector(dataset_id, ensemble, algorithm, contamination, features):
+    started = time.perf_counter()
+    detector = get_detector(dataset_id, algorithm, contamination, features, component_of=ensemble)
+    scores, labels = score_detector(detector, features['X_scaled'])
+    return algorithm, scores, labels, time.perf_counter() - started
+
+
+def _run_shared_detector(shm_name, shape, dtype, dataset_id, ensemble, algorithm, contamination, metadata):
+    """Run one detector in a worker on the feature matrix in shared memory."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        X_scaled = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        X_scaled.flags.writeable = False
+        with app.app_context():
+            try:
+                return _run_detector(dataset_id, ensemble, algorithm, contamination, dict(metadata, X_scaled=X_scaled))
+            finally:
+                db.session.remove()
+    finally:
+        # The view must be gone before the mapping can be closed
+        X_scaled = None
+        shm.close()
+
+
+def combine_scores(scores, labels, method, contamination):
+    """
+    Combine the scores of several detectors.
+
+    Args:
+        scores: Dict of detector name to score array, higher is more anomalous
+        labels: Dict of detector name to boolean anomaly array
+        method: 'rank' or 'vote'
+        contamination: Expected share of anomalies, used by 'rank'
+
+    Returns:
+        Tuple of (combined scores between 0 and 1; boolean array marking the
+        points classed as anomalies)
+    """
+    if method == 'rank':
+        n = len(next(iter(scores.values())))
+        ranks = np.mean([(rankdata(values) - 1) / max(n - 1, 1) for values in scores.values()], axis=0)
+        num_anomalies = int(round(contamination * n))
+        if num_anomalies == 0:
+            return ranks, np.zeros(n, dtype=bool)
+        threshold = np.partition(ranks, n - num_anomalies)[n - num_anomalies]
+        return ranks, ranks >= threshold
+
+    if method == 'vote':
+        votes = np.mean([values.astype(float) for values in labels.values()], axis=0)
+        return votes, votes > 0.5
+
+    raise ValueError(f"Unknown ensemble method: {method}")
+
+
+def detect_ensemble(dataset, algorithm, contamination=0.1):
+    """
+    Detect anomalies with every detector in parallel and combine the scores.
+
+    Args:
+        dataset: The Dataset model instance
+        algorithm: Ensemble algorithm name, a key of ENSEMBLE_ALGORITHMS
+        contamination: Float between 0 and 0.5 representing expected percentage of anomalies
+
+    Returns:
+        Tuple of (list of Anomaly model instances with their per-detector
+        scores; dict of detector name to wall-clock seconds)
+    """
+    method = ENSEMBLE_ALGORITHMS[algorithm]
+    features = get_features(dataset.id)
+    series = features['series']
+    if len(series['id']) == 0:
+        logging.warning(f"No data points found for dataset {dataset.id}")
+        return [], {}
+
+    results = []
+    # Job workers are pool processes themselves and don't start pools of their own
+    if app.config['ENSEMBLE_WORKERS'] <= 0 or multiprocessing.parent_process() is not None:
+        for detector in ENSEMBLE_DETECTORS:
+            results.append(_run_detector(dataset.id, algorithm, detector, contamination, features))
+    else:
+        X_scaled = np.ascontiguousarray(features['X_scaled'])
+        metadata = {name: features[name] for name in ('version', 'feature_names', 'scaler')}
+        shm = shared_memory.SharedMemory(create=True, size=max(X_scaled.nbytes, 1))
+        try:
+            np.ndarray(X_scaled.shape, dtype=X_scaled.dtype, buffer=shm.buf)[:] = X_scaled
+            futures = [_get_executor().submit(_run_shared_detector, shm.name, X_scaled.shape, X_scaled.dtype.str,
+                                              dataset.id, algorithm, detector, contamination, metadata)
+                       for detector in ENSEMBLE_DETECTORS]
+            results = [future.result() for future in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    scores = {name: detector_scores for name, detector_scores, _, _ in results}
+    labels = {name: detector_labels for name, _, detector_labels, _ in results}
+    seconds = {name: round(elapsed, 3) for name, _, _, elapsed in results}
+    logging.info(f"Ensemble detectors for dataset {dataset.id} took {seconds}")
+
+    combined, is_anomaly = combine_scores(scores, labels, method, contamination)
+    indices = np.flatnonzero(is_anomaly)
+    anomaly_ids = series['id'][indices].tolist()
+    detector_scores = {name: values[indices].tolist() for name, values in scores.items()}
+    anomalies = [
+        Anomaly(
+            data_point_id=data_point_id,
+            dataset_id=dataset.id,
+            anomaly_score=float(score),
+            algorithm=algorithm,
+            detector_scores=json.dumps({name: round(values[i], 6) for name, values in detector_scores.items()})
+        )
+        for i, (data_point_id, score) in enumerate(zip(anomaly_ids, combined[indices].tolist()))
+    ]
+    return anomalies, seconds
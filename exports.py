@@ -0,0 +1,194 @@
+"""
+Streaming export of a dataset's readings with their anomaly flags.
+
+Each reading is exported with the flag and score of one detection run: the
+current run of the requested algorithm, or else the most recent current
+run. Readings are read through a server-side cursor, ``EXPORT_BATCH_SIZE``
+rows at a time, and every batch is serialized and handed to the server
+before the next one is fetched, so an export of any size runs in the memory
+of one batch:
+
+- ``csv`` in the upload format (see ingestion.py) plus ``is_anomaly`` and
+  ``anomaly_score`` columns, so an export can be uploaded again
+- ``ndjson``, one JSON object per reading
+- ``parquet``, one row group per batch; this needs pyarrow, which is
+  imported on first use
+
+The response is sent chunked as the batches are produced. It keeps one
+worker thread and one database connection for its duration, and nothing
+else.
+"""
+import io
+import csv
+import json
+import importlib.util
+from sqlalchemy import select, func, and_, false
+from app import db
+from models import DataPoint, Anomaly, DetectionRun
+
+
+# Format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# Columns of every export, in order
+EXPORT_COLUMNS = ('timestamp', 'energy_consumption', 'temperature', 'humidity', 'occupancy',
+                  'is_anomaly', 'anomaly_score')
+
+# As read by ingest_csv
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def export_run_id(dataset_id, algorithm=None):
+    """
+    Id of the detection run whose anomalies are exported.
+
+    Args:
+        dataset_id: ID of the dataset
+        algorithm: Optional algorithm whose current run is used; by default
+            the most recent current run of any algorithm
+
+    Returns:
+        Run id, or None if the dataset has no current run
+    """
+    statement = select(func.max(DetectionRun.id)).where(DetectionRun.dataset_id == dataset_id,
+                                                        DetectionRun.status == 'current')
+    if algorithm:
+        statement = statement.where(DetectionRun.algorithm == algorithm)
+    return db.session.execute(statement).scalar()
+
+
+def export_statement(dataset_id, run_id):
+    """SELECT of a dataset's readings in time order, outer-joined with a run's anomalies."""
+    joined = and_(Anomaly.data_point_id == DataPoint.id, Anomaly.run_id == run_id) if run_id is not None else false()
+    return (select(DataPoint.timestamp, DataPoint.energy_consumption, DataPoint.temperature,
+                   DataPoint.humidity, DataPoint.occupancy, Anomaly.anomaly_score)
+            .outerjoin(Anomaly, joined)
+            .where(DataPoint.dataset_id == dataset_id)
+            .order_by(DataPoint.timestamp, DataPoint.id))
+
+
+def _batches(statement, batch_size):
+    # Server-side cursor: rows are fetched one batch at a time
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+    yield from result.partitions()
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows((row.timestamp.strftime(TIMESTAMP_FORMAT), row.energy_consumption, row.temperature,
+                          row.humidity, row.occupancy, int(row.anomaly_score is not None), row.anomaly_score)
+                         for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson_chunks(batches):
+    for rows in batches:
+        yield ''.join(json.dumps({
+            'timestamp': row.timestamp.isoformat(),
+            'energy_consumption': row.energy_consumption,
+            'temperature': row.temperature,
+            'humidity': row.humidity,
+            'occupancy': row.occupancy,
+            'is_anomaly': row.anomaly_score is not None,
+            'anomaly_score': row.anomaly_score,
+        }) + '\n' for row in rows)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what a writer produces until it is taken."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_available():
+    """Whether pyarrow, needed for Parquet exports, is installed."""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def parquet_schema():
+    """Arrow schema of Parquet exports."""
+    import pyarrow as pa
+
+    return pa.schema([
+        ('timestamp', pa.timestamp('ms')),
+        ('energy_consumption', pa.float64()),
+        ('temperature', pa.float64()),
+        ('humidity', pa.float64()),
+        ('occupancy', pa.int32()),
+        ('is_anomaly', pa.bool_()),
+        ('anomaly_score', pa.float64()),
+    ])
+
+
+def _parquet_chunks(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    try:
+        for rows in batches:
+            columns = [list(values) for values in zip(*rows)]
+            scores = columns[5]
+            table = pa.Table.from_arrays(
+                [pa.array(values, type=field.type)
+                 for values, field in zip(columns[:5] + [[score is not None for score in scores], scores], schema)],
+                schema=schema)
+            # Each batch becomes one row group, flushed to the client as it is written
+            writer.write_table(table, row_group_size=len(rows))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def export_chunks(dataset_id, export_format, run_id, batch_size):
+    """
+    Generate an export of a dataset as chunks of the response body.
+
+    Args:
+        dataset_id: ID of the dataset
+        export_format: Key of EXPORT_FORMATS
+        run_id: ID of the detection run whose anomalies are flagged, or None
+        batch_size: Rows fetched and serialized at a time
+
+    Returns:
+        Generator of str (csv, ndjson) or bytes (parquet) chunks
+    """
+    batches = _batches(export_statement(dataset_id, run_id), batch_size)
+    if export_format == 'csv':
+        return _csv_chunks(batches)
+    if export_format == 'ndjson':
+        return _ndjson_chunks(batches)
+    return _parquet_chunks(batches)
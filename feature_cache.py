@@ -0,0 +1,230 @@
+"""
+Per-process cache of preprocessed detection features.
+
+Entries are keyed by dataset id and the dataset's content version, which
+``timeseries_store.write_series`` bumps on every write, so a cached entry
+never needs explicit invalidation. Each entry holds the dataset's readings,
+the fixed-width feature matrix scaled by a fitted ``StandardScaler``, and
+the scaler itself. The cache is bounded by ``FEATURE_CACHE_MAX_BYTES`` with
+least-recently-used eviction; if ``FEATURE_CACHE_DIR`` is set, evicted
+entries are spilled there as ``.npy`` files and reloaded memory-mapped.
+"""
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from app import app
+from metrics import stage
+from timeseries_store import read_series, get_data_version, SERIES_COLUMNS
+
+
+# Optional feature columns, used when any reading in the dataset has them
+OPTIONAL_FEATURES = ('temperature', 'humidity', 'occupancy')
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+
+def build_features(series):
+    """
+    Build the feature matrix for anomaly detection from a dataset's readings.
+
+    Energy consumption is always used. Optional columns are included when
+    at least one reading has a value; gaps are filled with the column median.
+
+    Args:
+        series: Dict of column arrays as returned by read_series
+
+    Returns:
+        Tuple of (2-D float64 array with one row per reading, list of the
+        feature column names)
+    """
+    names = ['energy_consumption']
+    features = [np.asarray(series['energy_consumption'], dtype=np.float64)]
+    for name in OPTIONAL_FEATURES:
+        values = np.asarray(series[name], dtype=np.float64)
+        missing = np.isnan(values)
+        if missing.all():
+            continue
+        if missing.any():
+            values = np.where(missing, np.median(values[~missing]), values)
+        names.append(name)
+        features.append(values)
+    return np.column_stack(features), names
+
+
+def transform_features(columns, feature_names, scaler):
+    """
+    Build and scale features for new readings with an existing schema.
+
+    Columns missing from ``columns``, and gaps within them, are filled with
+    the scaler's training mean so they contribute nothing after scaling.
+
+    Args:
+        columns: Dict of column arrays for the new readings
+        feature_names: Feature column names the scaler was fitted on
+        scaler: Fitted StandardScaler
+
+    Returns:
+        2-D float64 array of scaled features
+    """
+    n = len(columns['energy_consumption'])
+    features = []
+    for i, name in enumerate(feature_names):
+        values = columns.get(name)
+        values = np.full(n, np.nan) if values is None else np.asarray(values, dtype=np.float64)
+        features.append(np.where(np.isnan(values), scaler.mean_[i], values))
+    return scaler.transform(np.column_stack(features))
+
+
+def _entry_bytes(entry):
+    return sum(values.nbytes for values in entry['series'].values()) + entry['X_scaled'].nbytes
+
+
+def _spill_path(dataset_id, version):
+    return os.path.join(app.config['FEATURE_CACHE_DIR'], f"{int(dataset_id)}-{int(version)}")
+
+
+def _spill(dataset_id, version, entry):
+    """Write an evicted entry to the spill directory."""
+    path = _spill_path(dataset_id, version)
+    if os.path.isdir(path):
+        return
+    scratch = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(scratch)
+    for name, values in entry['series'].items():
+        np.save(os.path.join(scratch, f"series_{name}.npy"), values)
+    np.save(os.path.join(scratch, 'X_scaled.npy'), entry['X_scaled'])
+    np.save(os.path.join(scratch, 'scaler_mean.npy'), entry['scaler'].mean_)
+    np.save(os.path.join(scratch, 'scaler_var.npy'), entry['scaler'].var_)
+    np.save(os.path.join(scratch, 'scaler_scale.npy'), entry['scaler'].scale_)
+    with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+        json.dump({'feature_names': entry['feature_names'],
+                   'n_samples_seen': int(entry['scaler'].n_samples_seen_)}, f)
+    try:
+        os.rename(scratch, path)
+    except OSError:
+        # Another process spilled the same entry first
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _load_spilled(dataset_id, version):
+    path = _spill_path(dataset_id, version)
+    if not os.path.isdir(path):
+        return None
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    scaler = StandardScaler()
+    scaler.mean_ = np.load(os.path.join(path, 'scaler_mean.npy'))
+    scaler.var_ = np.load(os.path.join(path, 'scaler_var.npy'))
+    scaler.scale_ = np.load(os.path.join(path, 'scaler_scale.npy'))
+    scaler.n_samples_seen_ = meta['n_samples_seen']
+    scaler.n_features_in_ = len(meta['feature_names'])
+    return {
+        'series': {name: np.load(os.path.join(path, f"series_{name}.npy"), mmap_mode='r')
+                   for name in SERIES_COLUMNS},
+        'X_scaled': np.load(os.path.join(path, 'X_scaled.npy'), mmap_mode='r'),
+        'scaler': scaler,
+        'feature_names': meta['feature_names'],
+    }
+
+
+def _drop_stale_spills(dataset_id, version):
+    spill_dir = app.config.get('FEATURE_CACHE_DIR')
+    if not spill_dir or not os.path.isdir(spill_dir):
+        return
+    prefix = f"{int(dataset_id)}-"
+    for name in os.listdir(spill_dir):
+        if name.startswith(prefix) and name != f"{prefix}{int(version)}":
+            shutil.rmtree(os.path.join(spill_dir, name), ignore_errors=True)
+
+
+def _store(dataset_id, version, entry):
+    global _cache_bytes
+    max_bytes = app.config['FEATURE_CACHE_MAX_BYTES']
+    spill = bool(app.config.get('FEATURE_CACHE_DIR'))
+    evicted = []
+
+    with _lock:
+        # Older versions of the same dataset can never be hit again
+        for key in [key for key in _cache if key[0] == dataset_id]:
+            _cache_bytes -= _cache.pop(key)['nbytes']
+
+        entry['nbytes'] = _entry_bytes(entry)
+        if entry['nbytes'] > max_bytes:
+            evicted.append(((dataset_id, version), entry))
+        else:
+            _cache[(dataset_id, version)] = entry
+            _cache_bytes += entry['nbytes']
+            while _cache_bytes > max_bytes:
+                key, old = _cache.popitem(last=False)
+                _cache_bytes -= old['nbytes']
+                evicted.append((key, old))
+
+    if spill:
+        try:
+            _drop_stale_spills(dataset_id, version)
+            for (evicted_id, evicted_version), old in evicted:
+                _spill(evicted_id, evicted_version, old)
+        except OSError as e:
+            logging.warning(f"Error spilling feature cache: {str(e)}")
+
+
+def get_features(dataset_id):
+    """
+    Get the preprocessed features for a dataset, building them on a miss.
+
+    Args:
+        dataset_id: ID of the dataset
+
+    Returns:
+        Dict with series (column arrays in timestamp order), X_scaled,
+        scaler, feature_names and version. Arrays may be shared or
+        memory-mapped and must not be modified.
+    """
+    version = get_data_version(dataset_id)
+    key = (dataset_id, version)
+
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+            return entry
+
+    entry = None
+    if app.config.get('FEATURE_CACHE_DIR'):
+        try:
+            entry = _load_spilled(dataset_id, version)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Error loading spilled features for dataset {dataset_id}: {str(e)}")
+
+    if entry is None:
+        with stage('detection', 'load'):
+            series = {name: np.array(values) for name, values in read_series(dataset_id).items()}
+        if len(series['id']):
+            with stage('detection', 'features'):
+                X, feature_names = build_features(series)
+                scaler = StandardScaler()
+                X_scaled = scaler.fit_transform(X)
+        else:
+            X_scaled, feature_names, scaler = np.empty((0, 1)), ['energy_consumption'], None
+        entry = {'series': series, 'X_scaled': X_scaled, 'scaler': scaler, 'feature_names': feature_names}
+
+    entry['version'] = version
+    if entry['scaler'] is not None:
+        _store(dataset_id, version, entry)
+    return entry
+
+
+def clear():
+    """Empty the in-memory cache."""
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
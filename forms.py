@@ -36,6 +36,7 @@ class GenerateDataForm(FlaskForm):
     end_date = DateField('End Date', validators=[DataRequired()], format='%Y-%m-%d')
     include_anomalies = SelectField('Include Anomalies', choices=[('yes', 'Yes'), ('no', 'No')], default='yes')
     anomaly_percentage = FloatField('Anomaly Percentage', validators=[Optional()])
+    seed = IntegerField('Random Seed', validators=[Optional()])
     submit = SubmitField('Generate Data')
 
 
@@ -61,6 +62,8 @@ class AnomalyDetectionForm(FlaskForm):
         ('isolation_forest', 'Isolation Forest'),
         ('kmeans_clustering', 'K-means Clustering'),
         ('auto_encoder', 'Autoencoder (Deep Learning)'),
+        ('ensemble_rank', 'Ensemble of all detectors (rank average)'),
+        ('ensemble_vote', 'Ensemble of all detectors (majority vote)'),
     ], default='isolation_forest')
     contamination = FloatField('Contamination Factor (0.01-0.5)', validators=[Optional()], default=0.1)
     submit = SubmitField('Detect Anomalies')
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings, read automatically from the working directory.
+
+Set ``GUNICORN_PRELOAD=1`` to load the app in the master process and warm
+it up (see startup.py) before forking the workers, so they share the
+analysis stack and cached detectors copy-on-write and score new readings
+inline without loading them. Detection jobs run in job workers spawned by
+each web worker, which share nothing with the master; they are started,
+and warm themselves up, as soon as the web worker is forked. Preloading is
+off by default because it doesn't combine with ``--reload``.
+"""
+import os
+
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+
+def on_starting(server):
+    # With preload_app the master has already imported the app by now
+    if preload_app:
+        from startup import warm_up
+        warm_up()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # Workers open their own database connections
+        from app import app, db
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+        # Job workers are spawned, not forked, so they warm up on their own
+        from jobs import start_workers
+        start_workers()
@@ -0,0 +1,330 @@
+"""
+Local background jobs for anomaly detection.
+
+Jobs are rows in the ``detection_job`` table and run in a process pool owned
+by each web process, so no external broker is needed. A worker claims a job
+with an atomic status update, which makes it safe for several web processes
+to submit the same job after a restart. Running jobs refresh
+``heartbeat_at``; jobs whose heartbeat goes stale (their process died) are
+requeued by ``recover_jobs``.
+
+A worker that dies (out of memory, a crash in native code) breaks the
+whole pool. The pool is then replaced: jobs that were running in it fail,
+and jobs still waiting for it are requeued in the new pool.
+"""
+import json
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import update, or_, and_
+from app import app, db
+import metrics
+from models import Dataset, DetectionJob
+from detection_runs import create_run, insert_anomalies, store_run_results, discard_run, discard_job_runs, prune_runs
+from timeseries_store import count_points
+
+
+HEARTBEAT_SECONDS = 30
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned workers import the app fresh instead of inheriting the
+            # parent's database connections and threads. Unpickling the
+            # initializer imports startup, which imports app first (rather
+            # than this module) and so keeps the app -> routes -> jobs
+            # import order intact.
+            from startup import warm_up_worker
+            _executor = ProcessPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=warm_up_worker)
+            atexit.register(_executor.shutdown, wait=False, cancel_futures=True)
+        return _executor
+
+
+def start_workers():
+    """
+    Start the worker processes now rather than as the first jobs arrive,
+    so they have warmed up by then.
+    """
+    if app.config['JOB_WORKERS'] <= 0:
+        return
+    executor = _get_executor()
+    # The pool starts a process for each task submitted while none is idle
+    for _ in range(app.config['JOB_WORKERS']):
+        executor.submit(int)
+
+
+def shutdown_workers(timeout=None):
+    """
+    Stop the worker pool once its running jobs finish. Jobs still queued
+    stay queued, for ``recover_jobs`` to pick up.
+
+    Args:
+        timeout: Seconds to wait for the workers to exit; no limit if None
+
+    Returns:
+        Whether every worker exited in time
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return True
+    stopper = threading.Thread(target=executor.shutdown, kwargs={'wait': True, 'cancel_futures': True}, daemon=True)
+    stopper.start()
+    stopper.join(timeout)
+    return not stopper.is_alive()
+
+
+def _discard_executor(executor):
+    """Stop using a broken pool; the next job starts a new one."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_in_worker(job_id):
+    run_detection_job(job_id)
+    # Hand the job's stage timings back to the web process
+    return metrics.drain()
+
+
+def _job_finished(job_id, executor, future):
+    if future.cancelled():
+        # The pool shut down first; the job stays queued
+        return
+    error = future.exception()
+    if error is None:
+        metrics.merge(future.result())
+        return
+
+    logging.error(f"Detection job {job_id} worker crashed: {str(error)}")
+    if isinstance(error, BrokenProcessPool):
+        _discard_executor(executor)
+    with app.app_context():
+        try:
+            # A job still queued never reached a worker and can run again
+            # elsewhere; one that was running takes the blame
+            with db.engine.begin() as conn:
+                failed = conn.execute(
+                    update(DetectionJob)
+                    .where(DetectionJob.id == job_id, DetectionJob.status == 'running')
+                    .values(status='failed', message='The worker process running the job died',
+                            finished_at=datetime.utcnow())
+                ).rowcount
+            if failed:
+                prune_runs(discard_job_runs(job_id))
+            else:
+                _dispatch(job_id)
+        except Exception as e:
+            logging.error(f"Recovering detection job {job_id} failed: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+def _dispatch(job_id):
+    if app.config['JOB_WORKERS'] <= 0:
+        # Run inline, e.g. for development or tests
+        run_detection_job(job_id)
+        return
+    executor = _get_executor()
+    try:
+        future = executor.submit(_run_in_worker, job_id)
+    except BrokenProcessPool:
+        # Broken since the last job finished; retry once in a new pool
+        _discard_executor(executor)
+        executor = _get_executor()
+        future = executor.submit(_run_in_worker, job_id)
+    future.add_done_callback(partial(_job_finished, job_id, executor))
+
+
+def submit_detection_job(user_id, dataset_id, algorithm, contamination):
+    """
+    Queue an anomaly detection run and hand it to the worker pool.
+
+    Returns:
+        The DetectionJob instance
+    """
+    job = DetectionJob(
+        user_id=user_id,
+        dataset_id=dataset_id,
+        algorithm=algorithm,
+        contamination=contamination,
+        status='queued',
+        message='Queued'
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    _dispatch(job.id)
+    return job
+
+
+def recover_jobs():
+    """Requeue jobs left queued, or running with a stale heartbeat, by a previous process."""
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    jobs = DetectionJob.query.filter(or_(
+        DetectionJob.status == 'queued',
+        and_(DetectionJob.status == 'running', DetectionJob.heartbeat_at < stale_before)
+    )).all()
+
+    for job in jobs:
+        if job.status == 'running':
+            job.status = 'queued'
+            job.message = 'Requeued after interruption'
+    db.session.commit()
+
+    for job in jobs:
+        _dispatch(job.id)
+
+    if jobs:
+        logging.info(f"Requeued {len(jobs)} detection job(s)")
+    return len(jobs)
+
+
+def _update_job(job_id, **values):
+    """Update a job row on its own connection, outside the worker's session."""
+    with db.engine.begin() as conn:
+        conn.execute(update(DetectionJob).where(DetectionJob.id == job_id).values(**values))
+
+
+def _heartbeat(job_id, stop):
+    with app.app_context():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                _update_job(job_id, heartbeat_at=datetime.utcnow())
+            except Exception as e:
+                logging.warning(f"Heartbeat failed for detection job {job_id}: {str(e)}")
+
+
+def _report_window(job_id, done, total):
+    _update_job(job_id, progress=0.1 + 0.5 * done / total, message=f'Scored window {done} of {total}')
+
+
+def run_detection_job(job_id):
+    """
+    Run a queued detection job: detect anomalies, evaluate the model,
+    generate recommendations and store the results. Executed in a worker
+    process.
+    """
+    # Imported here so the web process doesn't need the analysis stack
+    # just to queue jobs
+    from anomaly_detection import (detect_anomalies, evaluate_model, generate_recommendations,
+                                   recommendations_for_readings)
+    from ensemble import ENSEMBLE_ALGORITHMS, detect_ensemble
+    from windowed_detection import use_windowed_detection, detect_windowed
+
+    with app.app_context():
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            claimed = conn.execute(
+                update(DetectionJob)
+                .where(DetectionJob.id == job_id, DetectionJob.status == 'queued')
+                .values(status='running', started_at=now, heartbeat_at=now, progress=0.0,
+                        message='Loading data')
+            ).rowcount
+        if not claimed:
+            # Already taken by another worker, or no longer queued
+            return
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(job_id, stop), daemon=True)
+        heartbeat.start()
+
+        pending_run_id = None
+        try:
+            job = db.session.get(DetectionJob, job_id)
+            dataset = db.session.get(Dataset, job.dataset_id)
+            if dataset is None:
+                raise ValueError(f"Dataset {job.dataset_id} no longer exists")
+
+            _update_job(job_id, progress=0.1, message='Detecting anomalies')
+            started = time.perf_counter()
+            detector_seconds = None
+            if use_windowed_detection(count_points(dataset.id)):
+                # Windows are committed as they complete; the run stays
+                # pending, and its anomalies hidden, until the end
+                run = create_run(dataset.id, job.algorithm, job.contamination, job_id, status='pending')
+                db.session.commit()
+                pending_run_id = run.id
+                result = detect_windowed(dataset, job.algorithm, job.contamination, run,
+                                         progress=partial(_report_window, job_id))
+                detection_seconds = time.perf_counter() - started
+
+                _update_job(job_id, progress=0.6, message='Evaluating model')
+                evaluation = evaluate_model(dataset, job.algorithm, num_anomalies=run.anomaly_count)
+
+                _update_job(job_id, progress=0.75, message='Generating recommendations')
+                recommendations = recommendations_for_readings(dataset, result['readings'], result['anomaly_id'])
+            else:
+                if job.algorithm in ENSEMBLE_ALGORITHMS:
+                    anomalies, detector_seconds = detect_ensemble(dataset, job.algorithm, job.contamination)
+                else:
+                    anomalies = detect_anomalies(dataset, job.algorithm, job.contamination)
+                detection_seconds = time.perf_counter() - started
+
+                _update_job(job_id, progress=0.6, message='Evaluating model')
+                evaluation = evaluate_model(dataset, job.algorithm, anomalies)
+
+                _update_job(job_id, progress=0.75, message='Generating recommendations')
+                run = create_run(dataset.id, job.algorithm, job.contamination, job_id)
+                with metrics.stage('detection', 'persist'):
+                    insert_anomalies(run, anomalies)  # Assigns the ids recommendations link to
+                recommendations = generate_recommendations(dataset, anomalies)
+            run.detection_seconds = detection_seconds
+            run.detector_seconds = json.dumps(detector_seconds) if detector_seconds else None
+            with metrics.stage('detection', 'persist'):
+                superseded = store_run_results(run, evaluation, recommendations)
+
+            job.status = 'completed'
+            job.progress = 1.0
+            job.message = f'Detected {run.anomaly_count} anomalies'
+            job.finished_at = datetime.utcnow()
+            db.session.flush()
+            job.result = json.dumps({
+                'anomalies': run.anomaly_count,
+                'run_id': run.id,
+                'evaluation_id': evaluation.id,
+                'recommendations': len(recommendations),
+                'detection_seconds': round(detection_seconds, 3),
+                'detector_seconds': detector_seconds
+            })
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Detection job {job_id} failed: {str(e)}")
+            _update_job(job_id, status='failed', message=str(e), finished_at=datetime.utcnow())
+            superseded = []
+            if pending_run_id is not None:
+                # Drop the windows already committed
+                discard_run(pending_run_id)
+                superseded = [pending_run_id]
+
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        # The new results are already visible; deleting the old ones can't
+        # fail the job
+        try:
+            prune_runs(superseded)
+        except Exception as e:
+            logging.error(f"Pruning runs superseded by job {job_id} failed: {str(e)}")
+        finally:
+            db.session.remove()
+
@@ -0,0 +1,209 @@
+"""
+In-process metrics, exposed in the Prometheus text format at ``/metrics``.
+
+Three kinds of measurement are collected:
+
+- per-route request latency and status counts, from request hooks
+- SQL queries and query time per request, from SQLAlchemy engine events
+- pipeline stage timers (``stage``) around the load, feature build, fit,
+  score and persist steps of detection, evaluation, recommendations and
+  ingestion
+
+Metrics live in the process that records them. Detection jobs run in
+worker processes, so each job hands the metrics it recorded back with its
+result (``drain``), and the web process adds them to its own (``merge``).
+With several gunicorn workers, each serves its own counters.
+
+Setting ``SLOW_REQUEST_SECONDS`` logs requests slower than that, with the
+SQL statements they issued and the time spent in each.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Name -> (type, help, label names, buckets for histograms)
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by route.', ('method', 'route'),
+                                      LATENCY_BUCKETS),
+    'http_requests_total': ('counter', 'Requests by route and response status.', ('method', 'route', 'status'),
+                            None),
+    'http_request_sql_queries': ('histogram', 'SQL queries issued per request.', ('method', 'route'),
+                                 QUERY_COUNT_BUCKETS),
+    'http_request_sql_seconds': ('histogram', 'Time spent in SQL queries per request.', ('method', 'route'),
+                                 LATENCY_BUCKETS),
+    'sql_queries_total': ('counter', 'SQL queries executed.', (), None),
+    'sql_query_seconds_total': ('counter', 'Time spent executing SQL queries.', (), None),
+    'pipeline_stage_seconds': ('histogram', 'Time spent in each stage of the analysis pipelines.',
+                               ('pipeline', 'stage'), STAGE_BUCKETS),
+}
+
+# Characters of each statement kept in the slow-request log
+SLOW_LOG_STATEMENT_CHARS = 500
+
+# Name -> {label values: counter value, or histogram [bucket counts..., sum, count]}
+_values = {name: {} for name in METRICS}
+_lock = threading.Lock()
+
+
+def observe(name, value, labels=()):
+    """Record a value in a histogram."""
+    buckets = METRICS[name][3]
+    with _lock:
+        series = _values[name].get(labels)
+        if series is None:
+            series = _values[name][labels] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+
+def increment(name, amount=1, labels=()):
+    """Add to a counter."""
+    with _lock:
+        _values[name][labels] = _values[name].get(labels, 0) + amount
+
+
+@contextmanager
+def stage(pipeline, name):
+    """Time a block as one stage of an analysis pipeline."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('pipeline_stage_seconds', time.perf_counter() - started, (pipeline, name))
+
+
+def drain():
+    """Return the metrics recorded so far and reset them, e.g. to send them to another process."""
+    global _values
+    with _lock:
+        values, _values = _values, {name: {} for name in METRICS}
+    return values
+
+
+def merge(values):
+    """Add metrics returned by drain in another process to this process's."""
+    with _lock:
+        for name, series in values.items():
+            for labels, value in series.items():
+                current = _values[name].get(labels)
+                if current is None:
+                    _values[name][labels] = list(value) if isinstance(value, list) else value
+                elif isinstance(current, list):
+                    _values[name][labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    _values[name][labels] = current + value
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {name: {labels: list(value) if isinstance(value, list) else value
+                           for labels, value in series.items()}
+                    for name, series in _values.items()}
+
+    lines = []
+    for name, (kind, description, label_names, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(snapshot[name].items()):
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(label_names, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(label_names, labels, ('le', bound))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(label_names, labels, ('le', '+Inf'))} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(label_names, labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(label_names, labels)} {value[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    increment('sql_queries_total')
+    increment('sql_query_seconds_total', seconds)
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+        if g.sql_statements is not None:
+            g.sql_statements.append((seconds, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(context):
+    conn = context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+@app.before_request
+def _request_started():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.sql_statements = [] if app.config['SLOW_REQUEST_SECONDS'] > 0 else None
+
+
+@app.after_request
+def _count_response(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _request_finished(error=None):
+    # Runs once the response has been sent, so streamed responses count in full
+    if 'request_started' not in g:
+        return
+    seconds = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (request.method, route)
+    status = g.get('response_status', 500)
+    observe('http_request_duration_seconds', seconds, labels)
+    increment('http_requests_total', labels=labels + (str(status),))
+    observe('http_request_sql_queries', g.sql_queries, labels)
+    observe('http_request_sql_seconds', g.sql_seconds, labels)
+
+    threshold = app.config['SLOW_REQUEST_SECONDS']
+    if threshold > 0 and seconds >= threshold:
+        queries = '\n'.join(f"  {query_seconds * 1000:8.2f} ms  {' '.join(statement.split())[:SLOW_LOG_STATEMENT_CHARS]}"
+                            for query_seconds, statement in g.sql_statements)
+        logging.warning(f"Slow request {request.method} {request.full_path.rstrip('?')} -> {status} "
+                        f"took {seconds:.3f}s, {g.sql_queries} queries in {g.sql_seconds:.3f}s\n{queries}")
+
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrape endpoint
+    if not app.config['METRICS_ENABLED']:
+        return Response('Not Found', status=404)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
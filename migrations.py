@@ -0,0 +1,199 @@
+"""
+Versioned schema migrations.
+
+``db.create_all`` creates missing tables but never alters existing ones, so
+columns and indexes added to models after a database was created are
+applied here. Each migration has a version number and is recorded in the
+``schema_migration`` table once applied. Migrations check for what they
+create, so they are safe on databases where ``create_all`` already built
+the current schema, and they run on both SQLite and PostgreSQL.
+
+``init_db`` creates the tables and applies the migrations. It runs once
+per process before the first request, once in the gunicorn master when
+the app is preloaded (see gunicorn.conf.py), before every ``flask``
+command of the app, and from ``flask migrate-db``, which also lists the
+applied versions; importing the app never touches the schema.
+"""
+import logging
+import functools
+import threading
+from datetime import datetime
+from sqlalchemy import inspect, insert, select, update, union, func
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import (DataPoint, Dataset, Anomaly, ModelEvaluation, Recommendation, DetectionJob, FittedModel,
+                    DetectionRun, DatasetVersion, SchemaMigration)
+
+
+def _add_column(conn, model, name):
+    """Add a model column to its table if the table doesn't have it yet."""
+    table = model.__table__
+    if name in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    column_type = table.c[name].type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(name)} {column_type}")
+
+
+def _create_index(conn, model, name):
+    """Create an index declared on a model if it doesn't exist yet."""
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    index.create(conn, checkfirst=True)
+
+
+def _add_recommendation_rule_columns(conn):
+    for name in ('rule', 'support_count', 'rule_seconds'):
+        _add_column(conn, Recommendation, name)
+
+
+def _add_query_indexes(conn):
+    for model, name in ((DataPoint, 'ix_data_point_dataset_timestamp'),
+                        (Dataset, 'ix_dataset_user_created'),
+                        (Anomaly, 'ix_anomaly_dataset_score'),
+                        (Anomaly, 'ix_anomaly_dataset_data_point'),
+                        (Anomaly, 'ix_anomaly_data_point'),
+                        (ModelEvaluation, 'ix_model_evaluation_dataset'),
+                        (Recommendation, 'ix_recommendation_dataset'),
+                        (Recommendation, 'ix_recommendation_anomaly'),
+                        (DetectionJob, 'ix_detection_job_user_status'),
+                        (DetectionJob, 'ix_detection_job_status'),
+                        (FittedModel, 'ix_fitted_model_lookup')):
+        _create_index(conn, model, name)
+
+
+def _add_detection_runs(conn):
+    DetectionRun.__table__.create(conn, checkfirst=True)
+    for model, index in ((Anomaly, 'ix_anomaly_run'),
+                         (ModelEvaluation, 'ix_model_evaluation_run'),
+                         (Recommendation, 'ix_recommendation_run')):
+        _add_column(conn, model, 'run_id')
+        _create_index(conn, model, index)
+
+    # Existing results become one current run per dataset and algorithm
+    anomaly, evaluation, recommendation, run = (Anomaly.__table__, ModelEvaluation.__table__,
+                                                Recommendation.__table__, DetectionRun.__table__)
+    pairs = union(select(anomaly.c.dataset_id, anomaly.c.algorithm).where(anomaly.c.run_id.is_(None)),
+                  select(evaluation.c.dataset_id, evaluation.c.algorithm).where(evaluation.c.run_id.is_(None)))
+    now = datetime.utcnow()
+    rows = [{'dataset_id': dataset_id, 'algorithm': algorithm, 'status': 'current', 'created_at': now}
+            for dataset_id, algorithm in conn.execute(pairs)]
+    if not rows:
+        return
+    conn.execute(insert(run), rows)
+
+    for table in (anomaly, evaluation):
+        conn.execute(update(table).where(table.c.run_id.is_(None)).values(run_id=(
+            select(func.min(run.c.id))
+            .where(run.c.dataset_id == table.c.dataset_id, run.c.algorithm == table.c.algorithm)
+            .scalar_subquery())))
+    # Recommendations follow the anomaly they link to, or any run of their dataset
+    conn.execute(update(recommendation).where(recommendation.c.run_id.is_(None)).values(run_id=(
+        select(anomaly.c.run_id).where(anomaly.c.id == recommendation.c.anomaly_id).scalar_subquery())))
+    conn.execute(update(recommendation).where(recommendation.c.run_id.is_(None)).values(run_id=(
+        select(func.min(run.c.id)).where(run.c.dataset_id == recommendation.c.dataset_id).scalar_subquery())))
+
+    conn.execute(update(run).values(
+        anomaly_count=select(func.count(anomaly.c.id)).where(anomaly.c.run_id == run.c.id).scalar_subquery(),
+        recommendation_count=(select(func.count(recommendation.c.id))
+                              .where(recommendation.c.run_id == run.c.id).scalar_subquery()),
+        potential_savings=(select(func.coalesce(func.sum(recommendation.c.potential_savings), 0.0))
+                           .where(recommendation.c.run_id == run.c.id).scalar_subquery())))
+
+
+def _add_ensemble_columns(conn):
+    _add_column(conn, Anomaly, 'detector_scores')
+    for name in ('detection_seconds', 'detector_seconds'):
+        _add_column(conn, DetectionRun, name)
+
+
+def _add_anomaly_version(conn):
+    _add_column(conn, DatasetVersion, 'anomaly_version')
+
+
+def _add_export_index(conn):
+    _create_index(conn, Anomaly, 'ix_anomaly_data_point_run')
+
+
+# (version, description, function taking a connection), in order
+MIGRATIONS = [
+    (1, 'Add rule, support_count and rule_seconds to recommendation', _add_recommendation_rule_columns),
+    (2, 'Add indexes for dataset-scoped reads', _add_query_indexes),
+    (3, 'Add detection runs and assign existing results to them', _add_detection_runs),
+    (4, 'Add per-detector ensemble scores and detection timings', _add_ensemble_columns),
+    (5, 'Add anomaly versions for cached API responses', _add_anomaly_version),
+    (6, "Add an index joining readings with a run's anomalies", _add_export_index),
+]
+
+
+def run_migrations():
+    """
+    Apply pending migrations, each in its own transaction.
+
+    Returns:
+        List of the versions applied
+    """
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    with db.engine.connect() as conn:
+        applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+
+    newly_applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with db.engine.begin() as conn:
+                migrate(conn)
+                conn.execute(insert(SchemaMigration).values(version=version, description=description,
+                                                            applied_at=datetime.utcnow()))
+        except IntegrityError:
+            # Another process applied it concurrently
+            continue
+        logging.info(f"Applied schema migration {version}: {description}")
+        newly_applied.append(version)
+    return newly_applied
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def init_db():
+    """
+    Create missing tables and apply pending migrations, once per process.
+    Processes forked after it ran (a preloaded gunicorn master's workers)
+    skip it.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            db.create_all()
+            run_migrations()
+            _schema_ready = True
+
+
+def _with_schema(callback):
+    @functools.wraps(callback)
+    def run(*args, **kwargs):
+        with app.app_context():
+            init_db()
+        return callback(*args, **kwargs)
+    return run
+
+
+def init_db_before_commands():
+    """
+    Run ``init_db`` before each of the app's ``flask`` commands, which don't
+    go through ``before_request``. Called once all commands are registered.
+    """
+    for command in app.cli.commands.values():
+        command.callback = _with_schema(command.callback)
+
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create missing tables, apply pending schema migrations and list the applied versions."""
+    init_db()
+    for migration in SchemaMigration.query.order_by(SchemaMigration.version):
+        print(f"{migration.version:4d}  {migration.applied_at:%Y-%m-%d %H:%M:%S}  {migration.description}")
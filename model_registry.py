@@ -0,0 +1,262 @@
+"""
+Registry of fitted anomaly detectors.
+
+Each entry is a pickled detector plus the scaler it was trained with, saved
+under ``MODEL_REGISTRY_DIR`` and described by a ``FittedModel`` row keyed
+by dataset, algorithm and a hash of the fit parameters. The row records the
+training size, fit time, feature schema, data version and a SHA-256 of the
+file, which is checked before unpickling. When the registry grows past
+``MODEL_REGISTRY_MAX_BYTES`` the least recently used entries are deleted.
+
+Registry rows are written on their own connection, independent of the
+caller's transaction, since they describe files that already exist on disk.
+"""
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select, insert, update, delete, func
+from app import app, db
+from models import FittedModel
+
+
+# Loaded detectors kept in memory per process, by registry row id
+LOADED_CACHE_SIZE = 8
+
+_loaded = OrderedDict()
+_lock = threading.Lock()
+
+
+def params_key(params):
+    """Stable hash of a parameter dict."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _registry_dir():
+    path = app.config['MODEL_REGISTRY_DIR']
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_model(dataset_id, algorithm, params, data_version=None):
+    """
+    Find the newest registered model for a dataset, algorithm and parameters.
+
+    Args:
+        dataset_id: ID of the dataset
+        algorithm: Algorithm name
+        params: Dict of fit parameters
+        data_version: If given, only match models trained on this data version
+
+    Returns:
+        FittedModel row or None
+    """
+    query = FittedModel.query.filter_by(dataset_id=dataset_id, algorithm=algorithm,
+                                        params_key=params_key(params))
+    if data_version is not None:
+        query = query.filter_by(data_version=data_version)
+    return query.order_by(FittedModel.created_at.desc(), FittedModel.id.desc()).first()
+
+
+def find_run_model(run):
+    """
+    Find the newest registered model of a single-algorithm detection run:
+    fitted on the whole dataset or on its latest window, with the run's
+    algorithm and contamination. Components of ensembles are skipped, so
+    ensemble runs have no model.
+
+    Args:
+        run: DetectionRun row
+
+    Returns:
+        FittedModel row or None
+    """
+    records = (FittedModel.query
+               .filter_by(dataset_id=run.dataset_id, algorithm=run.algorithm)
+               .order_by(FittedModel.created_at.desc(), FittedModel.id.desc())
+               .all())
+    for record in records:
+        params = json.loads(record.params)
+        if 'component_of' in params:
+            continue
+        # Runs migrated from before detection runs existed have no contamination
+        if run.contamination is None or params.get('contamination') == run.contamination:
+            return record
+    return None
+
+
+def _load_file(record):
+    """Unpickle a registered detector into the in-memory cache; None if the file is bad."""
+    path = os.path.join(_registry_dir(), record.path)
+    try:
+        if _file_sha256(path) != record.sha256:
+            raise ValueError("checksum mismatch")
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception as e:
+        logging.error(f"Discarding registered model {record.id}: {str(e)}")
+        _delete_entries([record.id])
+        return None
+
+    with _lock:
+        _loaded[record.id] = cached
+        while len(_loaded) > LOADED_CACHE_SIZE:
+            _loaded.popitem(last=False)
+    return cached
+
+
+def preload_models(limit=LOADED_CACHE_SIZE):
+    """
+    Load the most recently used detectors into the in-memory cache without
+    marking them used, e.g. before forking workers that then share them.
+
+    Args:
+        limit: Maximum number of detectors to load
+
+    Returns:
+        Number of detectors loaded
+    """
+    records = (FittedModel.query
+               .order_by(FittedModel.last_used_at.desc(), FittedModel.id.desc())
+               .limit(limit)
+               .all())
+    # Least recent first, so the cache keeps the registry's LRU order
+    return sum(1 for record in reversed(records) if _load_file(record) is not None)
+
+
+def load_model(record):
+    """
+    Load a registered detector after verifying its file checksum.
+
+    Args:
+        record: FittedModel row
+
+    Returns:
+        Tuple of (detector dict, fitted scaler), or (None, None) if the
+        file is missing or corrupt, in which case the entry is removed
+    """
+    with _lock:
+        cached = _loaded.get(record.id)
+        if cached is not None:
+            _loaded.move_to_end(record.id)
+
+    if cached is None:
+        cached = _load_file(record)
+        if cached is None:
+            return None, None
+
+    with db.engine.begin() as conn:
+        conn.execute(update(FittedModel).where(FittedModel.id == record.id)
+                     .values(last_used_at=datetime.utcnow()))
+    return cached['detector'], cached['scaler']
+
+
+def save_model(dataset_id, algorithm, params, detector, scaler, data_version, training_size,
+               fit_seconds, feature_names):
+    """
+    Register a fitted detector, replacing older entries with the same
+    dataset, algorithm and parameters.
+
+    Returns:
+        ID of the new FittedModel row, or None if the detector could not be
+        saved
+    """
+    key = params_key(params)
+    name = f"{int(dataset_id)}-{algorithm}-{key[:12]}-{uuid.uuid4().hex[:8]}.pkl"
+    path = os.path.join(_registry_dir(), name)
+
+    try:
+        with open(path, 'wb') as f:
+            pickle.dump({'detector': detector, 'scaler': scaler}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        # A detector that can't be pickled is just refitted next time
+        logging.warning(f"Could not register {algorithm} model for dataset {dataset_id}: {str(e)}")
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    with db.engine.begin() as conn:
+        previous = conn.execute(
+            select(FittedModel.id).where(FittedModel.dataset_id == dataset_id,
+                                         FittedModel.algorithm == algorithm,
+                                         FittedModel.params_key == key)
+        ).scalars().all()
+        now = datetime.utcnow()
+        model_id = conn.execute(insert(FittedModel).values(
+            dataset_id=dataset_id,
+            algorithm=algorithm,
+            params_key=key,
+            params=json.dumps(params, sort_keys=True),
+            data_version=data_version,
+            training_size=training_size,
+            fit_seconds=fit_seconds,
+            feature_schema=json.dumps(list(feature_names)),
+            path=name,
+            sha256=_file_sha256(path),
+            size_bytes=os.path.getsize(path),
+            created_at=now,
+            last_used_at=now
+        )).inserted_primary_key[0]
+
+    _delete_entries(previous)
+    enforce_size_limit()
+    return model_id
+
+
+def _delete_entries(model_ids):
+    if not model_ids:
+        return
+    with db.engine.begin() as conn:
+        paths = conn.execute(select(FittedModel.path).where(FittedModel.id.in_(model_ids))).scalars().all()
+        conn.execute(delete(FittedModel).where(FittedModel.id.in_(model_ids)))
+    with _lock:
+        for model_id in model_ids:
+            _loaded.pop(model_id, None)
+    for name in paths:
+        try:
+            os.remove(os.path.join(_registry_dir(), name))
+        except OSError:
+            pass
+
+
+def enforce_size_limit(max_bytes=None):
+    """Delete least recently used entries until the registry fits its size budget."""
+    max_bytes = app.config['MODEL_REGISTRY_MAX_BYTES'] if max_bytes is None else max_bytes
+    with db.engine.connect() as conn:
+        total = conn.execute(select(func.coalesce(func.sum(FittedModel.size_bytes), 0))).scalar()
+        if total <= max_bytes:
+            return 0
+        rows = conn.execute(
+            select(FittedModel.id, FittedModel.size_bytes).order_by(FittedModel.last_used_at, FittedModel.id)
+        ).all()
+
+    evicted = []
+    for model_id, size in rows:
+        if total <= max_bytes:
+            break
+        evicted.append(model_id)
+        total -= size
+    _delete_entries(evicted)
+    return len(evicted)
+
+
+def delete_dataset_models(dataset_id):
+    """Remove every registered model for a dataset."""
+    with db.engine.connect() as conn:
+        model_ids = conn.execute(
+            select(FittedModel.id).where(FittedModel.dataset_id == dataset_id)
+        ).scalars().all()
+    _delete_entries(model_ids)
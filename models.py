@@ -1,5 +1,6 @@
 from app import db, login_manager
 from flask_login import UserMixin
+import json
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -41,6 +42,8 @@ class Dataset(db.Model):
     data_points = db.relationship('DataPoint', backref='dataset', lazy=True, cascade="all, delete-orphan")
     anomalies = db.relationship('Anomaly', backref='dataset', lazy=True, cascade="all, delete-orphan")
     
+    __table_args__ = (db.Index('ix_dataset_user_created', 'user_id', 'created_at'),)
+    
     def __repr__(self):
         return f'<Dataset {self.name}>'
 
@@ -54,10 +57,46 @@ class DataPoint(db.Model):
     occupancy = db.Column(db.Integer, nullable=True)
     dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), nullable=False)
     
+    # Serves time-window reads of a dataset
+    __table_args__ = (db.Index('ix_data_point_dataset_timestamp', 'dataset_id', 'timestamp'),)
+    
     def __repr__(self):
         return f'<DataPoint {self.timestamp}>'
 
 
+class DatasetVersion(db.Model):
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), primary_key=True)
+    data_version = db.Column(db.Integer, nullable=False, default=0)  # Bumped on every write of readings
+    anomaly_version = db.Column(db.Integer, default=0)  # Bumped whenever the current anomalies change
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DatasetVersion {self.dataset_id} v{self.data_version}>'
+
+
+class DetectionRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), nullable=False)
+    algorithm = db.Column(db.String(50), nullable=False)
+    contamination = db.Column(db.Float, nullable=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('detection_job.id'), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='current')  # pending, current, superseded
+    anomaly_count = db.Column(db.Integer, nullable=False, default=0)
+    recommendation_count = db.Column(db.Integer, nullable=False, default=0)
+    potential_savings = db.Column(db.Float, nullable=False, default=0.0)
+    detection_seconds = db.Column(db.Float, nullable=True)  # Wall-clock time of the detection step
+    detector_seconds = db.Column(db.Text, nullable=True)  # JSON per-detector wall-clock times of an ensemble
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationship
+    dataset = db.relationship('Dataset', backref=db.backref('detection_runs', cascade="all, delete-orphan"))
+    
+    __table_args__ = (db.Index('ix_detection_run_lookup', 'dataset_id', 'algorithm', 'status'),)
+    
+    def __repr__(self):
+        return f'<DetectionRun {self.id} {self.algorithm} {self.status}>'
+
+
 class Anomaly(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     data_point_id = db.Column(db.Integer, db.ForeignKey('data_point.id'), nullable=False)
@@ -65,9 +104,21 @@ class Anomaly(db.Model):
     anomaly_score = db.Column(db.Float, nullable=False)
     detected_at = db.Column(db.DateTime, default=datetime.utcnow)
     algorithm = db.Column(db.String(50), nullable=False)
+    detector_scores = db.Column(db.Text, nullable=True)  # JSON scores of each detector in an ensemble
+    run_id = db.Column(db.Integer, db.ForeignKey('detection_run.id'), nullable=True)
     
-    # Relationship
+    # Relationships
     data_point = db.relationship('DataPoint', backref='anomalies')
+    run = db.relationship('DetectionRun')
+    
+    __table_args__ = (
+        db.Index('ix_anomaly_dataset_score', 'dataset_id', 'anomaly_score'),
+        db.Index('ix_anomaly_dataset_data_point', 'dataset_id', 'data_point_id'),
+        db.Index('ix_anomaly_data_point', 'data_point_id'),
+        db.Index('ix_anomaly_run', 'run_id'),
+        # Serves joins of readings with one run's anomalies (see exports.py)
+        db.Index('ix_anomaly_data_point_run', 'data_point_id', 'run_id'),
+    )
     
     def __repr__(self):
         return f'<Anomaly {self.id}>'
@@ -81,10 +132,17 @@ class ModelEvaluation(db.Model):
     precision = db.Column(db.Float, nullable=True)
     recall = db.Column(db.Float, nullable=True)
     f1_score = db.Column(db.Float, nullable=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('detection_run.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relationship
+    # Relationships
     dataset = db.relationship('Dataset', backref='model_evaluations')
+    run = db.relationship('DetectionRun')
+    
+    __table_args__ = (
+        db.Index('ix_model_evaluation_dataset', 'dataset_id', 'created_at'),
+        db.Index('ix_model_evaluation_run', 'run_id'),
+    )
     
     def __repr__(self):
         return f'<ModelEvaluation {self.algorithm}>'
@@ -96,11 +154,122 @@ class Recommendation(db.Model):
     anomaly_id = db.Column(db.Integer, db.ForeignKey('anomaly.id'), nullable=True)
     recommendation_text = db.Column(db.Text, nullable=False)
     potential_savings = db.Column(db.Float, nullable=True)
+    rule = db.Column(db.String(50), nullable=True)  # Pattern rule that produced it, or 'general'
+    support_count = db.Column(db.Integer, nullable=True)  # Anomalies supporting it
+    rule_seconds = db.Column(db.Float, nullable=True)  # Time spent evaluating the rule
+    run_id = db.Column(db.Integer, db.ForeignKey('detection_run.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     dataset = db.relationship('Dataset', backref='recommendations')
     anomaly = db.relationship('Anomaly', backref='recommendations')
+    run = db.relationship('DetectionRun')
+    
+    __table_args__ = (
+        db.Index('ix_recommendation_dataset', 'dataset_id', 'created_at'),
+        db.Index('ix_recommendation_anomaly', 'anomaly_id'),
+        db.Index('ix_recommendation_run', 'run_id'),
+    )
     
     def __repr__(self):
         return f'<Recommendation {self.id}>'
+
+
+class DetectionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), nullable=False)
+    algorithm = db.Column(db.String(50), nullable=False)
+    contamination = db.Column(db.Float, nullable=False, default=0.1)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, completed, failed
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    message = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON summary of a completed run
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationship
+    dataset = db.relationship('Dataset', backref=db.backref('detection_jobs', cascade="all, delete-orphan"))
+    
+    __table_args__ = (
+        db.Index('ix_detection_job_user_status', 'user_id', 'status'),
+        db.Index('ix_detection_job_status', 'status'),
+    )
+    
+    def __repr__(self):
+        return f'<DetectionJob {self.id} {self.status}>'
+
+
+class FittedModel(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), nullable=False)
+    algorithm = db.Column(db.String(50), nullable=False)
+    params_key = db.Column(db.String(64), nullable=False)  # Hash of the canonical parameter JSON
+    params = db.Column(db.Text, nullable=False)  # JSON
+    data_version = db.Column(db.Integer, nullable=False)
+    training_size = db.Column(db.Integer, nullable=False)
+    fit_seconds = db.Column(db.Float, nullable=False)
+    feature_schema = db.Column(db.Text, nullable=False)  # JSON list of feature column names
+    path = db.Column(db.String(255), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_fitted_model_lookup', 'dataset_id', 'algorithm', 'params_key'),)
+    
+    @property
+    def feature_names(self):
+        return json.loads(self.feature_schema)
+    
+    def __repr__(self):
+        return f'<FittedModel {self.algorithm} dataset={self.dataset_id} v{self.data_version}>'
+
+
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    dataset_count = db.Column(db.Integer, nullable=False, default=0)
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    anomaly_count = db.Column(db.Integer, nullable=False, default=0)
+    recommendation_count = db.Column(db.Integer, nullable=False, default=0)
+    potential_savings = db.Column(db.Float, nullable=False, default=0.0)
+    last_detection_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UserStats {self.user_id}>'
+
+
+class DatasetStats(db.Model):
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    anomaly_count = db.Column(db.Integer, nullable=False, default=0)
+    recommendation_count = db.Column(db.Integer, nullable=False, default=0)
+    potential_savings = db.Column(db.Float, nullable=False, default=0.0)
+    last_detection_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DatasetStats {self.dataset_id}>'
+
+
+class AlgorithmStats(db.Model):
+    dataset_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), primary_key=True)
+    algorithm = db.Column(db.String(50), primary_key=True)
+    anomaly_count = db.Column(db.Integer, nullable=False, default=0)
+    last_detection_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<AlgorithmStats {self.dataset_id} {self.algorithm}>'
+
+
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
@@ -0,0 +1,197 @@
+"""
+Query-plan audit for the web routes.
+
+``flask audit-queries`` seeds a throwaway user with a large dataset,
+requests every GET route as that user, captures each SELECT the routes
+issue, and runs EXPLAIN on it. It fails if any plan reads one of the
+``LARGE_TABLES`` with a full (sequential) scan. The seeded user is deleted
+afterwards, but the command is meant for a scratch database:
+
+    DATABASE_URL=sqlite:////tmp/audit.db flask audit-queries
+"""
+import re
+import sys
+import time
+import logging
+import numpy as np
+import click
+from datetime import date, datetime, timedelta
+from sqlalchemy import event, select, delete, insert
+from app import app, db
+from models import (User, Dataset, DataPoint, Anomaly, ModelEvaluation, Recommendation, DetectionJob,
+                    DetectionRun, UserStats, DatasetStats, AlgorithmStats, DatasetVersion, FittedModel)
+from data_generator import generate_sample_arrays
+from timeseries_store import write_series, delete_store
+
+
+# Tables expected to grow large, where a full scan is a failure
+LARGE_TABLES = ('data_point', 'anomaly', 'recommendation')
+
+AUDIT_USERNAME = 'query-audit'
+
+# Routes not audited (logging out would end the audit session)
+SKIPPED_ENDPOINTS = ('static', 'logout')
+
+# Extra query strings requested for routes that take filters
+ROUTE_QUERIES = {
+    '/api/dataset/<int:dataset_id>/data': ['', 'start=2014-03-01&end=2014-03-08&max_points=500'],
+    '/api/dataset/<int:dataset_id>/anomalies': [
+        '', 'algorithm=isolation_forest&min_score=0.5&start=2014-02-01', 'format=ndjson'],
+}
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+_POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def _seed(num_points, num_anomalies):
+    """Create the audit user with one large dataset and two detection runs."""
+    user = User(username=AUDIT_USERNAME, email='query-audit@example.invalid')
+    user.set_password(AUDIT_USERNAME)
+    db.session.add(user)
+    db.session.flush()
+    dataset = Dataset(name='Query audit', user_id=user.id, is_sample=True)
+    db.session.add(dataset)
+    db.session.flush()
+
+    # Readings are at least 30 minutes apart, so span enough days for all of them
+    start = date(2014, 1, 1)
+    columns = generate_sample_arrays(num_points, start, start + timedelta(days=num_points // 48 + 1), seed=0)
+    ids = write_series(dataset.id, columns, return_ids=True)
+
+    # A superseded run not yet pruned alongside the current one, as right
+    # after a rerun
+    rng = np.random.default_rng(0)
+    now = datetime.utcnow()
+    for status in ('superseded', 'current'):
+        chosen = np.sort(rng.choice(ids, size=min(num_anomalies, len(ids)), replace=False))
+        run = DetectionRun(dataset_id=dataset.id, algorithm='isolation_forest', status=status,
+                           anomaly_count=len(chosen), recommendation_count=10, potential_savings=1.0)
+        db.session.add(run)
+        db.session.flush()
+        db.session.execute(insert(Anomaly), [
+            {'data_point_id': data_point_id, 'dataset_id': dataset.id, 'anomaly_score': score,
+             'detected_at': now, 'algorithm': 'isolation_forest', 'run_id': run.id}
+            for data_point_id, score in zip(chosen.tolist(), rng.random(len(chosen)).tolist())])
+        db.session.add(ModelEvaluation(dataset_id=dataset.id, algorithm='isolation_forest', precision=0.5,
+                                       run_id=run.id))
+        db.session.add_all([Recommendation(dataset_id=dataset.id, recommendation_text='Audit',
+                                           potential_savings=0.1, run_id=run.id)
+                            for _ in range(10)])
+    job = DetectionJob(user_id=user.id, dataset_id=dataset.id, algorithm='isolation_forest', status='completed')
+    db.session.add(job)
+    db.session.commit()
+    return user.id, dataset.id, job.id
+
+
+def _cleanup():
+    user_id = db.session.execute(select(User.id).where(User.username == AUDIT_USERNAME)).scalar()
+    if user_id is None:
+        return
+    dataset_ids = db.session.execute(select(Dataset.id).where(Dataset.user_id == user_id)).scalars().all()
+    for model in (Recommendation, Anomaly, ModelEvaluation, DetectionRun, DetectionJob, FittedModel,
+                  AlgorithmStats, DatasetStats, DatasetVersion, DataPoint):
+        db.session.execute(delete(model).where(model.dataset_id.in_(dataset_ids)))
+    db.session.execute(delete(Dataset).where(Dataset.user_id == user_id))
+    db.session.execute(delete(UserStats).where(UserStats.user_id == user_id))
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+    for dataset_id in dataset_ids:
+        delete_store(dataset_id)
+
+
+def _route_urls(dataset_id, job_id, cursor):
+    """URLs of every parameterless or dataset/job-scoped GET route."""
+    values = {'dataset_id': dataset_id, 'job_id': job_id}
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS or set(rule.arguments) - set(values):
+            continue
+        path = rule.rule
+        for name, value in values.items():
+            path = path.replace(f'<int:{name}>', str(value))
+        for query in ROUTE_QUERIES.get(rule.rule, ['']):
+            urls.append(f"{path}?{query}" if query else path)
+        if rule.endpoint == 'anomaly_panel':
+            urls.append(f"{path}?cursor={cursor}")
+    return urls
+
+
+def _explain(conn, statement, parameters):
+    """Return the plan lines and the large tables read by full scans."""
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+        lines = [row[-1] for row in rows]
+        scans = [match.group(1) for match in map(_SQLITE_SCAN.match, lines) if match]
+    else:
+        rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).all()
+        lines = [row[0] for row in rows]
+        scans = [match.group(1) for line in lines for match in [_POSTGRES_SCAN.search(line)] if match]
+    return lines, [table for table in scans if table in LARGE_TABLES]
+
+
+def audit_queries(num_points=200000, num_anomalies=20000, verbose=False):
+    """
+    Seed data, capture the SELECTs issued by every GET route and EXPLAIN them.
+
+    Returns:
+        List of (url, statement, plan lines, scanned tables) for each query
+        that fully scans a large table
+    """
+    from anomaly_queries import encode_cursor
+
+    _cleanup()
+    started = time.perf_counter()
+    user_id, dataset_id, job_id = _seed(num_points, num_anomalies)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    print(f"Seeded {num_points} readings and {num_anomalies} anomalies in {time.perf_counter() - started:.1f}s")
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    failures = []
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        for url in _route_urls(dataset_id, job_id, encode_cursor(0.5, 0)):
+            captured.clear()
+            response = client.get(url)
+            response.get_data()
+            if response.status_code >= 300:
+                print(f"{url}: HTTP {response.status_code}")
+            queries = list(captured)
+            with db.engine.connect() as conn:
+                for statement, parameters in queries:
+                    lines, scans = _explain(conn, statement, parameters)
+                    if scans:
+                        failures.append((url, statement, lines, scans))
+                    if verbose or scans:
+                        print(f"{'FAIL' if scans else 'ok  '} {url}\n     {' '.join(statement.split())}")
+                        for line in lines:
+                            print(f"       {line}")
+            print(f"{url}: {len(queries)} queries")
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+        _cleanup()
+    return failures
+
+
+@app.cli.command('audit-queries')
+@click.option('--points', default=200000, help='Readings in the seeded dataset.')
+@click.option('--anomalies', default=20000, help='Anomalies in the seeded dataset.')
+@click.option('--verbose', is_flag=True, help='Print every query plan.')
+def audit_queries_command(points, anomalies, verbose):
+    """EXPLAIN every query the GET routes issue; fail on full scans of large tables."""
+    logging.getLogger().setLevel(logging.WARNING)
+    failures = audit_queries(points, anomalies, verbose)
+    if failures:
+        print(f"{len(failures)} queries fully scan a large table")
+        sys.exit(1)
+    print("No full scans of large tables")
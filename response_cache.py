@@ -0,0 +1,177 @@
+"""
+Conditional requests and a payload cache for the dataset API.
+
+Responses of the views wrapped with ``cached_response`` carry a strong ETag
+derived from the dataset's content versions (see ``get_versions``: the
+readings version is bumped by every write, the anomaly version whenever a
+detection run's results become current or incremental scoring adds
+anomalies), the endpoint, the query string and, for views that negotiate
+their representation, the variant the request gets. A request whose
+``If-None-Match`` matches is answered with 304 after two primary-key
+lookups, without reading any readings or anomalies.
+
+Serialized payloads are kept in a bounded in-process LRU cache of
+``RESPONSE_CACHE_MAX_BYTES``, and also written under
+``RESPONSE_CACHE_DIR/<dataset id>/`` when that is set, so other processes
+and restarts reuse them. Entries are keyed by ETag, so a new version is
+never served a stale payload; storing a payload for a new version drops
+the dataset's entries for older versions.
+"""
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, Response
+from flask_login import current_user
+from app import app
+from models import Dataset
+from timeseries_store import get_versions
+
+
+_cache = OrderedDict()  # ETag -> (dataset_id, versions, headers, body)
+
+# Response headers stored with cached payloads
+CACHED_HEADERS = ('Content-Type', 'Content-Encoding')
+_cache_bytes = 0
+_lock = threading.Lock()
+
+
+def make_etag(dataset_id, versions, endpoint, args, variant=''):
+    """Strong ETag for a dataset API response; args are the request's query arguments."""
+    key = json.dumps([endpoint, dataset_id, list(versions), sorted(args.items(multi=True)), variant])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def _file_prefix(versions):
+    return '-'.join(map(str, versions)) + '-'
+
+
+def _file_path(etag, dataset_id, versions):
+    return os.path.join(app.config['RESPONSE_CACHE_DIR'], str(dataset_id), f"{_file_prefix(versions)}{etag}")
+
+
+def _read_file(etag, dataset_id, versions):
+    try:
+        with open(_file_path(etag, dataset_id, versions), 'rb') as f:
+            return json.loads(f.readline()), f.read()
+    except (OSError, ValueError):
+        return None
+
+
+def _write_file(etag, dataset_id, versions, headers, body):
+    directory = os.path.join(app.config['RESPONSE_CACHE_DIR'], str(dataset_id))
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, f".{uuid.uuid4().hex}.tmp")
+    with open(temporary, 'wb') as f:
+        f.write(json.dumps(headers).encode() + b'\n')
+        f.write(body)
+    os.replace(temporary, _file_path(etag, dataset_id, versions))
+
+    # Files for older versions of the dataset can never be served again
+    prefix = _file_prefix(versions)
+    for name in os.listdir(directory):
+        if not name.startswith(prefix) and not name.startswith('.'):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def get(etag, dataset_id, versions):
+    """Cached (headers, body) for an ETag, or None."""
+    with _lock:
+        entry = _cache.get(etag)
+        if entry is not None:
+            _cache.move_to_end(etag)
+            return entry[2], entry[3]
+    if app.config.get('RESPONSE_CACHE_DIR'):
+        entry = _read_file(etag, dataset_id, versions)
+        if entry is not None:
+            _store(etag, dataset_id, versions, *entry)
+            return entry
+    return None
+
+
+def _store(etag, dataset_id, versions, headers, body):
+    global _cache_bytes
+    max_bytes = app.config['RESPONSE_CACHE_MAX_BYTES']
+    if len(body) > max_bytes:
+        return
+    with _lock:
+        # Entries for older versions of the dataset can never be served again
+        for key in [key for key, entry in _cache.items() if entry[0] == dataset_id and entry[1] != versions]:
+            _cache_bytes -= len(_cache.pop(key)[3])
+        previous = _cache.pop(etag, None)
+        if previous is not None:
+            _cache_bytes -= len(previous[3])
+        _cache[etag] = (dataset_id, versions, headers, body)
+        _cache_bytes += len(body)
+        while _cache_bytes > max_bytes:
+            _cache_bytes -= len(_cache.popitem(last=False)[1][3])
+
+
+def put(etag, dataset_id, versions, headers, body):
+    """Cache a serialized payload and its headers, and write them to RESPONSE_CACHE_DIR if set."""
+    _store(etag, dataset_id, versions, headers, body)
+    if app.config.get('RESPONSE_CACHE_DIR'):
+        try:
+            _write_file(etag, dataset_id, versions, headers, body)
+        except OSError as e:
+            logging.warning(f"Error writing cached response for dataset {dataset_id}: {str(e)}")
+
+
+def clear():
+    """Empty the in-memory cache."""
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
+
+
+def cached_response(variant=None):
+    """
+    Serve a dataset API view conditionally and from the payload cache.
+
+    The wrapped view takes a ``dataset_id`` owned by the current user.
+    Successful responses are cached, except streamed ones (``format=ndjson``),
+    which only get the ETag and 304 handling.
+
+    Args:
+        variant: Optional callable naming the representation the current
+            request gets, for views that negotiate it from request headers
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(dataset_id, **kwargs):
+            # Verify the dataset belongs to the current user before serving anything cached
+            Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
+
+            versions = get_versions(dataset_id)
+            etag = make_etag(dataset_id, versions, request.endpoint, request.args,
+                             variant() if variant is not None else '')
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                cached = get(etag, dataset_id, versions)
+                if cached is not None:
+                    response = Response(cached[1], headers=cached[0])
+                else:
+                    response = app.make_response(view(dataset_id, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        put(etag, dataset_id, versions,
+                            {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers},
+                            response.get_data())
+            response.set_etag(etag)
+            # Browsers keep the payload but revalidate it on every use
+            response.headers['Cache-Control'] = 'private, no-cache'
+            if variant is not None:
+                response.vary.update(('Accept', 'Accept-Encoding'))
+            return response
+        return wrapper
+    return decorator
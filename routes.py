@@ -1,16 +1,42 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify
+from flask import render_template, redirect, url_for, flash, request, jsonify, Response, stream_with_context
 from flask_login import login_user, current_user, logout_user, login_required
 from app import app, db
-from models import User, Dataset, DataPoint, Anomaly, ModelEvaluation, Recommendation
+from models import User, Dataset, DataPoint, Anomaly, ModelEvaluation, Recommendation, DetectionJob
 from forms import LoginForm, SignupForm, GenerateDataForm, UploadDataForm, ManualDataEntryForm, AnomalyDetectionForm
-from data_generator import generate_sample_data
-from anomaly_detection import detect_anomalies, evaluate_model, generate_recommendations
-import pandas as pd
-import io
+from data_generator import generate_sample_arrays
+from timeseries_store import write_series, append_point, read_series
+from jobs import submit_detection_job, recover_jobs
+from incremental import IncrementalScorer
+from downsampling import downsample, DOWNSAMPLING_METHODS
+from dataset_stats import get_user_stats
+from anomaly_queries import anomaly_counts, anomaly_page, encode_cursor, decode_cursor
+from detection_runs import current_run_ids
+from response_cache import cached_response
+from series_encoding import SERIES_MIMETYPE, wants_binary, response_variant, encode_series
+from exports import EXPORT_FORMATS, export_run_id, export_chunks, parquet_available
+from sqlalchemy import select, and_, or_
 from datetime import datetime
+import numpy as np
+import json
 import logging
 
 
+_jobs_recovered = False
+
+
+@app.before_request
+def resume_interrupted_jobs():
+    # Pick up detection jobs orphaned by a previous server process
+    global _jobs_recovered
+    if not _jobs_recovered:
+        _jobs_recovered = True
+        try:
+            recover_jobs()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Job recovery error: {str(e)}")
+
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -63,10 +89,11 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get user statistics for dashboard
-    datasets_count = Dataset.query.filter_by(user_id=current_user.id).count()
-    anomalies_count = Anomaly.query.join(Dataset).filter(Dataset.user_id == current_user.id).count()
-    recommendations_count = Recommendation.query.join(Dataset).filter(Dataset.user_id == current_user.id).count()
+    # Get user statistics for dashboard from the materialized summary row
+    stats = get_user_stats(current_user.id)
+    datasets_count = stats.dataset_count
+    anomalies_count = stats.anomaly_count
+    recommendations_count = stats.recommendation_count
     
     # Get recent datasets
     recent_datasets = Dataset.query.filter_by(user_id=current_user.id).order_by(Dataset.created_at.desc()).limit(5).all()
@@ -100,20 +127,20 @@ def generate_data():
             include_anomalies = form.include_anomalies.data == 'yes'
             anomaly_percentage = form.anomaly_percentage.data if include_anomalies else 0
             
-            data_points = generate_sample_data(
+            columns = generate_sample_arrays(
                 num_points=form.num_data_points.data,
                 start_date=form.start_date.data,
                 end_date=form.end_date.data,
                 include_anomalies=include_anomalies,
                 anomaly_percentage=anomaly_percentage,
-                dataset_id=dataset.id
+                seed=form.seed.data
             )
             
-            # Add data points to the database
-            db.session.add_all(data_points)
+            # Bulk insert the generated rows
+            num_points = write_series(dataset.id, columns)
             db.session.commit()
             
-            flash(f'Successfully generated {len(data_points)} data points!', 'success')
+            flash(f'Successfully generated {num_points} data points!', 'success')
             return redirect(url_for('view_anomalies'))
         except Exception as e:
             db.session.rollback()
@@ -135,40 +162,42 @@ def custom_data():
     # Process file upload
     if upload_form.validate_on_submit() and 'data_file' in request.files:
         try:
-            file = request.files['upload_form-data_file']
+            file = request.files['data_file']
             if file.filename:
-                # Create new dataset
-                dataset = Dataset(
-                    name=upload_form.name.data,
-                    description=upload_form.description.data,
-                    user_id=current_user.id,
-                    is_sample=False
-                )
-                db.session.add(dataset)
-                db.session.flush()
+                append_dataset_id = request.form.get('append_dataset_id')
+                scorer = None
                 
-                # Read and process the CSV file
-                stream = io.StringIO(file.stream.read().decode('utf-8'))
-                df = pd.read_csv(stream)
-                
-                # Process each row and add to database
-                data_points = []
-                for _, row in df.iterrows():
-                    # Assuming CSV has required columns
-                    data_point = DataPoint(
-                        timestamp=datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S'),
-                        energy_consumption=float(row['energy_consumption']),
-                        temperature=float(row.get('temperature', 0)) if 'temperature' in row else None,
-                        humidity=float(row.get('humidity', 0)) if 'humidity' in row else None,
-                        occupancy=int(row.get('occupancy', 0)) if 'occupancy' in row else None,
-                        dataset_id=dataset.id
+                if append_dataset_id and append_dataset_id != 'new':
+                    # Append to an existing dataset, scoring the new rows against its last model
+                    dataset = Dataset.query.filter_by(id=int(append_dataset_id), user_id=current_user.id).first_or_404()
+                    if app.config['INCREMENTAL_SCORING']:
+                        scorer = IncrementalScorer(dataset.id)
+                else:
+                    # Create new dataset
+                    dataset = Dataset(
+                        name=upload_form.name.data,
+                        description=upload_form.description.data,
+                        user_id=current_user.id,
+                        is_sample=False
                     )
-                    data_points.append(data_point)
+                    db.session.add(dataset)
+                    db.session.flush()
                 
-                db.session.add_all(data_points)
+                # Stream the CSV file into the database chunk by chunk; the
+                # CSV parser (pandas) is loaded on the first upload
+                from ingestion import ingest_csv
+                result = ingest_csv(file.stream, dataset.id,
+                                    on_chunk=scorer.score if scorer is not None and scorer.active else None)
                 db.session.commit()
                 
-                flash(f'Successfully uploaded {len(data_points)} data points!', 'success')
+                message = f'Successfully uploaded {result["rows"]} data points ({result["rows_per_second"]:,.0f} rows/s)'
+                if result['rejected']:
+                    message += f'; {result["rejected"]} rows were rejected'
+                if scorer is not None and scorer.active:
+                    message += f'; {scorer.anomalies} new anomalies detected'
+                    if scorer.finish(current_user.id):
+                        message += '; a full re-detection has been queued'
+                flash(message + '!', 'success')
                 return redirect(url_for('custom_data'))
         except Exception as e:
             db.session.rollback()
@@ -191,22 +220,32 @@ def custom_data():
                 )
                 db.session.add(dataset)
                 db.session.flush()
-                dataset_id = dataset.id
+            else:
+                # Verify the dataset belongs to the current user
+                dataset = Dataset.query.filter_by(id=int(dataset_id), user_id=current_user.id).first_or_404()
             
-            # Create new data point
-            data_point = DataPoint(
+            # Append the new data point
+            dataset_id = dataset.id
+            scorer = IncrementalScorer(dataset_id) if app.config['INCREMENTAL_SCORING'] else None
+            columns = append_point(
+                dataset_id,
                 timestamp=manual_form.timestamp.data,
                 energy_consumption=manual_form.energy_consumption.data,
                 temperature=manual_form.temperature.data,
                 humidity=manual_form.humidity.data,
-                occupancy=manual_form.occupancy.data,
-                dataset_id=dataset_id
+                occupancy=manual_form.occupancy.data
             )
             
-            db.session.add(data_point)
+            # Score just the new point against the dataset's last fitted model
+            is_anomaly = scorer is not None and scorer.score(columns['id'], columns) > 0
             db.session.commit()
             
-            flash('Data point added successfully!', 'success')
+            if is_anomaly:
+                flash('Data point added and flagged as an anomaly.', 'warning')
+            else:
+                flash('Data point added successfully!', 'success')
+            if scorer is not None:
+                scorer.finish(current_user.id)
             return redirect(url_for('custom_data'))
         except Exception as e:
             db.session.rollback()
@@ -236,54 +275,63 @@ def view_anomalies():
             algorithm = form.algorithm.data
             contamination = form.contamination.data or 0.1
             
-            # Run anomaly detection
-            dataset = Dataset.query.get_or_404(dataset_id)
-            anomalies = detect_anomalies(dataset, algorithm, contamination)
-            
-            # Store anomalies in the database
-            db.session.add_all(anomalies)
-            
-            # Run model evaluation
-            evaluation = evaluate_model(dataset, algorithm, anomalies)
-            db.session.add(evaluation)
-            
-            # Generate recommendations based on anomalies
-            recommendations = generate_recommendations(dataset, anomalies)
-            db.session.add_all(recommendations)
-            
-            db.session.commit()
+            # Queue anomaly detection, evaluation and recommendations as a background job
+            dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
+            job = submit_detection_job(current_user.id, dataset.id, algorithm, contamination)
             
-            flash(f'Successfully detected {len(anomalies)} anomalies!', 'success')
+            flash(f'Anomaly detection queued for {dataset.name} (job #{job.id}).', 'info')
             return redirect(url_for('view_anomalies'))
         except Exception as e:
             db.session.rollback()
-            flash(f'Error detecting anomalies: {str(e)}', 'danger')
+            flash(f'Error queuing anomaly detection: {str(e)}', 'danger')
             logging.error(f"Anomaly detection error: {str(e)}")
     
-    # Get datasets and their anomalies for display
-    datasets_with_anomalies = []
-    for dataset in datasets:
-        anomalies = Anomaly.query.filter_by(dataset_id=dataset.id).all()
-        if anomalies:
-            datasets_with_anomalies.append({
-                'dataset': dataset,
-                'anomalies': anomalies,
-                'count': len(anomalies)
-            })
+    # Jobs still in progress, so the page can poll them
+    active_jobs = (DetectionJob.query
+                   .filter(DetectionJob.user_id == current_user.id,
+                           DetectionJob.status.in_(('queued', 'running')))
+                   .order_by(DetectionJob.created_at)
+                   .all())
+    
+    # Datasets with their anomaly counts; panels load their anomalies when expanded
+    datasets_with_anomalies = [{'dataset': dataset, 'count': count}
+                               for dataset, count in anomaly_counts(current_user.id)]
     
     return render_template('view_anomalies.html', 
                           title='View Anomalies',
                           form=form,
+                          active_jobs=active_jobs,
                           datasets_with_anomalies=datasets_with_anomalies)
 
 
+@app.route('/view-anomalies/<int:dataset_id>/panel')
+@login_required
+def anomaly_panel(dataset_id):
+    # Verify the dataset belongs to the current user
+    dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
+    
+    cursor = request.args.get('cursor')
+    try:
+        anomalies, next_cursor = anomaly_page(dataset.id, app.config['ANOMALY_PANEL_PAGE_SIZE'], cursor)
+    except ValueError:
+        return 'Invalid cursor', 400
+    
+    # Follow-up pages only need the extra table rows
+    template = 'anomaly_rows.html' if cursor else 'anomaly_panel.html'
+    response = app.make_response(render_template(template, dataset=dataset, anomalies=anomalies,
+                                                 next_cursor=next_cursor))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
 @app.route('/model-evaluation')
 @login_required
 def model_evaluation():
-    # Get all model evaluations for the current user
+    # Get the current model evaluations for the current user
     evaluations = (ModelEvaluation.query
                   .join(Dataset)
-                  .filter(Dataset.user_id == current_user.id)
+                  .filter(Dataset.user_id == current_user.id, ModelEvaluation.run_id.in_(current_run_ids()))
                   .order_by(ModelEvaluation.created_at.desc())
                   .all())
     
@@ -305,10 +353,10 @@ def model_evaluation():
 @app.route('/recommendations')
 @login_required
 def recommendations():
-    # Get all recommendations for the current user
+    # Get the current recommendations for the current user
     recommendations = (Recommendation.query
                       .join(Dataset)
-                      .filter(Dataset.user_id == current_user.id)
+                      .filter(Dataset.user_id == current_user.id, Recommendation.run_id.in_(current_run_ids()))
                       .order_by(Recommendation.created_at.desc())
                       .all())
     
@@ -317,55 +365,106 @@ def recommendations():
                           recommendations=recommendations)
 
 
+def _parse_time_arg(name):
+    """Parse an optional ISO date/time query parameter."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('T', ' ').strip())
+
+
+def _nullable_list(values):
+    """Convert a float array to a list with NaN as None (JSON null)."""
+    return [None if value != value else value for value in values.tolist()]
+
+
 @app.route('/api/dataset/<int:dataset_id>/data')
 @login_required
+@cached_response(variant=response_variant)
 def get_dataset_data(dataset_id):
     # Verify the dataset belongs to the current user
     dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
     
-    # Get data points for the dataset
-    data_points = DataPoint.query.filter_by(dataset_id=dataset_id).order_by(DataPoint.timestamp).all()
+    # Time window and downsampling options
+    try:
+        start = _parse_time_arg('start')
+        end = _parse_time_arg('end')
+        max_points = request.args.get('max_points', app.config['CHART_MAX_POINTS'], type=int)
+    except ValueError:
+        return jsonify({'error': 'start and end must be ISO dates or date-times'}), 400
+    max_points = min(max(max_points, 10), app.config['CHART_MAX_POINTS_LIMIT'])
+    method = request.args.get('method', 'lttb')
+    if method not in DOWNSAMPLING_METHODS:
+        return jsonify({'error': f"method must be one of {', '.join(DOWNSAMPLING_METHODS)}"}), 400
+    
+    # Get the readings in the window
+    series = read_series(dataset_id, ('id', 'timestamp', 'energy_consumption', 'temperature', 'humidity'),
+                         start=start, end=end)
+    
+    # Flag anomalous readings; they are always kept when downsampling
+    anomaly_data_point_ids = np.fromiter(
+        db.session.execute(select(Anomaly.data_point_id)
+                           .where(Anomaly.dataset_id == dataset_id,
+                                  Anomaly.run_id.in_(current_run_ids(dataset_id)))
+                           .distinct()).scalars(),
+        dtype=np.int64)
+    is_anomaly = np.isin(series['id'], anomaly_data_point_ids)
     
-    # Get anomalies
-    anomalies = Anomaly.query.filter_by(dataset_id=dataset_id).all()
-    anomaly_data_point_ids = [a.data_point_id for a in anomalies]
+    total_points = len(series['id'])
+    selected = downsample(series['timestamp'], series['energy_consumption'], max_points,
+                          keep=is_anomaly, method=method)
+    summary = {
+        'total_points': total_points,
+        'anomaly_count': int(is_anomaly.sum()),
+        'downsampled': len(selected) < total_points,
+        'method': method
+    }
+    
+    if wants_binary():
+        # Packed typed-array columns (see series_encoding.py)
+        compress = 'gzip' in request.accept_encodings
+        try:
+            body = encode_series([
+                ('timestamp', 'uint32', series['timestamp'][selected].astype('datetime64[s]').astype(np.int64)),
+                ('energy_consumption', 'float32', series['energy_consumption'][selected]),
+                ('temperature', 'float32', series['temperature'][selected]),
+                ('humidity', 'float32', series['humidity'][selected]),
+                ('is_anomaly', 'uint8', is_anomaly[selected]),
+            ], summary, compress=compress)
+        except ValueError as e:
+            # Readings before 1970 or after 2106; the JSON below has no such limit
+            logging.info(f"Sending dataset {dataset_id} chart data as JSON: {str(e)}")
+        else:
+            response = Response(body, mimetype=SERIES_MIMETYPE)
+            if compress:
+                response.headers['Content-Encoding'] = 'gzip'
+            return response
     
-    # Format data for chart.js
+    # Format data for chart.js; optional readings stay aligned, with null for gaps
     data = {
-        'timestamps': [dp.timestamp.strftime('%Y-%m-%d %H:%M:%S') for dp in data_points],
-        'energy_consumption': [dp.energy_consumption for dp in data_points],
-        'temperature': [dp.temperature for dp in data_points if dp.temperature is not None],
-        'humidity': [dp.humidity for dp in data_points if dp.humidity is not None],
-        'is_anomaly': [1 if dp.id in anomaly_data_point_ids else 0 for dp in data_points]
+        'timestamps': np.char.replace(np.datetime_as_string(series['timestamp'][selected], unit='s'), 'T', ' ').tolist(),
+        'energy_consumption': series['energy_consumption'][selected].tolist(),
+        'temperature': _nullable_list(series['temperature'][selected]),
+        'humidity': _nullable_list(series['humidity'][selected]),
+        'is_anomaly': is_anomaly[selected].astype(int).tolist(),
+        **summary
     }
     
     return jsonify(data)
 
 
-@app.route('/api/dataset/<int:dataset_id>/anomalies')
-@login_required
-def get_dataset_anomalies(dataset_id):
-    # Verify the dataset belongs to the current user
-    dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
-    
-    # Get anomalies and join with data points to get timestamps
-    anomalies = (Anomaly.query
-                .join(DataPoint, Anomaly.data_point_id == DataPoint.id)
-                .filter(Anomaly.dataset_id == dataset_id)
-                .with_entities(
-                    Anomaly.id,
-                    Anomaly.anomaly_score,
-                    Anomaly.algorithm,
-                    DataPoint.timestamp,
-                    DataPoint.energy_consumption,
-                    DataPoint.temperature,
-                    DataPoint.humidity,
-                    DataPoint.occupancy
-                )
-                .all())
-    
-    # Format data
-    result = [{
+def _encode_cursor(timestamp, anomaly_id):
+    """Opaque keyset cursor for the anomaly listing."""
+    return encode_cursor(timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'), anomaly_id)
+
+
+def _decode_cursor(cursor):
+    timestamp, anomaly_id = decode_cursor(cursor)
+    return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f'), int(anomaly_id)
+
+
+def _serialize_anomaly(a):
+    return {
         'id': a.id,
         'timestamp': a.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
         'score': a.anomaly_score,
@@ -373,7 +472,115 @@ def get_dataset_anomalies(dataset_id):
         'energy_consumption': a.energy_consumption,
         'temperature': a.temperature,
         'humidity': a.humidity,
-        'occupancy': a.occupancy
-    } for a in anomalies]
+        'occupancy': a.occupancy,
+        'detector_scores': json.loads(a.detector_scores) if a.detector_scores else None
+    }
+
+
+@app.route('/api/dataset/<int:dataset_id>/anomalies')
+@login_required
+@cached_response()
+def get_dataset_anomalies(dataset_id):
+    # Anomalies in (timestamp, id) order, filtered by algorithm, min_score,
+    # max_score, start and end. Returns one page of at most `limit` rows and
+    # a next_cursor for the following page, or with format=ndjson streams
+    # every matching row as one JSON object per line.
+    # Verify the dataset belongs to the current user
+    dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
+    
+    try:
+        start = _parse_time_arg('start')
+        end = _parse_time_arg('end')
+        min_score = request.args.get('min_score', type=float)
+        max_score = request.args.get('max_score', type=float)
+        limit = request.args.get('limit', app.config['ANOMALY_PAGE_SIZE'], type=int)
+        cursor = _decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid start, end or cursor'}), 400
+    limit = min(max(limit, 1), app.config['ANOMALY_PAGE_SIZE_LIMIT'])
+    algorithm = request.args.get('algorithm')
+    
+    # Join anomalies with data points to get timestamps and readings
+    statement = (select(Anomaly.id, Anomaly.anomaly_score, Anomaly.algorithm, Anomaly.detector_scores,
+                        DataPoint.timestamp, DataPoint.energy_consumption, DataPoint.temperature,
+                        DataPoint.humidity, DataPoint.occupancy)
+                 .join(DataPoint, Anomaly.data_point_id == DataPoint.id)
+                 .where(Anomaly.dataset_id == dataset_id, Anomaly.run_id.in_(current_run_ids(dataset_id)))
+                 .order_by(DataPoint.timestamp, Anomaly.id))
+    if algorithm:
+        statement = statement.where(Anomaly.algorithm == algorithm)
+    if min_score is not None:
+        statement = statement.where(Anomaly.anomaly_score >= min_score)
+    if max_score is not None:
+        statement = statement.where(Anomaly.anomaly_score <= max_score)
+    if start is not None:
+        statement = statement.where(DataPoint.timestamp >= start)
+    if end is not None:
+        statement = statement.where(DataPoint.timestamp < end)
+    if cursor is not None:
+        cursor_timestamp, cursor_id = cursor
+        statement = statement.where(or_(DataPoint.timestamp > cursor_timestamp,
+                                        and_(DataPoint.timestamp == cursor_timestamp, Anomaly.id > cursor_id)))
+    
+    if request.args.get('format') == 'ndjson':
+        batch_size = app.config['ANOMALY_STREAM_BATCH_SIZE']
+        
+        def generate():
+            # Server-side cursor: rows are fetched and written one batch at a time
+            result = db.session.execute(statement.execution_options(yield_per=batch_size))
+            for rows in result.partitions():
+                yield ''.join(json.dumps(_serialize_anomaly(a)) + '\n' for a in rows)
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    rows = db.session.execute(statement.limit(limit + 1)).all()
+    next_cursor = _encode_cursor(rows[limit - 1].timestamp, rows[limit - 1].id) if len(rows) > limit else None
+    
+    return jsonify({
+        'anomalies': [_serialize_anomaly(a) for a in rows[:limit]],
+        'next_cursor': next_cursor
+    })
+
+
+@app.route('/api/dataset/<int:dataset_id>/export')
+@login_required
+def export_dataset(dataset_id):
+    # Every reading of the dataset with the anomaly flag and score of the
+    # current run of `algorithm` (by default the latest current run), as a
+    # csv, ndjson or parquet download streamed batch by batch
+    # Verify the dataset belongs to the current user
+    dataset = Dataset.query.filter_by(id=dataset_id, user_id=current_user.id).first_or_404()
+    
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown export format, expected one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if export_format == 'parquet' and not parquet_available():
+        return jsonify({'error': 'Parquet export requires pyarrow'}), 501
+    
+    run_id = export_run_id(dataset.id, request.args.get('algorithm'))
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    chunks = export_chunks(dataset.id, export_format, run_id, app.config['EXPORT_BATCH_SIZE'])
+    
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="dataset-{dataset.id}.{extension}"'
+    })
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def get_job_status(job_id):
+    # Verify the job belongs to the current user
+    job = DetectionJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
     
-    return jsonify(result)
+    return jsonify({
+        'id': job.id,
+        'dataset_id': job.dataset_id,
+        'algorithm': job.algorithm,
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'started_at': job.started_at.strftime('%Y-%m-%d %H:%M:%S') if job.started_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None
+    })
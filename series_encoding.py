@@ -0,0 +1,91 @@
+"""
+Compact binary encoding of chart series.
+
+Clients that send ``Accept: application/vnd.energy-series`` (or pass
+``format=binary``) get the chart data as packed little-endian columns
+instead of JSON:
+
+    4 bytes     magic, b'ESR1'
+    uint32      length of the JSON header
+    JSON header {"count": n, "columns": [{"name", "type"}, ...], ...}
+    columns     n values each, in header order, each starting on a 4-byte
+                boundary (zero padding)
+
+Timestamps are uint32 seconds since the epoch, for the naive stored
+times read as UTC, so only times from 1970 to 2106 fit; ``encode_series``
+raises ValueError for values outside an integer column's range, and such
+series are sent as JSON instead. Readings are float32 with NaN for missing
+values; flags are uint8. The header also carries the scalar fields of the JSON response.
+Browsers map each column straight onto a typed array. The body is
+gzip-compressed when the client accepts it.
+"""
+import gzip
+import json
+import struct
+import numpy as np
+from flask import request
+
+
+SERIES_MIMETYPE = 'application/vnd.energy-series'
+
+MAGIC = b'ESR1'
+
+# Column types and their NumPy dtypes
+COLUMN_TYPES = {
+    'uint32': '<u4',
+    'float32': '<f4',
+    'uint8': 'u1',
+}
+
+GZIP_LEVEL = 6
+
+
+def wants_binary():
+    """Whether the current request asks for the binary series encoding."""
+    if request.args.get('format') == 'binary':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', SERIES_MIMETYPE]) == SERIES_MIMETYPE
+
+
+def response_variant():
+    """The representation the current request gets, for cache keys."""
+    if not wants_binary():
+        return 'json'
+    return 'binary+gzip' if 'gzip' in request.accept_encodings else 'binary'
+
+
+def _padding(length):
+    return b'\0' * (-length % 4)
+
+
+def encode_series(columns, fields, compress=False):
+    """
+    Pack chart columns into the binary series format.
+
+    Args:
+        columns: List of (name, type, array) with type a key of COLUMN_TYPES
+        fields: Dict of scalar fields added to the header
+        compress: Whether to gzip the result
+
+    Returns:
+        Bytes of the encoded series
+
+    Raises:
+        ValueError: If a value doesn't fit its integer column type
+    """
+    for name, kind, values in columns:
+        dtype = np.dtype(COLUMN_TYPES[kind])
+        if dtype.kind in 'iu' and len(values):
+            limits = np.iinfo(dtype)
+            if np.min(values) < limits.min or np.max(values) > limits.max:
+                raise ValueError(f"Column {name} has values outside the {kind} range")
+    count = len(columns[0][2]) if columns else 0
+    header = json.dumps(dict(fields, count=count,
+                             columns=[{'name': name, 'type': kind} for name, kind, _ in columns])).encode()
+    parts = [MAGIC, struct.pack('<I', len(header)), header, _padding(len(header))]
+    for _, kind, values in columns:
+        data = np.ascontiguousarray(values, dtype=COLUMN_TYPES[kind]).tobytes()
+        parts.extend([data, _padding(len(data))])
+    body = b''.join(parts)
+    # A fixed mtime keeps the bytes, and so the ETag, stable
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0) if compress else body
@@ -0,0 +1,113 @@
+"""
+Startup cost: import-time profiling and preload warm-up.
+
+Importing the app loads only Flask, SQLAlchemy and NumPy. The analysis
+stack (scikit-learn, SciPy, pandas) is imported by the code paths that
+need it, on first use, so the web process, CLI commands and spawned job
+workers start quickly. ``flask profile-imports`` shows where import time
+goes.
+
+With ``GUNICORN_PRELOAD=1`` (see gunicorn.conf.py) the gunicorn master
+imports the app, runs ``warm_up`` and then forks its workers, which share
+the loaded modules and detectors copy-on-write instead of each loading
+them on their first request that scores inline (incremental scoring of
+new readings, ingestion). Detection jobs run in spawned job workers,
+which share nothing with the master: each runs ``warm_up_worker`` as it
+starts, and a preloaded web worker starts its job workers right after it
+is forked rather than on its first job.
+"""
+import sys
+import logging
+import importlib
+import subprocess
+from app import app, db
+
+
+# Modules loaded lazily by detection and ingestion, imported by warm_up and warm_up_worker
+ANALYSIS_MODULES = ('anomaly_detection', 'ensemble', 'windowed_detection', 'feature_cache', 'ingestion')
+
+
+def warm_up():
+    """
+    Prepare the process for forking workers: create the schema, import the
+    analysis stack and load the most recently used detectors. Database
+    connections are closed afterwards so no worker inherits them.
+
+    Returns:
+        Number of detectors loaded
+    """
+    from migrations import init_db
+    from model_registry import preload_models
+
+    with app.app_context():
+        try:
+            init_db()
+            for name in ANALYSIS_MODULES:
+                importlib.import_module(name)
+            loaded = preload_models()
+        finally:
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+    logging.info(f"Warmed up {len(ANALYSIS_MODULES)} analysis modules and {loaded} detectors")
+    return loaded
+
+
+def warm_up_worker():
+    """
+    Initializer of the job workers: import the analysis stack and load the
+    most recently used detectors before the first job. A failure is only
+    logged, since an initializer that raises breaks the whole pool.
+    """
+    from model_registry import preload_models
+
+    with app.app_context():
+        try:
+            for name in ANALYSIS_MODULES:
+                importlib.import_module(name)
+            loaded = preload_models()
+            logging.info(f"Warmed up job worker with {loaded} detectors")
+        except Exception as e:
+            logging.warning(f"Warming up job worker failed: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+def profile_imports(module='app'):
+    """
+    Measure a module's import in a fresh interpreter with ``-X importtime``.
+    Modules other than the app are imported after it, and measured alone.
+
+    Args:
+        module: Module to import
+
+    Returns:
+        Tuple of (total seconds, list of (cumulative seconds, module name)
+        for the modules it imported, slowest first)
+    """
+    statement = 'import app' if module == 'app' else f'import app; import {module}'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative) / 1e6, name.strip()))
+        # Imports are listed after their dependencies, so everything up to
+        # the app itself belongs to the app
+        if module != 'app' and name == ' app':
+            timings = []
+    total = next((seconds for seconds, name in timings if name == module), 0.0)
+    timings.sort(reverse=True)
+    return total, timings
+
+
+@app.cli.command('profile-imports')
+def profile_imports_command():
+    """Show the slowest imports of the app and of the analysis stack."""
+    for module in ('app', 'anomaly_detection'):
+        total, timings = profile_imports(module)
+        print(f"import {module}: {total:.2f}s")
+        for seconds, name in timings[1:16]:
+            print(f"  {seconds:7.3f}s  {name}")
@@ -40,7 +40,7 @@ function createEnergyConsumptionChart(canvasId, data) {
     const chart = new Chart(ctx, {
         type: 'line',
         data: {
-            labels: timestamps,
+            labels: Array.from(timestamps),
             datasets: [
                 {
                     label: 'Energy Consumption',
@@ -149,7 +149,7 @@ function createCorrelationChart(canvasId, data) {
     
     // Only create points where both energy and temperature values exist
     for (let i = 0; i < energyValues.length; i++) {
-        if (i < temperatureValues.length) {
+        if (isPresent(temperatureValues[i])) {
             const point = {
                 x: temperatureValues[i],
                 y: energyValues[i]
@@ -500,12 +500,92 @@ function determineTimeUnit(timestamps) {
     }
 }
 
+/**
+ * Whether a reading is present (not null, undefined or NaN)
+ * @param {number|null} value - The reading
+ * @returns {boolean} True if the value can be plotted
+ */
+function isPresent(value) {
+    return value !== null && value !== undefined && !Number.isNaN(value);
+}
+
+const SERIES_MIMETYPE = 'application/vnd.energy-series';
+
+/**
+ * Decodes the binary chart series format (see series_encoding.py)
+ * @param {ArrayBuffer} buffer - The response body
+ * @returns {Object} Chart data with typed-array columns: timestamps in
+ *                   milliseconds, float32 readings (NaN when missing) and
+ *                   uint8 is_anomaly flags, plus the summary fields
+ */
+function decodeSeries(buffer) {
+    const align = offset => offset + (-offset & 3);
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== 'ESR1') {
+        throw new Error('Unexpected chart data format');
+    }
+    const headerLength = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+    const types = {uint32: Uint32Array, float32: Float32Array, uint8: Uint8Array};
+    
+    // Columns are little-endian, the byte order of every browser platform
+    const data = Object.assign({}, header);
+    let offset = align(8 + headerLength);
+    for (const column of header.columns) {
+        const ArrayType = types[column.type];
+        data[column.name] = new ArrayType(buffer, offset, header.count);
+        offset = align(offset + header.count * ArrayType.BYTES_PER_ELEMENT);
+    }
+    
+    // Stored times are naive; show them at the same wall-clock time as
+    // the JSON format's strings rather than shifted to the local zone. The
+    // zone offset is looked up once per day, or per reading on days it changes.
+    const dayMs = 86400000;
+    const zoneOffset = ms => new Date(ms).getTimezoneOffset() * 60000;
+    // The offset in effect at the shifted instant, not at the UTC one
+    const wallClockOffset = ms => zoneOffset(ms + zoneOffset(ms));
+    const timestamps = new Float64Array(header.count);
+    let dayStart = NaN;
+    let dayOffset = 0;
+    let offsetChanges = false;
+    for (let i = 0; i < header.count; i++) {
+        const ms = data.timestamp[i] * 1000;
+        if (!(ms >= dayStart && ms < dayStart + dayMs)) {
+            dayStart = ms - ms % dayMs;
+            dayOffset = wallClockOffset(dayStart);
+            offsetChanges = wallClockOffset(dayStart + dayMs - 1) !== dayOffset;
+        }
+        timestamps[i] = ms + (offsetChanges ? wallClockOffset(ms) : dayOffset);
+    }
+    data.timestamps = timestamps;
+    return data;
+}
+
+/**
+ * Builds the chart data URL for a dataset
+ * @param {number} datasetId - The ID of the dataset
+ * @param {Object} options - Optional start, end (ISO strings), maxPoints and method
+ * @returns {string} URL of the downsampled series
+ */
+function datasetDataUrl(datasetId, options) {
+    const params = new URLSearchParams();
+    if (options.start) params.set('start', options.start);
+    if (options.end) params.set('end', options.end);
+    if (options.maxPoints) params.set('max_points', options.maxPoints);
+    if (options.method) params.set('method', options.method);
+    const query = params.toString();
+    return `/api/dataset/${datasetId}/data${query ? '?' + query : ''}`;
+}
+
 /**
  * Fetches dataset data and creates charts
  * @param {number} datasetId - The ID of the dataset to fetch
  * @param {string} containerSelector - The selector for the container to render charts in
+ * @param {Object} options - Optional start, end, maxPoints and method for the series, and
+ *                           details: false to skip the anomaly details table
  */
-function loadDatasetVisualizations(datasetId, containerSelector) {
+function loadDatasetVisualizations(datasetId, containerSelector, options = {}) {
     const container = document.querySelector(containerSelector);
     
     if (!container) {
@@ -513,6 +593,10 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
         return;
     }
     
+    // About two readings per horizontal pixel is all a line chart can show
+    const dataOptions = Object.assign({maxPoints: Math.max(Math.round(container.clientWidth * 2), 500)}, options);
+    const showDetails = options.details !== false;
+    
     // Show loading state
     container.innerHTML = `
         <div class="loader-container">
@@ -521,12 +605,16 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
         </div>
     `;
     
-    // Fetch dataset data
-    fetch(`/api/dataset/${datasetId}/data`)
+    // Fetch dataset data as packed typed arrays
+    fetch(datasetDataUrl(datasetId, dataOptions), {headers: {Accept: SERIES_MIMETYPE}})
         .then(response => {
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
+            // Series the binary format can't represent are sent as JSON
+            if ((response.headers.get('Content-Type') || '').startsWith(SERIES_MIMETYPE)) {
+                return response.arrayBuffer().then(decodeSeries);
+            }
             return response.json();
         })
         .then(data => {
@@ -542,16 +630,16 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
                 </div>
                 <div class="card-body">
                     <div class="chart-container">
-                        <canvas id="energy-time-chart"></canvas>
+                        <canvas id="energy-time-chart-${datasetId}"></canvas>
                     </div>
                 </div>
             `;
             container.appendChild(timeSeriesContainer);
             
-            createEnergyConsumptionChart('energy-time-chart', data);
+            createEnergyConsumptionChart(`energy-time-chart-${datasetId}`, data);
             
             // Create correlation chart if temperature data exists
-            if (data.temperature && data.temperature.length > 0) {
+            if (data.temperature && data.temperature.some(isPresent)) {
                 const correlationContainer = document.createElement('div');
                 correlationContainer.className = 'card mb-4';
                 correlationContainer.innerHTML = `
@@ -560,18 +648,20 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
                     </div>
                     <div class="card-body">
                         <div class="chart-container">
-                            <canvas id="correlation-chart"></canvas>
+                            <canvas id="correlation-chart-${datasetId}"></canvas>
                         </div>
                     </div>
                 `;
                 container.appendChild(correlationContainer);
                 
-                createCorrelationChart('correlation-chart', data);
+                createCorrelationChart(`correlation-chart-${datasetId}`, data);
             }
             
             // Create anomaly proportion chart
-            const anomalyCount = data.is_anomaly.filter(val => val === 1).length;
-            const normalCount = data.is_anomaly.length - anomalyCount;
+            // Counts cover the whole window, not just the downsampled readings
+            const totalCount = data.total_points;
+            const anomalyCount = data.anomaly_count;
+            const normalCount = totalCount - anomalyCount;
             
             if (anomalyCount > 0) {
                 const proportionContainer = document.createElement('div');
@@ -584,16 +674,16 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
                         <div class="row">
                             <div class="col-md-6">
                                 <div class="chart-container" style="height: 300px;">
-                                    <canvas id="anomaly-proportion-chart"></canvas>
+                                    <canvas id="anomaly-proportion-chart-${datasetId}"></canvas>
                                 </div>
                             </div>
                             <div class="col-md-6">
                                 <div class="anomaly-stats p-3">
                                     <h4>Anomaly Statistics</h4>
                                     <ul class="list-unstyled">
-                                        <li><strong>Total Data Points:</strong> ${data.timestamps.length}</li>
-                                        <li><strong>Normal Data Points:</strong> ${normalCount} (${((normalCount / data.timestamps.length) * 100).toFixed(1)}%)</li>
-                                        <li><strong>Anomalies Detected:</strong> ${anomalyCount} (${((anomalyCount / data.timestamps.length) * 100).toFixed(1)}%)</li>
+                                        <li><strong>Total Data Points:</strong> ${totalCount}</li>
+                                        <li><strong>Normal Data Points:</strong> ${normalCount} (${((normalCount / totalCount) * 100).toFixed(1)}%)</li>
+                                        <li><strong>Anomalies Detected:</strong> ${anomalyCount} (${((anomalyCount / totalCount) * 100).toFixed(1)}%)</li>
                                     </ul>
                                 </div>
                             </div>
@@ -602,12 +692,13 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
                 `;
                 container.appendChild(proportionContainer);
                 
-                createAnomalyProportionChart('anomaly-proportion-chart', normalCount, anomalyCount);
+                createAnomalyProportionChart(`anomaly-proportion-chart-${datasetId}`, normalCount, anomalyCount);
                 
                 // Fetch anomaly details for additional visualizations
-                fetch(`/api/dataset/${datasetId}/anomalies`)
+                if (showDetails) fetch(`/api/dataset/${datasetId}/anomalies?limit=100`)
                     .then(response => response.json())
-                    .then(anomalies => {
+                    .then(page => {
+                        const anomalies = page.anomalies;
                         if (anomalies && anomalies.length > 0) {
                             // Add anomaly details table
                             const anomalyTable = document.createElement('div');
@@ -615,6 +706,7 @@ function loadDatasetVisualizations(datasetId, containerSelector) {
                             anomalyTable.innerHTML = `
                                 <div class="card-header">
                                     <h3>Anomaly Details</h3>
+                                    ${page.next_cursor ? `<small>Showing the first ${anomalies.length} of ${anomalyCount} anomalies</small>` : ''}
                                 </div>
                                 <div class="card-body">
                                     <div class="table-container">
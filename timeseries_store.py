@@ -0,0 +1,443 @@
+"""
+Read/write API for the energy readings of a dataset.
+
+Readings always live in the ``data_point`` table, since anomalies reference
+them by id. When ``SERIES_STORE_ENABLED`` is set, every write is also
+appended to a per-dataset columnar store: compressed ``.npz`` chunks of
+contiguous id, timestamp, consumption, temperature, humidity and occupancy
+arrays under ``SERIES_STORE_DIR/<dataset_id>/``. Reads consolidate the
+chunks into plain ``.npy`` column files once and then serve memory-mapped
+NumPy views of them, so analysis code never rehydrates ORM objects.
+
+Datasets without a columnar store are read from the row table.
+"""
+import os
+import json
+import uuid
+import time
+import shutil
+import logging
+import numpy as np
+from datetime import datetime
+from sqlalchemy import event, select, func, update, insert
+from app import app, db
+from models import DataPoint, DatasetVersion
+from dataset_stats import record_points
+
+
+# Rows per INSERT statement
+INSERT_CHUNK_SIZE = 10000
+
+SERIES_COLUMNS = ('id', 'timestamp', 'energy_consumption', 'temperature', 'humidity', 'occupancy')
+
+OPTIONAL_COLUMNS = ('temperature', 'humidity', 'occupancy')
+
+COLUMN_DTYPES = {
+    'id': np.int64,
+    'timestamp': 'datetime64[us]',
+    'energy_consumption': np.float64,
+    'temperature': np.float64,
+    'humidity': np.float64,
+    'occupancy': np.float64,
+}
+
+_PENDING_KEY = 'series_store_pending'
+
+
+def store_enabled():
+    return bool(app.config.get('SERIES_STORE_ENABLED'))
+
+
+def _store_path(dataset_id):
+    return os.path.join(app.config['SERIES_STORE_DIR'], str(int(dataset_id)))
+
+
+def has_store(dataset_id):
+    """Whether reads for this dataset are served by the columnar store."""
+    return store_enabled() and os.path.isdir(_store_path(dataset_id))
+
+
+def _sql_values(values, integer=False):
+    """Convert a float array with NaN gaps to a list of Python values with None."""
+    result = np.empty(len(values), dtype=object)
+    valid = ~np.isnan(values)
+    result[valid] = values[valid].astype(np.int64 if integer else np.float64).tolist()
+    return result.tolist()
+
+
+def insert_rows(dataset_id, columns, chunk_size=INSERT_CHUNK_SIZE, return_ids=False):
+    """
+    Write column arrays to the data_point table with chunked Core INSERTs.
+
+    Optional columns may be missing from ``columns`` or contain NaN, in
+    which case NULL is stored. The caller commits.
+
+    Args:
+        dataset_id: ID of the dataset these points belong to
+        columns: Dict of NumPy arrays keyed by DataPoint column name
+        chunk_size: Number of rows per INSERT
+        return_ids: Whether to return the generated primary keys
+
+    Returns:
+        Number of rows inserted, or an int64 array of their ids in input
+        order if return_ids is set
+    """
+    table = DataPoint.__table__
+    total = len(columns['timestamp'])
+    statement = table.insert()
+    if return_ids:
+        statement = statement.returning(table.c.id, sort_by_parameter_order=True)
+    ids = []
+
+    for start in range(0, total, chunk_size):
+        stop = start + chunk_size
+        timestamps = np.asarray(columns['timestamp'][start:stop]).astype('datetime64[us]').tolist()
+        energy = np.asarray(columns['energy_consumption'][start:stop], dtype=np.float64).tolist()
+        optional = {}
+        for name in OPTIONAL_COLUMNS:
+            values = columns.get(name)
+            if values is None:
+                optional[name] = [None] * len(timestamps)
+            else:
+                values = np.asarray(values[start:stop], dtype=np.float64)
+                optional[name] = _sql_values(values, integer=(name == 'occupancy'))
+
+        rows = [{
+            'timestamp': ts,
+            'energy_consumption': value,
+            'temperature': temperature,
+            'humidity': humidity,
+            'occupancy': occupancy,
+            'dataset_id': dataset_id
+        } for ts, value, temperature, humidity, occupancy in zip(
+            timestamps, energy, optional['temperature'], optional['humidity'], optional['occupancy']
+        )]
+        result = db.session.execute(statement, rows)
+        if return_ids:
+            ids.extend(result.scalars().all())
+
+    if return_ids:
+        return np.asarray(ids, dtype=np.int64)
+    return total
+
+
+def _normalize(columns, ids):
+    """Build a complete, typed column dict for the store."""
+    n = len(ids)
+    series = {'id': ids}
+    for name in SERIES_COLUMNS[1:]:
+        values = columns.get(name)
+        if values is None:
+            series[name] = np.full(n, np.nan)
+        else:
+            series[name] = np.asarray(values).astype(COLUMN_DTYPES[name])
+    return series
+
+
+def get_data_version(dataset_id):
+    """Current content version of a dataset's readings (0 if never written)."""
+    version = db.session.execute(
+        select(DatasetVersion.data_version).where(DatasetVersion.dataset_id == dataset_id)
+    ).scalar()
+    return version or 0
+
+
+def get_versions(dataset_id):
+    """Current (readings, anomalies) content versions of a dataset."""
+    row = db.session.execute(
+        select(DatasetVersion.data_version, DatasetVersion.anomaly_version)
+        .where(DatasetVersion.dataset_id == dataset_id)
+    ).first()
+    return (row.data_version or 0, row.anomaly_version or 0) if row is not None else (0, 0)
+
+
+def _bump_version(dataset_id, name):
+    table = DatasetVersion.__table__
+    now = datetime.utcnow()
+    updated = db.session.execute(
+        update(table)
+        .where(table.c.dataset_id == dataset_id)
+        .values({name: func.coalesce(table.c[name], 0) + 1, 'updated_at': now})
+    ).rowcount
+    if not updated:
+        values = {'data_version': 0, 'anomaly_version': 0, name: 1}
+        db.session.execute(insert(table).values(dataset_id=dataset_id, updated_at=now, **values))
+
+
+def bump_data_version(dataset_id):
+    """Mark a dataset's readings as changed, invalidating cached features."""
+    _bump_version(dataset_id, 'data_version')
+
+
+def bump_anomaly_version(dataset_id):
+    """Mark a dataset's current anomalies as changed, invalidating cached responses."""
+    _bump_version(dataset_id, 'anomaly_version')
+
+
+def write_series(dataset_id, columns, return_ids=False):
+    """
+    Append readings to a dataset.
+
+    Rows go to the data_point table immediately; if the columnar store is
+    enabled the same rows are appended to it once the session commits, and
+    discarded if it rolls back.
+
+    Args:
+        dataset_id: ID of the dataset
+        columns: Dict of NumPy arrays keyed by DataPoint column name
+        return_ids: Whether to return the ids of the new rows
+
+    Returns:
+        Number of rows written, or an int64 array of the new row ids if
+        return_ids is set
+    """
+    bump_data_version(dataset_id)
+
+    # A dataset that already has rows but no store stays on the row table
+    # until rebuild_store() is run for it
+    stage = store_enabled()
+    if stage:
+        pending = db.session.info.setdefault(_PENDING_KEY, [])
+        stage = (os.path.isdir(_store_path(dataset_id))
+                 or any(pending_id == dataset_id for pending_id, _ in pending)
+                 or _count_rows(dataset_id) == 0)
+
+    if not stage:
+        result = insert_rows(dataset_id, columns, return_ids=return_ids)
+        record_points(dataset_id, len(result) if return_ids else result)
+        return result
+
+    ids = insert_rows(dataset_id, columns, return_ids=True)
+    if len(ids):
+        pending.append((dataset_id, _normalize(columns, ids)))
+    record_points(dataset_id, len(ids))
+    return ids if return_ids else len(ids)
+
+
+def append_point(dataset_id, timestamp, energy_consumption, temperature=None, humidity=None, occupancy=None):
+    """
+    Append a single reading to a dataset. The caller commits.
+
+    Returns:
+        Dict of one-element column arrays for the new reading, including its id
+    """
+    columns = {
+        'timestamp': np.array([timestamp], dtype='datetime64[us]'),
+        'energy_consumption': np.array([energy_consumption], dtype=np.float64),
+        'temperature': np.array([temperature], dtype=np.float64),
+        'humidity': np.array([humidity], dtype=np.float64),
+        'occupancy': np.array([occupancy], dtype=np.float64),
+    }
+    columns['id'] = write_series(dataset_id, columns, return_ids=True)
+    return columns
+
+
+def _write_chunk(dataset_id, series):
+    path = _store_path(dataset_id)
+    os.makedirs(path, exist_ok=True)
+    name = f"chunk-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz"
+    tmp_path = os.path.join(path, f".{name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **series)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _flush_pending_chunks(session):
+    for dataset_id, series in session.info.pop(_PENDING_KEY, []):
+        try:
+            _write_chunk(dataset_id, series)
+        except OSError as e:
+            # The row table stays authoritative; drop the stale store
+            logging.error(f"Error writing series chunk for dataset {dataset_id}: {str(e)}")
+            delete_store(dataset_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_pending_chunks(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _chunk_names(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('chunk-') and name.endswith('.npz'))
+
+
+def _consolidate(path):
+    """
+    Merge the chunks into one uncompressed, timestamp-ordered .npy file per
+    column, unless the existing consolidation already covers every chunk.
+    Chunks added since the last consolidation are folded into it, so each
+    append is decompressed once rather than on every consolidation.
+    """
+    chunks = _chunk_names(path)
+    columns_path = os.path.join(path, 'columns')
+    manifest_path = os.path.join(columns_path, 'manifest.json')
+
+    try:
+        with open(manifest_path) as f:
+            folded = json.load(f)['chunks']
+        if folded == chunks:
+            return columns_path
+        base = ({name: np.load(os.path.join(columns_path, f"{name}.npy"), mmap_mode='r') for name in SERIES_COLUMNS}
+                if set(folded).issubset(chunks) else None)
+    except (OSError, ValueError, KeyError):
+        base = None
+    if base is None:
+        folded = []
+
+    folded_names = set(folded)
+    parts = {name: [] for name in SERIES_COLUMNS}
+    for chunk in chunks:
+        if chunk in folded_names:
+            continue
+        with np.load(os.path.join(path, chunk)) as data:
+            for name in SERIES_COLUMNS:
+                parts[name].append(data[name])
+
+    added = {name: (np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=COLUMN_DTYPES[name]))
+             for name in SERIES_COLUMNS}
+    order = np.lexsort((added['id'], added['timestamp']))
+    added = {name: values[order] for name, values in added.items()}
+    if base is None:
+        merged = added
+    else:
+        merged = {name: np.concatenate([base[name], added[name]]) for name in SERIES_COLUMNS}
+        # Appends usually come after every consolidated reading, which keeps
+        # the concatenation in order; otherwise sort everything again
+        if (len(base['id']) and len(order)
+                and (added['timestamp'][0], added['id'][0]) < (base['timestamp'][-1], base['id'][-1])):
+            order = np.lexsort((merged['id'], merged['timestamp']))
+            merged = {name: values[order] for name, values in merged.items()}
+
+    # Build into a scratch directory and swap it in, so concurrent readers
+    # never see a half-written consolidation
+    scratch = f"{columns_path}.{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(scratch)
+    for name in SERIES_COLUMNS:
+        np.save(os.path.join(scratch, f"{name}.npy"), merged[name])
+    with open(os.path.join(scratch, 'manifest.json'), 'w') as f:
+        json.dump({'chunks': chunks, 'count': int(len(merged['id']))}, f)
+
+    stale = f"{columns_path}.{uuid.uuid4().hex[:8]}.old"
+    try:
+        if os.path.isdir(columns_path):
+            os.rename(columns_path, stale)
+        os.rename(scratch, columns_path)
+    except OSError:
+        # Another process swapped in its consolidation first
+        shutil.rmtree(scratch, ignore_errors=True)
+    shutil.rmtree(stale, ignore_errors=True)
+    return columns_path
+
+
+def _read_store(dataset_id, names, start=None, end=None):
+    columns_path = _consolidate(_store_path(dataset_id))
+    series = {name: np.load(os.path.join(columns_path, f"{name}.npy"), mmap_mode='r') for name in names}
+    if start is None and end is None:
+        return series
+
+    # Columns are timestamp-ordered, so a time window is a contiguous slice
+    timestamps = np.load(os.path.join(columns_path, 'timestamp.npy'), mmap_mode='r')
+    low = 0 if start is None else int(np.searchsorted(timestamps, np.datetime64(start, 'us'), side='left'))
+    high = len(timestamps) if end is None else int(np.searchsorted(timestamps, np.datetime64(end, 'us'), side='left'))
+    return {name: values[low:max(low, high)] for name, values in series.items()}
+
+
+def _count_rows(dataset_id):
+    return db.session.execute(
+        select(func.count(DataPoint.id)).where(DataPoint.dataset_id == dataset_id)
+    ).scalar()
+
+
+def _read_rows(dataset_id, names, start=None, end=None):
+    table = DataPoint.__table__
+    statement = (select(*[table.c[name] for name in names])
+                 .where(table.c.dataset_id == dataset_id)
+                 .order_by(table.c.timestamp, table.c.id))
+    if start is not None:
+        statement = statement.where(table.c.timestamp >= start)
+    if end is not None:
+        statement = statement.where(table.c.timestamp < end)
+    rows = db.session.execute(statement).all()
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: np.array(column, dtype=COLUMN_DTYPES[name]) for name, column in zip(names, values)}
+
+
+def read_series(dataset_id, columns=SERIES_COLUMNS, start=None, end=None):
+    """
+    Read a dataset's readings as NumPy arrays ordered by timestamp.
+
+    Missing optional values are NaN. Arrays served from the columnar store
+    are read-only memory-mapped views; copy before modifying them.
+
+    Args:
+        dataset_id: ID of the dataset
+        columns: Names of the columns to return
+        start: Optional datetime; only readings at or after it are returned
+        end: Optional datetime; only readings before it are returned
+
+    Returns:
+        Dict of NumPy arrays keyed by column name
+    """
+    columns = tuple(columns)
+    if has_store(dataset_id):
+        try:
+            return _read_store(dataset_id, columns, start, end)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Error reading series store for dataset {dataset_id}, using row table: {str(e)}")
+    return _read_rows(dataset_id, columns, start, end)
+
+
+def count_points(dataset_id):
+    """Number of readings in a dataset."""
+    if has_store(dataset_id):
+        manifest_path = os.path.join(_consolidate(_store_path(dataset_id)), 'manifest.json')
+        with open(manifest_path) as f:
+            return json.load(f)['count']
+    return _count_rows(dataset_id)
+
+
+def time_range(dataset_id):
+    """
+    First and last reading time of a dataset.
+
+    Returns:
+        Tuple of (first, last) datetimes, or (None, None) for an empty dataset
+    """
+    if has_store(dataset_id):
+        try:
+            timestamps = _read_store(dataset_id, ('timestamp',))['timestamp']
+            if not len(timestamps):
+                return None, None
+            return timestamps[0].item(), timestamps[-1].item()
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Error reading series store for dataset {dataset_id}, using row table: {str(e)}")
+    return tuple(db.session.execute(
+        select(func.min(DataPoint.timestamp), func.max(DataPoint.timestamp))
+        .where(DataPoint.dataset_id == dataset_id)
+    ).one())
+
+
+def rebuild_store(dataset_id):
+    """Recreate a dataset's columnar store from the row table."""
+    series = _read_rows(dataset_id, SERIES_COLUMNS)
+    delete_store(dataset_id)
+    if len(series['id']):
+        _write_chunk(dataset_id, series)
+    else:
+        os.makedirs(_store_path(dataset_id), exist_ok=True)
+    return len(series['id'])
+
+
+def delete_store(dataset_id):
+    """Remove a dataset's columnar store; reads fall back to the row table."""
+    shutil.rmtree(_store_path(dataset_id), ignore_errors=True)
+
+
+@app.cli.command('rebuild-series-store')
+def rebuild_series_store_command():
+    """Build the columnar store for every dataset from the row table."""
+    from models import Dataset
+    for dataset_id, in db.session.execute(select(Dataset.id)).all():
+        count = rebuild_store(dataset_id)
+        print(f"Dataset {dataset_id}: {count} readings")
@@ -0,0 +1,178 @@
+"""
+Bounded-memory anomaly detection for very large datasets.
+
+Instead of loading every reading and fitting one model over all of them,
+windowed detection walks the series in time windows of
+``DETECTION_WINDOW_DAYS``. Each window fits its detector on a random
+subsample of at most ``DETECTION_FIT_SAMPLE_ROWS`` readings from the window
+plus the ``DETECTION_WINDOW_OVERLAP_DAYS`` before it, then scores the
+window's own readings in chunks of ``DETECTION_SCORE_CHUNK_ROWS``. Every
+reading is scored exactly once, by the model of the window it falls in,
+and the overlap keeps models continuous across window edges.
+
+Each window's anomalies are inserted and committed as the window
+completes, under a ``pending`` detection run that only becomes current
+when the job finishes. Peak memory is bounded by the window size rather
+than the dataset size; only the anomalous readings, which the
+recommendation rules need, are kept across windows. Jobs use this mode
+for datasets with at least ``WINDOWED_DETECTION_MIN_ROWS`` readings.
+"""
+import json
+import time
+import logging
+import numpy as np
+from datetime import timedelta
+from sklearn.preprocessing import StandardScaler
+from app import app, db
+from models import Anomaly
+from anomaly_detection import fit_detector, score_detector
+from ensemble import ENSEMBLE_ALGORITHMS, ENSEMBLE_DETECTORS, combine_scores
+from feature_cache import build_features
+from model_registry import save_model
+from recommendation_rules import readings_for
+from timeseries_store import read_series, time_range, count_points, get_data_version
+from detection_runs import insert_anomalies
+from metrics import stage
+
+
+def use_windowed_detection(point_count):
+    """Whether a dataset of this many readings is detected window by window."""
+    return point_count >= app.config['WINDOWED_DETECTION_MIN_ROWS']
+
+
+def detection_windows(first, last, window_days=None, overlap_days=None):
+    """
+    Split a time range into detection windows.
+
+    Args:
+        first: Time of the first reading
+        last: Time of the last reading
+        window_days: Length of each window; DETECTION_WINDOW_DAYS if None
+        overlap_days: Extra history each window fits on;
+            DETECTION_WINDOW_OVERLAP_DAYS if None
+
+    Returns:
+        List of (fit start, window start, window end) datetimes. Windows
+        are contiguous, cover [first, last] and each starts where the
+        previous one ends.
+    """
+    window = timedelta(days=window_days or app.config['DETECTION_WINDOW_DAYS'])
+    overlap = timedelta(days=app.config['DETECTION_WINDOW_OVERLAP_DAYS'] if overlap_days is None else overlap_days)
+    windows = []
+    start = first
+    while start <= last:
+        end = start + window
+        windows.append((max(first, start - overlap), start, end))
+        start = end
+    return windows
+
+
+def _fit_window(algorithm, X, contamination, rng):
+    """Fit a window's scaler and detectors on a subsample of its features."""
+    sample_size = min(len(X), app.config['DETECTION_FIT_SAMPLE_ROWS'])
+    sample = X[np.sort(rng.choice(len(X), size=sample_size, replace=False))] if sample_size < len(X) else X
+    scaler = StandardScaler().fit(sample)
+    X_sample = scaler.transform(sample)
+    names = ENSEMBLE_DETECTORS if algorithm in ENSEMBLE_ALGORITHMS else (algorithm,)
+    return scaler, {name: fit_detector(name, X_sample, contamination) for name in names}
+
+
+def _score_window(algorithm, detectors, scaler, X, contamination):
+    """Score a window's readings in chunks; returns scores, labels, per-detector scores."""
+    chunk_rows = app.config['DETECTION_SCORE_CHUNK_ROWS']
+    scores = {name: np.empty(len(X)) for name in detectors}
+    labels = {name: np.empty(len(X), dtype=bool) for name in detectors}
+    for low in range(0, len(X), chunk_rows):
+        X_chunk = scaler.transform(X[low:low + chunk_rows])
+        for name, detector in detectors.items():
+            scores[name][low:low + chunk_rows], labels[name][low:low + chunk_rows] = score_detector(detector, X_chunk)
+
+    if algorithm in ENSEMBLE_ALGORITHMS:
+        combined, is_anomaly = combine_scores(scores, labels, ENSEMBLE_ALGORITHMS[algorithm], contamination)
+        return combined, is_anomaly, scores
+    return scores[algorithm], labels[algorithm], None
+
+
+def detect_windowed(dataset, algorithm, contamination, run, progress=None):
+    """
+    Detect anomalies window by window, storing and committing each window's
+    anomalies in the given run.
+
+    Args:
+        dataset: The Dataset model instance
+        algorithm: Algorithm name, including the ensemble algorithms
+        contamination: Float between 0 and 0.5 representing expected percentage of anomalies
+        run: Pending DetectionRun the anomalies are stored in
+        progress: Optional callable taking (windows done, total windows)
+
+    Returns:
+        Dict with the readings of the anomalous points ('readings', as
+        returned by readings_for, or None if there are none) and the id of
+        the first anomaly stored ('anomaly_id', or None)
+    """
+    first, last = time_range(dataset.id)
+    if first is None:
+        logging.warning(f"No data points found for dataset {dataset.id}")
+        return {'readings': None, 'anomaly_id': None}
+
+    windows = detection_windows(first, last)
+    rng = np.random.default_rng(42)
+    anomaly_id = None
+    readings = []
+    fitted = None
+    for index, (fit_start, start, end) in enumerate(windows, 1):
+        started = time.perf_counter()
+        with stage('detection', 'load'):
+            series = read_series(dataset.id, start=fit_start, end=end)
+        window_low = int(np.searchsorted(series['timestamp'], np.datetime64(start, 'us'), side='left'))
+        if window_low < len(series['id']):
+            with stage('detection', 'features'):
+                X, feature_names = build_features(series)
+            with stage('detection', 'fit'):
+                scaler, detectors = _fit_window(algorithm, X, contamination, rng)
+            with stage('detection', 'score'):
+                scores, is_anomaly, detector_scores = _score_window(algorithm, detectors, scaler, X[window_low:],
+                                                                    contamination)
+            fitted = (scaler, detectors, feature_names, time.perf_counter() - started, start)
+
+            indices = np.flatnonzero(is_anomaly)
+            ids = series['id'][window_low:][indices]
+            anomalies = [
+                Anomaly(
+                    data_point_id=data_point_id,
+                    dataset_id=dataset.id,
+                    anomaly_score=float(score),
+                    algorithm=algorithm,
+                    detector_scores=json.dumps({name: round(float(values[i]), 6)
+                                                for name, values in detector_scores.items()})
+                    if detector_scores else None
+                )
+                for data_point_id, score, i in zip(ids.tolist(), scores[indices].tolist(), indices.tolist())
+            ]
+            with stage('detection', 'persist'):
+                insert_anomalies(run, anomalies)
+                db.session.commit()
+            if anomalies:
+                anomaly_id = anomaly_id or anomalies[0].id
+                readings.append(readings_for({name: values[window_low:] for name, values in series.items()}, ids))
+            logging.info(f"Window {index}/{len(windows)} of dataset {dataset.id}: {len(anomalies)} anomalies "
+                         f"in {len(series['id']) - window_low} readings ({time.perf_counter() - started:.2f}s)")
+        if progress is not None:
+            progress(index, len(windows))
+
+    # Register the latest window's model, which fits the newest readings, for
+    # incremental scoring of appended data. It counts as trained on every
+    # reading so far, so appends don't immediately trigger a refit. The
+    # components of an ensemble are not a run's model and aren't registered.
+    if fitted is not None and algorithm not in ENSEMBLE_ALGORITHMS:
+        scaler, detectors, feature_names, fit_seconds, start = fitted
+        for name, detector in detectors.items():
+            save_model(dataset.id, name, {'contamination': contamination, 'window_start': start.isoformat()},
+                       detector, scaler, data_version=get_data_version(dataset.id),
+                       training_size=count_points(dataset.id), fit_seconds=fit_seconds,
+                       feature_names=feature_names)
+
+    if not readings:
+        return {'readings': None, 'anomaly_id': None}
+    return {'readings': {name: np.concatenate([window[name] for window in readings]) for name in readings[0]},
+            'anomaly_id': anomaly_id}